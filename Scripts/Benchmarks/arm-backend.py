@@ -0,0 +1,293 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+# Benchmark for the Azure Resource Manager backend of the deployment:
+# runs the ARM calls a service deployment makes against a local fake
+# ARM server, and optionally measures the start up time of the az CLI,
+# which the az CLI backend pays for every command.
+
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+cur_dir = os.path.dirname(os.path.abspath(__file__))
+cli_dir = os.path.join(cur_dir, '..', '..', 'cli')
+sys.path.append(cli_dir)
+from raft_sdk import raft_deploy
+from raft_sdk.raft_deploy import ArmBackend, RaftAzCliException
+
+
+class FakeArmServer(ThreadingHTTPServer):
+    '''
+        Keeps resources created with PUT in memory. Resource creation
+        completes as a long running operation when async_operations is set.
+    '''
+    daemon_threads = True
+
+    def __init__(self, address, latency=0.0, async_operations=True):
+        super(FakeArmServer, self).__init__(address, FakeArmHandler)
+        self.latency = latency
+        self.async_operations = async_operations
+        self.resources = {}
+        self.operations = {}
+        self.lock = threading.Lock()
+        self.request_count = 0
+
+    @property
+    def endpoint(self):
+        return f'http://127.0.0.1:{self.server_address[1]}'
+
+
+class FakeArmHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # headers and body are sent in one write, delayed ACKs
+    # of separate writes would add to every round trip
+    wbufsize = 64 * 1024
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, status, body=None, headers=None):
+        data = json.dumps(body).encode() if body is not None else b''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def not_found(self, path):
+        self.reply(404, {'error': {'code': 'ResourceNotFound',
+                                   'message': f'{path} was not found'}})
+
+    def request_path(self):
+        # resource paths are case-insensitive
+        return self.path.split('?')[0].rstrip('/').lower()
+
+    def handle_request(self, method):
+        server = self.server
+        with server.lock:
+            server.request_count += 1
+        time.sleep(server.latency)
+
+        if not self.headers.get('Authorization', '').startswith('Bearer '):
+            self.reply(401, {'error': {'code': 'AuthenticationFailed',
+                                       'message': 'Missing bearer token'}})
+            return
+
+        length = int(self.headers.get('Content-Length') or 0)
+        body = json.loads(self.rfile.read(length)) if length else None
+        path = self.request_path()
+        getattr(self, f'do_{method}_request')(server, path, body)
+
+    def do_PUT_request(self, server, path, body):
+        resource = dict(body or {})
+        resource['id'] = self.path.split('?')[0]
+        resource['name'] = resource['id'].split('/')[-1]
+        properties = dict(resource.get('properties') or {})
+        properties['provisioningState'] = 'Succeeded'
+        if path.endswith('/microsoft.eventgrid/domains/' + resource['name'].lower()):
+            properties['endpoint'] = (f'https://{resource["name"]}.westus2-1'
+                                      '.eventgrid.azure.net/api/events')
+        resource['properties'] = properties
+        with server.lock:
+            server.resources[path] = resource
+
+        if server.async_operations and '/config/' not in path:
+            operation_id = f'{uuid.uuid4()}'
+            with server.lock:
+                server.operations[operation_id] = 'Succeeded'
+            self.reply(201, resource, {
+                'Azure-AsyncOperation': f'{server.endpoint}/operations/{operation_id}',
+                'Retry-After': '0'
+            })
+        else:
+            self.reply(200, resource)
+
+    def do_GET_request(self, server, path, body):
+        if path.startswith('/operations/'):
+            status = server.operations.get(path.split('/')[-1])
+            if status is None:
+                self.not_found(path)
+            else:
+                self.reply(200, {'status': status})
+        elif re.match(r'^/subscriptions/[^/]+/providers/[^/]+$', path):
+            self.reply(200, {'namespace': path.split('/')[-1],
+                             'registrationState': 'Registered'})
+        elif path in server.resources:
+            self.reply(200, server.resources[path])
+        else:
+            self.not_found(path)
+
+    def do_POST_request(self, server, path, body):
+        parent, _, action = path.rpartition('/')
+        if action == 'listkeys':
+            name = parent.split('/')[-1]
+            key = 'ZmFrZS1rZXk='
+            self.reply(200, {
+                'keys': [{'keyName': 'key1', 'value': key, 'permissions': 'FULL'}],
+                'key1': key,
+                'key2': key,
+                'keyName': name,
+                'primaryKey': key,
+                'primaryConnectionString': ('Endpoint=sb://fake.servicebus.windows.net/;'
+                                            f'SharedAccessKeyName={name};SharedAccessKey={key}')
+            })
+        elif action == 'list' and parent.endswith('/config/appsettings'):
+            self.reply(200, server.resources.get(parent, {'properties': {}}))
+        elif action == 'register':
+            self.reply(200, {'namespace': parent.split('/')[-1],
+                             'registrationState': 'Registered'})
+        elif action == 'restart':
+            self.reply(200)
+        else:
+            self.not_found(path)
+
+    def do_PUT(self):
+        self.handle_request('PUT')
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+    def do_POST(self):
+        self.handle_request('POST')
+
+
+def deployment_commands(rg, name):
+    '''
+        ARM commands the service deployment runs, in deployment order
+    '''
+    sb = f'{name}-sb'
+    commands = [
+        f'group create --name {rg} --location westus2',
+        f'servicebus namespace create --resource-group {rg} --name {sb}'
+        ' --location westus2 --sku Standard'
+    ]
+    for rule, rights in [('Read', 'Listen'), ('Send', 'Send')]:
+        commands += [
+            'servicebus namespace authorization-rule create'
+            f' --resource-group {rg} --namespace-name {sb}'
+            f' --name "{rule}" --rights {rights}',
+            'servicebus namespace authorization-rule keys list'
+            f' --resource-group {rg} --namespace-name {sb} --name "{rule}"'
+        ]
+    for queue in ['create-queue', 'delete-queue']:
+        commands.append(
+            f'servicebus queue create --resource-group {rg} --namespace-name {sb}'
+            f' --name {queue} --enable-session true')
+    commands += [
+        f'servicebus topic create --resource-group {rg} --namespace-name {sb}'
+        ' --name job-events --enable-ordering true',
+        'servicebus topic authorization-rule create'
+        f' --resource-group {rg} --namespace-name {sb} --topic-name job-events'
+        ' --name "Send-Events" --rights Send',
+        'servicebus topic authorization-rule keys list'
+        f' --resource-group {rg} --namespace-name {sb} --topic-name job-events'
+        ' --name "Send-Events"',
+        'servicebus topic subscription create'
+        f' --resource-group {rg} --namespace-name {sb} --topic-name job-events'
+        ' --name "jobstatus-handler"',
+        'servicebus topic subscription create'
+        f' --resource-group {rg} --namespace-name {sb} --topic-name job-events'
+        ' --name "webhooks-handler"'
+    ]
+    for storage in [f'{name}utils', f'{name}results']:
+        commands.append(
+            f'storage account create --name {storage} --resource-group {rg}'
+            ' --https-only true --location westus2')
+    commands += [
+        'storage account show-connection-string'
+        f' --resource-group {rg} --name "{name}utils" --query connectionString',
+        f'eventgrid domain create --location westus2 --name {name}-ed'
+        f' --resource-group {rg}',
+        f'eventgrid domain show --resource-group {rg} --name {name}-ed',
+        f'eventgrid domain key list --resource-group {rg} --name {name}-ed',
+        f'appservice plan create --name {name}-asp --resource-group {rg}'
+        ' --is-linux --location westus2 --number-of-workers 2 --sku B2'
+    ]
+    for site in ['functionapp', 'webapp']:
+        commands += [
+            f'{site} config appsettings list --name {name}-{site}'
+            f' --resource-group {rg}',
+            f'{site} config appsettings set --name {name}-{site}'
+            f' --resource-group {rg} --settings "RAFT_UTILS_FILESHARE={uuid.uuid4()}"',
+            f'{site} restart --name {name}-{site} --resource-group {rg}'
+        ]
+    for provider in ['Microsoft.ContainerRegistry', 'Microsoft.ContainerInstance']:
+        commands.append(f'provider register --namespace {provider} --wait')
+    return commands
+
+
+class NoFallback():
+    def run(self, args):
+        raise RaftAzCliException('Command is not an ARM call', args)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='ARM backend benchmark')
+    parser.add_argument('--latency-ms', type=float, default=20,
+                        help='Simulated ARM round trip latency')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--az-startup', action='store_true',
+                        help='Also measure the start up time of the az CLI')
+    args = parser.parse_args()
+
+    server = FakeArmServer(('127.0.0.1', 0), args.latency_ms / 1000.0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    subscription = f'{uuid.uuid4()}'
+    commands = deployment_commands('raft-benchmark-rg', 'raftbench')
+    print(f'{len(commands)} deployment commands,'
+          f' simulated ARM latency {args.latency_ms:.0f} ms')
+
+    timings = []
+    for _ in range(args.repeat):
+        backend = ArmBackend(subscription, endpoint=server.endpoint,
+                             token='fake-token', fallback=NoFallback())
+        raft_deploy.use_az_backend(backend)
+        start = time.time()
+        for c in commands:
+            raft_deploy.az(c)
+        timings.append(time.time() - start)
+
+    # results must have the shape the deployment reads
+    assert raft_deploy.az_json(
+        'eventgrid domain show --resource-group raft-benchmark-rg'
+        ' --name raftbench-ed')['endpoint']
+    assert raft_deploy.az_json(
+        'servicebus namespace authorization-rule keys list'
+        ' --resource-group raft-benchmark-rg --namespace-name raftbench-sb'
+        ' --name "Read"')['primaryConnectionString']
+    assert [s for s in raft_deploy.az_json(
+        'functionapp config appsettings list --name raftbench-functionapp'
+        ' --resource-group raft-benchmark-rg')
+        if s['name'] == 'RAFT_UTILS_FILESHARE']
+
+    t = min(timings)
+    print(f'ARM backend: {t * 1000:.0f} ms,'
+          f' {t * 1000 / len(commands):.1f} ms per command,'
+          f' {backend.stats()["requests"]} requests')
+
+    if args.az_startup:
+        startups = []
+        for _ in range(args.repeat):
+            start = time.time()
+            r = subprocess.run('az --version', shell=True,
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            startups.append(time.time() - start)
+        if r.returncode != 0:
+            print('az CLI is not installed')
+        else:
+            s = min(startups)
+            print(f'az CLI start up: {s * 1000:.0f} ms per command,'
+                  f' at least {s * len(commands):.1f} s for the deployment commands')
+
+    server.shutdown()
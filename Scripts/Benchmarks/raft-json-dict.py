@@ -0,0 +1,97 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+# Microbenchmark for RaftJsonDict: parses a synthetic /jobs response
+# and reads job status fields using the previous linear-scan dictionary
+# and the current lowered-key index implementation.
+
+import argparse
+import json
+import os
+import sys
+import timeit
+
+cur_dir = os.path.dirname(os.path.abspath(__file__))
+cli_dir = os.path.join(cur_dir, '..', '..', 'cli')
+sys.path.append(cli_dir)
+from raft_sdk.raft_common import RaftJsonDict
+
+
+class LinearScanJsonDict(dict):
+    def __init__(self):
+        super(LinearScanJsonDict, self).__init__()
+
+    def __getitem__(self, key):
+        for k in self.keys():
+            if k.lower() == key.lower():
+                key = k
+                break
+        return super(LinearScanJsonDict, self).__getitem__(key)
+
+    def get(self, key):
+        for k in self.keys():
+            if k.lower() == key.lower():
+                key = k
+                break
+        return super(LinearScanJsonDict, self).get(key)
+
+    @staticmethod
+    def raft_json_object_hook(x):
+        r = LinearScanJsonDict()
+        for k in x:
+            r[k] = x[k]
+        return r
+
+
+def jobs_response(jobs, agents):
+    status = []
+    for j in range(jobs):
+        job_id = f'job-{j}'
+        for a in range(agents):
+            status.append({
+                'jobId': job_id,
+                'agentName': job_id if a == 0 else f'{job_id}_{a}',
+                'tool': 'RESTler',
+                'state': 'Running',
+                'utcEventTime': '2021-03-01T10:00:00Z',
+                'resultsUrl': f'https://results/{job_id}',
+                'details': {'lastLogLine': 'Fuzzing', 'iteration': a},
+                'metrics': {
+                    'totalRequestCount': 1000 + a,
+                    'responseCodeCounts': {'200': 900, '404': 80, '500': 20 + a}
+                }
+            })
+    return json.dumps(status)
+
+
+def parse_and_read(text, hook):
+    # mixes exact-case lookups (print_status) with lookups that differ
+    # in casing from the payload (raft_local event sink processing)
+    total = 0
+    for s in json.loads(text, object_hook=hook):
+        if s['agentName'] != s['jobId'] and s.get('metrics'):
+            total += s['metrics']['totalRequestCount']
+            total += s['Metrics']['ResponseCodeCounts']['500']
+        if s['State'] == 'Completed' and s.get('Details'):
+            total += 1
+        total += len(s['AgentName'])
+    return total
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='RaftJsonDict microbenchmark')
+    parser.add_argument('--jobs', type=int, default=500)
+    parser.add_argument('--agents', type=int, default=10)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    text = jobs_response(args.jobs, args.agents)
+    print(f'/jobs response: {args.jobs * args.agents} status entries, {len(text)} bytes')
+
+    assert parse_and_read(text, LinearScanJsonDict.raft_json_object_hook) ==\
+        parse_and_read(text, RaftJsonDict.raft_json_object_hook)
+
+    for name, hook in [('linear scan', LinearScanJsonDict.raft_json_object_hook),
+                       ('lowered-key index', RaftJsonDict.raft_json_object_hook)]:
+        t = min(timeit.repeat(lambda: parse_and_read(text, hook), number=1, repeat=args.repeat))
+        print(f'{name:>20}: {t * 1000:.1f} ms')
@@ -6,7 +6,6 @@ import sys
 import os
 import json
 import urllib.parse
-import time
 
 cur_dir = os.path.dirname(os.path.abspath(__file__))
 cli_dir = os.path.join(cur_dir, '..', '..', 'cli')
@@ -33,27 +32,16 @@ def find_files():
     return configs
 
 def wait(configs, count, task_name, job_id_key):
+    job_ids = []
+    for c in configs:
+        if configs[c].get(task_name):
+            job_ids.append(configs[c][job_id_key])
+
     completed_count = 0
-    completed_counted = {}
-    while completed_count < count:
-        for c in configs:
-            if configs[c].get(task_name):
-                try:
-                    status = cli.job_status(configs[c][job_id_key])
-                except RaftApiException as ex:
-                    if ex.status_code != 404:
-                        raise ex
-                completed, _ = cli.is_completed(status)
-                if completed and not completed_counted.get(configs[c][job_id_key]):
-                    completed_counted[configs[c][job_id_key]] = True
-                    completed_count += 1
-                    print('Jobs completed: ' + configs[c][job_id_key] + " job index : " + str(completed_count) + ' out of ' + str(count))
-                cli.print_status(status)
-        for _ in range(1,9) :
-            sys.stdout.write('.')
-            sys.stdout.flush()
-            time.sleep(1)
-        print('.')
+    for job_id, status, _ in cli.poll_many(job_ids):
+        completed_count += 1
+        print('Jobs completed: ' + job_id + " job index : " + str(completed_count) + ' out of ' + str(count))
+        cli.print_status(status)
 
 
 def compile_and_dredd_and_schemathesis(cli, configs):
@@ -1,31 +1,117 @@
 import msal
 import os
 import json
+import copy
 import sys
+import time
+import fcntl
+import hashlib
+import tempfile
 
 class RaftJsonDict(dict):
-    def __init__(self):
-        super(RaftJsonDict, self).__init__()
+    '''
+        Dictionary with case-insensitive lookup of string keys.
+
+        Keys keep the casing they were first inserted with. Exact-case
+        lookups go straight to the dictionary; other lookups use an index
+        of lowered keys which is built on first use and kept up to date
+        by every mutating method, so no lookup scans all of the keys.
+    '''
+    lowered_keys = None
+
+    def index(self):
+        if self.lowered_keys is None:
+            # built in reverse so that the first of several keys
+            # differing only in casing wins
+            self.lowered_keys = {k.lower(): k for k in reversed(dict.keys(self))
+                                 if isinstance(k, str)}
+        return self.lowered_keys
+
+    def stored_key(self, key):
+        if dict.__contains__(self, key) or not isinstance(key, str):
+            return key
+        if self.lowered_keys is None:
+            self.index()
+        return self.lowered_keys.get(key.lower(), key)
+
+    def unindex(self, key):
+        if self.lowered_keys is not None and isinstance(key, str):
+            lowered = key.lower()
+            if self.lowered_keys.get(lowered) == key:
+                del self.lowered_keys[lowered]
 
     def __getitem__(self, key):
-        for k in self.keys():
-            if k.lower() == key.lower():
-                break
-        return super(RaftJsonDict, self).__getitem__(key)
+        return dict.__getitem__(self, self.stored_key(key))
 
-    def get(self, key):
-        for k in self.keys():
-            if k.lower() == key.lower():
-                break
-        return super(RaftJsonDict, self).get(key)
+    def __setitem__(self, key, value):
+        key = self.stored_key(key)
+        if isinstance(key, str) and not dict.__contains__(self, key):
+            self.index()[key.lower()] = key
+        dict.__setitem__(self, key, value)
 
-    @staticmethod
-    def raft_json_object_hook(x):
+    def __delitem__(self, key):
+        key = self.stored_key(key)
+        dict.__delitem__(self, key)
+        self.unindex(key)
+
+    def __contains__(self, key):
+        return dict.__contains__(self, self.stored_key(key))
+
+    def get(self, key, default=None):
+        return dict.get(self, self.stored_key(key), default)
+
+    def pop(self, key, *default):
+        key = self.stored_key(key)
+        self.unindex(key)
+        return dict.pop(self, key, *default)
+
+    def popitem(self):
+        key, value = dict.popitem(self)
+        self.unindex(key)
+        return key, value
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def update(self, *args, **kwargs):
+        if args:
+            other = args[0]
+            if hasattr(other, 'keys'):
+                for k in other.keys():
+                    self[k] = other[k]
+            else:
+                for k, v in other:
+                    self[k] = v
+        for k in kwargs:
+            self[k] = kwargs[k]
+
+    def clear(self):
+        dict.clear(self)
+        self.lowered_keys = None
+
+    def copy(self):
+        return RaftJsonDict(self)
+
+    def __copy__(self):
+        return self.copy()
+
+    def __deepcopy__(self, memo):
         r = RaftJsonDict()
-        for k in x:
-            r[k] = x[k]
+        memo[id(self)] = r
+        for k in dict.keys(self):
+            dict.__setitem__(r, copy.deepcopy(k, memo),
+                             copy.deepcopy(dict.__getitem__(self, k), memo))
         return r
 
+    def __reduce__(self):
+        return (RaftJsonDict, (dict(self),))
+
+    @staticmethod
+    def raft_json_object_hook(x):
+        return RaftJsonDict(x)
+
 
 def get_token(client_id, tenant_id, secret, scopes, authority_uri, audience):
 
@@ -43,14 +129,61 @@ def get_token(client_id, tenant_id, secret, scopes, authority_uri, audience):
     app = msal.ConfidentialClientApplication(client_id, authority=authority, client_credential=secret)
     return app.acquire_token_for_client(scopes)
 
+# Cached tokens are refreshed once they are this close to expiration
+refresh_margin_seconds = 300
+
+def token_cache_path():
+    cache_directory = os.environ.get('RAFT_TOKEN_CACHE_DIRECTORY') or tempfile.gettempdir()
+    return os.path.join(cache_directory, 'raft-msal-token-cache.json')
+
+def cached_token(auth_params, get):
+    '''
+        Returns token for authentication parameters from the token cache
+        file shared by all invocations of this script. Calls get to
+        acquire a new token if there is no cached token, or if cached
+        token expires in less than refresh_margin_seconds.
+    '''
+    # do not store secrets in the cache file
+    key = hashlib.sha256(auth_params.encode()).hexdigest()
+    path = token_cache_path()
+    fd = os.open(path, os.O_CREAT | os.O_RDWR, 0o600)
+    with open(fd, 'r+') as cache_file:
+        fcntl.flock(cache_file, fcntl.LOCK_EX)
+        try:
+            try:
+                cache = json.loads(cache_file.read() or '{}')
+            except ValueError:
+                cache = {}
+
+            now = time.time()
+            # drop expired tokens
+            cache = {k: v for k, v in cache.items() if v['expiresOn'] > now}
+            entry = cache.get(key)
+            if entry and entry['expiresOn'] - refresh_margin_seconds > now:
+                return entry['token']
+
+            token = get()
+            if 'access_token' not in token:
+                raise Exception(f"Failed to acquire token: {token.get('error')} {token.get('error_description')}")
+            cache[key] = {
+                'token': f'{token["token_type"]} {token["access_token"]}',
+                'expiresOn': now + int(token.get('expires_in', 0))
+            }
+            cache_file.seek(0)
+            cache_file.truncate()
+            json.dump(cache, cache_file)
+            return cache[key]['token']
+        finally:
+            fcntl.flock(cache_file, fcntl.LOCK_UN)
+
 def token_from_env_variable(env_variable_name):
     auth_params = os.environ.get(env_variable_name)
     if auth_params:
         auth = json.loads(auth_params, object_hook=RaftJsonDict.raft_json_object_hook)
         #print("Getting MSAL token")
-        token = get_token(auth['client'], auth['tenant'], auth['secret'], auth.get('scopes'), auth.get('authorityUri'), auth.get('audience'))
-        #print("Token created")
-        return f'{token["token_type"]} {token["access_token"]}'
+        return cached_token(
+            auth_params,
+            lambda: get_token(auth['client'], auth['tenant'], auth['secret'], auth.get('scopes'), auth.get('authorityUri'), auth.get('audience')))
     else:
         raise Exception(f"Authentication parameters are not set in environment variable {env_variable_name}")
 
@@ -4,6 +4,7 @@ const http = require('http');
 const querystring = require('querystring');
 const fs = require('fs');
 const path = require('path'); 
+const crypto = require('crypto');
 const { exec } = require('child_process');
 
 const workDirectory = process.env.RAFT_WORK_DIRECTORY;
@@ -25,23 +26,57 @@ function jsonGet(jo, keys) {
 }
 
 const timer = ms => new Promise(res => setTimeout(res, ms));
-function waitForEndpoint(url, callback) {
-    http.get(url,
-        function(res) {
-            if (res.statusCode !== 200) {
-                timer(1000).then( _ => waitForEndpoint(url, callback));
-            } else {
-                callback(null, null);
-            }
-        }
-    ).on("error", function(err) {
-            console.log(`Failed to establish connection to ${url} due to ${err}. Trying again...`);
-            timer(1000).then( _ => waitForEndpoint(url, callback));
+
+// Waits until url responds with status code 200, retrying with exponential backoff and jitter.
+// Calls callback with an error once timeoutMs passed, otherwise with the number of milliseconds waited.
+function waitForEndpoint(url, callback, timeoutMs = 600000, initialDelayMs = 100, maxDelayMs = 5000) {
+    const agent = new http.Agent({ keepAlive: true, maxSockets: 1 });
+    const start = Date.now();
+    const deadline = start + timeoutMs;
+    let delayMs = initialDelayMs;
+    let attempts = 0;
+
+    function done(err, elapsedMs) {
+        agent.destroy();
+        callback(err, elapsedMs);
+    }
+
+    function retry(error) {
+        const remainingMs = deadline - Date.now();
+        if (remainingMs <= 0) {
+            done(new Error(`${url} is not ready after ${timeoutMs} ms and ${attempts} attempts. Last error: ${error}`), null);
+        } else {
+            const sleepMs = Math.min(Math.random() * delayMs, remainingMs);
+            delayMs = Math.min(delayMs * 2, maxDelayMs);
+            timer(sleepMs).then(_ => attempt());
         }
-    )
-}
+    }
 
+    function attempt() {
+        attempts++;
+        const request = http.get(url, { agent: agent, timeout: 5000 },
+            function(res) {
+                res.resume();
+                if (res.statusCode !== 200) {
+                    retry(`status code ${res.statusCode}`);
+                } else {
+                    const elapsedMs = Date.now() - start;
+                    console.log(`${url} is ready after ${elapsedMs} ms and ${attempts} attempts`);
+                    done(null, elapsedMs);
+                }
+            }
+        );
+        request.on("timeout", function() {
+            request.destroy(new Error("request timed out"));
+        });
+        request.on("error", function(err) {
+            console.log(`Failed to establish connection to ${url} due to ${err}. Trying again...`);
+            retry(err);
+        });
+    }
 
+    attempt();
+}
 
 class RaftUtils {
     constructor(toolName) {
@@ -100,9 +135,14 @@ class RaftUtils {
         );
     }
 
-    waitForAgentUtilities(callback) {
+    waitForAgentUtilities(callback, timeoutMs) {
         const readinessUrl = agentUtilitiesUrl + '/readiness/ready';
-        return waitForEndpoint(readinessUrl, callback);
+        return waitForEndpoint(readinessUrl, (err, elapsedMs) => {
+            if (!err) {
+                this.logTrace(`Agent utilities ready. Wait time: ${elapsedMs} ms`).catch(_ => {});
+            }
+            callback(err, elapsedMs);
+        }, timeoutMs);
     }
 
     postEvent (eventName, eventData) {
@@ -197,6 +237,17 @@ function getAuthHeader(callback) {
     }
 }
 
+const caCertificatesDirectory = '/usr/local/share/ca-certificates';
+// Hashes of the certificates installed by the previous run
+const certificatesMarker = caCertificatesDirectory + '/.raft-certificates.json';
+
+function fileHash(file) {
+    return crypto.createHash('sha256').update(fs.readFileSync(file)).digest('hex');
+}
+
+// Installs *.crt files from the target configuration certificates directory.
+// The trust store is not updated if the certificates did not change since the previous run,
+// and is updated incrementally if certificates were only added.
 function installCertificates(callback) {
     const certificates = jsonGet(config, ['targetConfiguration', 'certificates'])
 
@@ -208,21 +259,57 @@ function installCertificates(callback) {
                 callback(err, null);
             }
             else {
-                files.forEach(function(file) {
-                    console.log("File: " + file);
-                    if (path.extname(file) === '.crt') {
+                const hashes = {};
+                files.filter(file => path.extname(file) === '.crt').sort().forEach(function(file) {
+                    const f = certificates + "/" + file;
+                    if (fs.statSync(f).isFile()) {
+                        hashes[file] = fileHash(f);
+                    }
+                });
+
+                let installed = {};
+                const markerExists = fs.existsSync(certificatesMarker);
+                if (markerExists) {
+                    try {
+                        installed = JSON.parse(fs.readFileSync(certificatesMarker));
+                    } catch (e) {
+                        installed = {};
+                    }
+                }
+
+                if (JSON.stringify(installed) === JSON.stringify(hashes)) {
+                    console.log("Certificates did not change since the previous run");
+                    callback(null, null);
+                    return;
+                }
+
+                const removed = Object.keys(installed).filter(file => !(file in hashes));
+                const changed = Object.keys(hashes).filter(file => (file in installed) && installed[file] !== hashes[file]);
+                Object.keys(hashes).forEach(function(file) {
+                    if (installed[file] !== hashes[file]) {
                         const copySrc = certificates + "/" + file;
-                        const copyDest = "/usr/local/share/ca-certificates/" + file;
+                        const copyDest = caCertificatesDirectory + "/" + file;
                         console.log("CopySrc: " + copySrc + " CopyDest: " + copyDest);
                         fs.copyFileSync(copySrc, copyDest);
                     }
                 });
-                console.log("Updating certificates");
-                exec("update-ca-certificates --fresh", (error, _) => {
+                removed.forEach(function(file) {
+                    console.log("Removing file: " + file);
+                    try {
+                        fs.unlinkSync(caCertificatesDirectory + "/" + file);
+                    } catch (e) {
+                    }
+                });
+
+                const command = (removed.length > 0 || changed.length > 0) ?
+                    "update-ca-certificates --fresh" : "update-ca-certificates";
+                console.log("Updating certificates: " + command);
+                exec(command, (error, _) => {
                         if (error) {
                             console.log("Failed to update certificates: " + error);
                             callback(error, null);
                         } else {
+                            fs.writeFileSync(certificatesMarker, JSON.stringify(hashes));
                             callback(null, null);
                         }
                     }
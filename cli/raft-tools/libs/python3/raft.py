@@ -1,4 +1,5 @@
 import json
+import copy
 import os
 import subprocess
 import sys
@@ -7,81 +8,686 @@ import io
 import importlib
 import shutil
 import glob
+import atexit
+import functools
+import datetime
+import threading
+import base64
+import fcntl
+import hashlib
+import tempfile
+import random
 import requests
+from collections import deque
+from requests.adapters import HTTPAdapter
 
 from urllib.parse import urlparse
 from contextlib import redirect_stdout
 
 class RaftJsonDict(dict):
-    def __init__(self):
-        super(RaftJsonDict, self).__init__()
+    '''
+        Dictionary with case-insensitive lookup of string keys.
+
+        Keys keep the casing they were first inserted with. Exact-case
+        lookups go straight to the dictionary; other lookups use an index
+        of lowered keys which is built on first use and kept up to date
+        by every mutating method, so no lookup scans all of the keys.
+    '''
+    lowered_keys = None
+
+    def index(self):
+        if self.lowered_keys is None:
+            # built in reverse so that the first of several keys
+            # differing only in casing wins
+            self.lowered_keys = {k.lower(): k for k in reversed(dict.keys(self))
+                                 if isinstance(k, str)}
+        return self.lowered_keys
+
+    def stored_key(self, key):
+        if dict.__contains__(self, key) or not isinstance(key, str):
+            return key
+        if self.lowered_keys is None:
+            self.index()
+        return self.lowered_keys.get(key.lower(), key)
+
+    def unindex(self, key):
+        if self.lowered_keys is not None and isinstance(key, str):
+            lowered = key.lower()
+            if self.lowered_keys.get(lowered) == key:
+                del self.lowered_keys[lowered]
 
     def __getitem__(self, key):
-        for k in self.keys():
-            if k.lower() == key.lower():
-                key = k
-                break
-        return super(RaftJsonDict, self).__getitem__(key)
-
-    def pop(self, key):
-        for k in self.keys():
-            if k.lower() == key.lower():
-                key = k
-                break
-        return super(RaftJsonDict, self).pop(key)
-
-    def get(self, key):
-        for k in self.keys():
-            if k.lower() == key.lower():
-                key = k
-                break
-        return super(RaftJsonDict, self).get(key)
+        return dict.__getitem__(self, self.stored_key(key))
 
-    @staticmethod
-    def raft_json_object_hook(x):
+    def __setitem__(self, key, value):
+        key = self.stored_key(key)
+        if isinstance(key, str) and not dict.__contains__(self, key):
+            self.index()[key.lower()] = key
+        dict.__setitem__(self, key, value)
+
+    def __delitem__(self, key):
+        key = self.stored_key(key)
+        dict.__delitem__(self, key)
+        self.unindex(key)
+
+    def __contains__(self, key):
+        return dict.__contains__(self, self.stored_key(key))
+
+    def get(self, key, default=None):
+        return dict.get(self, self.stored_key(key), default)
+
+    def pop(self, key, *default):
+        key = self.stored_key(key)
+        self.unindex(key)
+        return dict.pop(self, key, *default)
+
+    def popitem(self):
+        key, value = dict.popitem(self)
+        self.unindex(key)
+        return key, value
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def update(self, *args, **kwargs):
+        if args:
+            other = args[0]
+            if hasattr(other, 'keys'):
+                for k in other.keys():
+                    self[k] = other[k]
+            else:
+                for k, v in other:
+                    self[k] = v
+        for k in kwargs:
+            self[k] = kwargs[k]
+
+    def clear(self):
+        dict.clear(self)
+        self.lowered_keys = None
+
+    def copy(self):
+        return RaftJsonDict(self)
+
+    def __copy__(self):
+        return self.copy()
+
+    def __deepcopy__(self, memo):
         r = RaftJsonDict()
-        for k in x:
-            r[k] = x[k]
+        memo[id(self)] = r
+        for k in dict.keys(self):
+            dict.__setitem__(r, copy.deepcopy(k, memo),
+                             copy.deepcopy(dict.__getitem__(self, k), memo))
         return r
 
-def install_certificates():
-    work_directory = os.environ['RAFT_WORK_DIRECTORY']
-    run_directory = os.environ['RAFT_TOOL_RUN_DIRECTORY']
-    with open(os.path.join(work_directory, "task-config.json"), 'r') as task_config:
-        config = json.load(task_config, object_hook=RaftJsonDict.raft_json_object_hook)
-        if config.get("targetConfiguration") and config.get("targetConfiguration").get("certificates"):
-            certificates = config["targetConfiguration"]["certificates"]
-            files = glob.iglob(os.path.join(certificates, "*.crt"))
-            for f in files:
-                if os.path.isfile(f):
-                    print(f"Copying file {f}")
-                    shutil.copy(f, "/usr/local/share/ca-certificates/")
-            subprocess.check_call(["update-ca-certificates", "--fresh"])
+    def __reduce__(self):
+        return (RaftJsonDict, (dict(self),))
 
+    @staticmethod
+    def raft_json_object_hook(x):
+        return RaftJsonDict(x)
 
-def auth_token():
-    auth_url = os.environ['RAFT_AGENT_UTILITIES_URL'] 
-    work_directory = os.environ['RAFT_WORK_DIRECTORY']
-    run_directory = os.environ['RAFT_TOOL_RUN_DIRECTORY']
-    with open(os.path.join(work_directory, "task-config.json"), 'r') as task_config:
-        config = json.load(task_config, object_hook=RaftJsonDict.raft_json_object_hook)
-        auth_config = config.get("authenticationMethod")
+class TaskConfigError(Exception):
+    pass
+
+
+def freeze(value):
+    if isinstance(value, list):
+        return tuple(freeze(v) for v in value)
+    return value
+
+
+def thaw(value):
+    if isinstance(value, tuple):
+        return [thaw(v) for v in value]
+    if isinstance(value, dict):
+        for k in dict.keys(value):
+            dict.__setitem__(value, k, thaw(dict.__getitem__(value, k)))
+    return value
+
+
+class TaskConfig(RaftJsonDict):
+    '''
+        Read-only task configuration. Objects nested in the configuration
+        are read-only as well and arrays are stored as tuples, so a single
+        parsed configuration can be shared by all of the helpers.
+        copy.deepcopy returns a modifiable RaftJsonDict with lists.
+    '''
+    def __init__(self, x=()):
+        dict.__init__(self, ((k, freeze(v)) for k, v in dict(x).items()))
+
+    def read_only(self, *args, **kwargs):
+        raise TypeError('Task configuration is read-only')
+
+    __setitem__ = read_only
+    __delitem__ = read_only
+    pop = read_only
+    popitem = read_only
+    setdefault = read_only
+    update = read_only
+    clear = read_only
+    __ior__ = read_only
+
+    def __deepcopy__(self, memo):
+        return thaw(RaftJsonDict.__deepcopy__(self, memo))
+
+    @property
+    def target_configuration(self):
+        return self.get('targetConfiguration')
+
+    @property
+    def endpoint(self):
+        if self.target_configuration:
+            return self.target_configuration.get('endpoint')
+        else:
+            return None
+
+    @property
+    def api_specifications(self):
+        if self.target_configuration:
+            return self.target_configuration.get('apiSpecifications') or ()
+        else:
+            return ()
+
+    @property
+    def certificates(self):
+        if self.target_configuration:
+            return self.target_configuration.get('certificates')
+        else:
+            return None
+
+    @property
+    def authentication_method(self):
+        '''
+            (authentication type, secret name) tuple or None
+        '''
+        auth_config = self.get('authenticationMethod')
         if auth_config:
-            auth_type, auth_key = auth_config.popitem()
-            response = requests.get(auth_url + '/auth' + '/' + auth_type + '/' + auth_key)
-            if response.ok:
-                content = json.loads(response.text)
-                return content['token']
-            else:
-                raise Exception(response.text)
+            return next(iter(auth_config.items()))
+        else:
+            return None
+
+    @property
+    def duration(self):
+        '''
+            Task duration as datetime.timedelta or None
+        '''
+        duration = self.get('duration')
+        if duration:
+            return parse_time_span(duration)
         else:
             return None
 
+    @property
+    def tool_configuration(self):
+        return self.get('toolConfiguration')
 
-def task_config():
-    work_directory = os.environ['RAFT_WORK_DIRECTORY']
+    @property
+    def output_folder(self):
+        return self.get('outputFolder')
+
+
+def parse_time_span(time_span):
+    '''
+        Parses .NET time span string ([d.]hh:mm:ss[.fffffff])
+    '''
+    days = 0
+    hours, minutes, seconds = time_span.split(':')
+    if '.' in hours:
+        days, hours = hours.split('.')
+    return datetime.timedelta(days=int(days), hours=int(hours),
+                              minutes=int(minutes), seconds=float(seconds))
+
+
+def validate(value, schema, components, path):
+    if '$ref' in schema:
+        schema = components[schema['$ref'].split('/')[-1]]
+
+    if value is None:
+        if schema.get('nullable', True):
+            return
+        raise TaskConfigError(f'{path} must not be null')
+
+    expected = schema.get('type')
+    types = {
+        'object': dict,
+        'array': (list, tuple),
+        'string': str,
+        'boolean': bool,
+        'integer': int,
+        'number': (int, float)
+    }
+    if expected in types and (not isinstance(value, types[expected]) or
+                              (expected in ['integer', 'number'] and isinstance(value, bool))):
+        raise TaskConfigError(f'{path} must be of type {expected}')
+
+    if 'enum' in schema and value not in schema['enum']:
+        raise TaskConfigError(f'{path} must be one of {schema["enum"]}')
+
+    if expected == 'array' and 'items' in schema:
+        for i, v in enumerate(value):
+            validate(v, schema['items'], components, f'{path}[{i}]')
+
+    if expected == 'object':
+        properties = RaftJsonDict(schema.get('properties') or {})
+        for k in value:
+            if k in properties:
+                validate(value[k], properties[k], components, f'{path}.{k}')
+            elif schema.get('additionalProperties') is False:
+                raise TaskConfigError(f'{path}.{k} is not a known property')
+            elif isinstance(schema.get('additionalProperties'), dict):
+                validate(value[k], schema['additionalProperties'], components, f'{path}.{k}')
+
+
+def validate_tool_configuration(config, schema_path):
+    '''
+        Validates tool configuration against the tool schema.json document.
+        The schema of the tool configuration is the component named after
+        the title of the document.
+    '''
+    with open(schema_path, 'r') as schema_file:
+        schema = json.load(schema_file)
+    components = schema.get('components', {}).get('schemas', {})
+    title = schema.get('info', {}).get('title')
+    if title in components and config.tool_configuration is not None:
+        validate(config.tool_configuration, components[title], components, 'toolConfiguration')
+
+
+@functools.lru_cache(maxsize=None)
+def load_task_config(work_directory, run_directory=None):
     with open(os.path.join(work_directory, 'task-config.json'), 'r') as task_config:
-        return json.load(task_config, object_hook=RaftJsonDict.raft_json_object_hook)
+        config = json.load(task_config, object_hook=TaskConfig)
+
+    if run_directory:
+        schema_path = os.path.join(run_directory, 'schema.json')
+        if os.path.exists(schema_path):
+            validate_tool_configuration(config, schema_path)
+    return config
+
+
+def task_config():
+    '''
+        Task configuration of the running task. The configuration is
+        parsed and validated against the tool schema.json on first use,
+        later calls return the same read-only object.
+    '''
+    return load_task_config(os.environ['RAFT_WORK_DIRECTORY'],
+                            os.environ.get('RAFT_TOOL_RUN_DIRECTORY'))
+
+
+ca_certificates_directory = '/usr/local/share/ca-certificates'
+# Hashes of the certificates installed by the previous run
+certificates_marker = os.path.join(ca_certificates_directory, '.raft-certificates.json')
+
+def file_hash(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def install_certificates():
+    '''
+        Installs *.crt files from the target configuration certificates
+        directory. The trust store is not updated if the certificates did
+        not change since the previous run, and is updated incrementally
+        if certificates were only added.
+    '''
+    certificates = task_config().certificates
+    if certificates:
+        files = sorted(f for f in glob.iglob(os.path.join(certificates, "*.crt")) if os.path.isfile(f))
+        hashes = {os.path.basename(f): file_hash(f) for f in files}
+
+        installed = {}
+        if os.path.exists(certificates_marker):
+            try:
+                with open(certificates_marker, 'r') as marker:
+                    installed = json.load(marker)
+            except ValueError:
+                installed = {}
+
+        if installed == hashes:
+            print("Certificates did not change since the previous run")
+            return
+
+        removed = [name for name in installed if name not in hashes]
+        changed = [name for name in hashes if name in installed and installed[name] != hashes[name]]
+        for f in files:
+            name = os.path.basename(f)
+            if installed.get(name) != hashes[name]:
+                print(f"Copying file {f}")
+                shutil.copy(f, ca_certificates_directory)
+        for name in removed:
+            print(f"Removing file {name}")
+            try:
+                os.remove(os.path.join(ca_certificates_directory, name))
+            except FileNotFoundError:
+                pass
+
+        # first run only adds certificates, a fresh rebuild is needed
+        # only to drop removed or replaced ones
+        if removed or changed:
+            subprocess.check_call(["update-ca-certificates", "--fresh"])
+        else:
+            subprocess.check_call(["update-ca-certificates"])
+
+        with open(certificates_marker, 'w') as marker:
+            json.dump(hashes, marker)
+
+
+def token_expiry(token):
+    '''
+        Expiration time of JWT token (seconds since epoch), or None if
+        token is not a JWT
+    '''
+    try:
+        payload = token.split(' ')[-1].split('.')[1]
+        payload += '=' * (-len(payload) % 4)
+        return float(json.loads(base64.urlsafe_b64decode(payload))['exp'])
+    except (IndexError, KeyError, TypeError, ValueError):
+        return None
+
+
+class TokenProvider():
+    '''
+        Caches authentication tokens fetched from agent utilities per
+        authentication method and secret name.
+
+        Tokens are refreshed by a background thread refresh_margin seconds
+        before they expire, or half way through their lifetime if they
+        are shorter lived. Expiration is read from the token if it is
+        a JWT, other tokens are refreshed every default_lifetime seconds.
+        Tokens are also kept in a cache file shared by all processes of
+        the task, so that subprocesses do not fetch tokens again.
+    '''
+    def __init__(self, auth_url, cache_path, refresh_margin=300, default_lifetime=600):
+        self.auth_url = auth_url
+        self.cache_path = cache_path
+        self.refresh_margin = refresh_margin
+        self.default_lifetime = default_lifetime
+        self.lock = threading.Lock()
+        # secret key -> (token, expires on, fetched on)
+        self.tokens = {}
+        self.refresh_threads = {}
+        self.fetches = 0
+        self.hits = 0
+
+    def margin(self, entry):
+        return min(self.refresh_margin, (entry[1] - entry[2]) / 2)
+
+    def is_fresh(self, entry):
+        return entry is not None and entry[1] - self.margin(entry) > time.time()
+
+    def fetch(self, auth_type, auth_key):
+        response = requests.get(self.auth_url + '/auth' + '/' + auth_type + '/' + auth_key)
+        if response.ok:
+            content = json.loads(response.text)
+            token = content['token']
+            self.fetches += 1
+            now = time.time()
+            return token, token_expiry(token) or now + self.default_lifetime, now
+        else:
+            raise Exception(response.text)
+
+    def load(self, auth_type, auth_key, force_refresh=False):
+        key = f'{auth_type}/{auth_key}'
+        with open(self.cache_path, 'a+') as cache_file:
+            # hold the lock while fetching, so that processes
+            # sharing the cache do not fetch the same token
+            fcntl.flock(cache_file, fcntl.LOCK_EX)
+            try:
+                cache_file.seek(0)
+                try:
+                    cache = json.loads(cache_file.read() or '{}')
+                except ValueError:
+                    cache = {}
+
+                entry = cache.get(key)
+                if entry:
+                    entry = (entry['token'], entry['expiresOn'],
+                             entry.get('fetchedOn', entry['expiresOn'] - 2 * self.refresh_margin))
+                if not force_refresh and self.is_fresh(entry):
+                    return entry
+
+                entry = self.fetch(auth_type, auth_key)
+                cache[key] = {'token': entry[0], 'expiresOn': entry[1], 'fetchedOn': entry[2]}
+                cache_file.seek(0)
+                cache_file.truncate()
+                json.dump(cache, cache_file)
+                return entry
+            finally:
+                fcntl.flock(cache_file, fcntl.LOCK_UN)
+
+    def token(self, auth_type, auth_key):
+        key = f'{auth_type}/{auth_key}'
+        with self.lock:
+            entry = self.tokens.get(key)
+            if self.is_fresh(entry):
+                self.hits += 1
+                return entry[0]
+
+            entry = self.load(auth_type, auth_key)
+            self.tokens[key] = entry
+            if key not in self.refresh_threads:
+                t = threading.Thread(target=self.refresh, args=(auth_type, auth_key), daemon=True)
+                self.refresh_threads[key] = t
+                t.start()
+            return entry[0]
+
+    def refresh(self, auth_type, auth_key):
+        key = f'{auth_type}/{auth_key}'
+        while True:
+            with self.lock:
+                entry = self.tokens[key]
+            time.sleep(max(entry[1] - self.margin(entry) - time.time(), 1))
+            try:
+                with self.lock:
+                    entry = self.tokens[key]
+                    if not self.is_fresh(entry):
+                        # another process might have refreshed it already
+                        self.tokens[key] = self.load(auth_type, auth_key)
+            except Exception as ex:
+                print(f'Failed to refresh {auth_type} token {auth_key}: {ex}')
+                time.sleep(30)
+
+
+@functools.lru_cache(maxsize=None)
+def token_provider(auth_url, job_id, work_directory):
+    # Token cache is not stored in the work directory, since work directory
+    # is the task output folder
+    cache_name = hashlib.sha256(f'{job_id}/{work_directory}'.encode()).hexdigest()
+    cache_path = os.path.join(tempfile.gettempdir(), f'raft-token-cache-{cache_name}.json')
+    if not os.path.exists(cache_path):
+        os.close(os.open(cache_path, os.O_CREAT | os.O_WRONLY, 0o600))
+    return TokenProvider(auth_url, cache_path)
+
+
+def auth_token():
+    auth_config = task_config().authentication_method
+    if auth_config:
+        auth_type, auth_key = auth_config
+        provider = token_provider(os.environ['RAFT_AGENT_UTILITIES_URL'],
+                                  os.environ.get('RAFT_JOB_ID'),
+                                  os.environ['RAFT_WORK_DIRECTORY'])
+        return provider.token(auth_type, auth_key)
+    else:
+        return None
+
+
+class MessageSender():
+    '''
+        Posts messages to agent utilities from a background thread over
+        a pooled keep-alive session, so that reporting does not block the
+        tool and does not open a connection per message.
+
+        Messages are sent in the order they were queued. A status update
+        replaces the previously queued status update if that one was not
+        sent yet, reports the same state and is the last queued message.
+        Once the queue is full, traces are dropped while bugs and status
+        updates wait for space in the queue.
+    '''
+    def __init__(self, base_url, max_queue_size=1000):
+        self.base_url = base_url
+        self.max_queue_size = max_queue_size
+        self.session = requests.Session()
+        self.session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=1))
+        self.session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=1))
+
+        self.condition = threading.Condition()
+        self.queue = deque()
+        # last status update that is still in the queue
+        self.queued_status = None
+        self.in_flight = 0
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.closed = False
+
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def send(self, path, message, block=True, status=None):
+        '''
+            Queues message for sending
+
+            Parameters:
+                path: agent utilities path to post the message to
+                message: JSON serializable message
+                block: wait for space in the queue if it is full,
+                       otherwise the message is dropped
+                status: state reported by a status update, used to
+                        coalesce consecutive updates
+
+            Returns:
+                False if the message was dropped
+        '''
+        # serialize now, since callers keep mutating the details they report
+        data = json.dumps(message)
+        with self.condition:
+            if self.closed:
+                self.dropped += 1
+                return False
+
+            # replacing a status queued before other messages
+            # would send it ahead of them
+            if (status and self.queued_status and self.queued_status[2] == status and
+                    self.queue and self.queue[-1] is self.queued_status):
+                self.queued_status[1] = data
+                self.coalesced += 1
+                return True
+
+            while len(self.queue) >= self.max_queue_size:
+                if not block:
+                    self.dropped += 1
+                    return False
+                self.condition.wait()
+
+            item = [path, data, status]
+            self.queue.append(item)
+            if status:
+                self.queued_status = item
+            self.condition.notify_all()
+            return True
+
+    def send_batch(self, path, messages):
+        '''
+            Queues a batch of messages for sending, waiting for space
+            in the queue if it is full. The sending thread is woken up
+            once per batch instead of once per message.
+
+            Parameters:
+                path: agent utilities path to post the messages to
+                messages: list of JSON serializable messages
+        '''
+        data = [json.dumps(m) for m in messages]
+        with self.condition:
+            for d in data:
+                if self.closed:
+                    self.dropped += 1
+                    continue
+                while len(self.queue) >= self.max_queue_size:
+                    self.condition.notify_all()
+                    self.condition.wait()
+                self.queue.append([path, d, None])
+            self.condition.notify_all()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while len(self.queue) == 0 and not self.closed:
+                    self.condition.wait()
+                if len(self.queue) == 0:
+                    return
+                item = self.queue.popleft()
+                if item is self.queued_status:
+                    self.queued_status = None
+                path, data, _ = item
+                self.in_flight += 1
+                self.condition.notify_all()
+
+            try:
+                r = self.session.post(f'{self.base_url}{path}', data=data,
+                                      headers={'Content-Type': 'application/json'})
+                ok = r.ok
+                if not ok:
+                    print(f'Posting to {path} failed with {r.status_code}: {r.text}')
+            except Exception as ex:
+                ok = False
+                print(f'Posting to {path} failed: {ex}')
+
+            with self.condition:
+                self.in_flight -= 1
+                if ok:
+                    self.sent += 1
+                else:
+                    self.failed += 1
+                self.condition.notify_all()
+
+    def wait_until_sent(self, timeout=None):
+        '''
+            Waits until every queued message is sent
+
+            Parameters:
+                timeout: maximum number of seconds to wait, or None
+
+            Returns:
+                True if the queue was drained
+        '''
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.condition:
+            while len(self.queue) > 0 or self.in_flight > 0:
+                if self.closed and not self.thread.is_alive():
+                    return False
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+            return True
+
+    def close(self, timeout=None):
+        '''
+            Sends queued messages and stops the background thread
+        '''
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.thread.join(timeout)
+        self.session.close()
+
+    def stats(self):
+        with self.condition:
+            return {
+                'queue_depth': len(self.queue),
+                'in_flight': self.in_flight,
+                'sent': self.sent,
+                'failed': self.failed,
+                'dropped': self.dropped,
+                'coalesced': self.coalesced
+            }
+
 
 class RaftUtils():
     def __init__(self, tool_name):
@@ -96,18 +702,49 @@ class RaftUtils():
             "taskIndex" : os.environ['RAFT_TASK_INDEX'],
             "containerName" : self.container_name
         }
+        self.sender = MessageSender(self.report_status_url)
 
-    def wait_for_agent_utilities(self):
-        try:
-            r = requests.get(f'{self.report_status_url}/readiness/ready')
-            if r.ok:
-                return
-            else:
-                time.sleep(1)
-                self.wait_for_agent_utilities()
-        except:
-            time.sleep(10)
-            return self.wait_for_agent_utilities()
+    def wait_for_agent_utilities(self, timeout=600, initial_delay=0.1, max_delay=5):
+        '''
+            Waits until agent utilities are ready, retrying with exponential
+            backoff and jitter. Time it took is logged as a trace.
+
+            Parameters:
+                timeout: maximum number of seconds to wait
+                initial_delay: delay in seconds after the first failed attempt
+                max_delay: maximum delay in seconds between attempts
+
+            Returns:
+                Number of seconds it took for agent utilities to become ready
+        '''
+        url = f'{self.report_status_url}/readiness/ready'
+        start = time.monotonic()
+        deadline = start + timeout
+        delay = initial_delay
+        attempts = 0
+        with requests.Session() as session:
+            while True:
+                attempts += 1
+                remaining = deadline - time.monotonic()
+                try:
+                    r = session.get(url, timeout=max(min(remaining, 5), 0.1))
+                    if r.ok:
+                        break
+                    error = f'status code {r.status_code}'
+                except requests.exceptions.RequestException as ex:
+                    error = f'{ex}'
+
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise Exception(f'Agent utilities are not ready after {timeout} seconds '
+                                    f'and {attempts} attempts. Last error: {error}')
+                time.sleep(min(random.uniform(0, delay), remaining))
+                delay = min(delay * 2, max_delay)
+
+        elapsed = time.monotonic() - start
+        print(f'Agent utilities are ready after {elapsed:.2f} seconds and {attempts} attempts')
+        self.log_trace(f'Agent utilities ready. Wait time: {elapsed:.2f} seconds. Attempts: {attempts}')
+        return elapsed
 
     def report_bug(self, bugDetails):
         m = {
@@ -116,9 +753,20 @@ class RaftUtils():
             'agentName' : self.container_name,
             'bugDetails' : bugDetails
         }
-        requests.post(f'{self.report_status_url}/messaging/event/bugFound', json=m)
+        self.sender.send('/messaging/event/bugFound', m)
 
-    def report_status(self, state, details):
+    def report_bugs(self, bugs_details):
+        m = []
+        for bugDetails in bugs_details:
+            m.append({
+                'tool' : self.tool_name,
+                'jobId' : self.job_id,
+                'agentName' : self.container_name,
+                'bugDetails' : bugDetails
+            })
+        self.sender.send_batch('/messaging/event/bugFound', m)
+
+    def report_status(self, state, details, metrics=None):
         m = {
             'tool' : self.tool_name,
             'jobId' : self.job_id,
@@ -127,19 +775,21 @@ class RaftUtils():
             'utcEventTime' : time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime()),
             'state' : state
         }
-        requests.post(f'{self.report_status_url}/messaging/event/jobStatus', json=m)
+        if metrics:
+            m['metrics'] = metrics
+        self.sender.send('/messaging/event/jobStatus', m, status=state)
 
-    def report_status_created(self, details=None):
-        self.report_status('Created', details)
+    def report_status_created(self, details=None, metrics=None):
+        self.report_status('Created', details, metrics)
 
-    def report_status_running(self, details=None):
-        self.report_status('Running', details)
+    def report_status_running(self, details=None, metrics=None):
+        self.report_status('Running', details, metrics)
 
-    def report_status_error(self, details=None):
-        self.report_status('Error', details)
+    def report_status_error(self, details=None, metrics=None):
+        self.report_status('Error', details, metrics)
 
-    def report_status_completed(self, details=None):
-        self.report_status('Completed', details)
+    def report_status_completed(self, details=None, metrics=None):
+        self.report_status('Completed', details, metrics)
 
     def log_trace(self, trace):
         t = {
@@ -147,7 +797,7 @@ class RaftUtils():
             'severity' : 'Information',
             'tags' : self.telemetry_properties
         }
-        requests.post(f'{self.report_status_url}/messaging/trace', json=t)
+        self.sender.send('/messaging/trace', t, block=False)
 
     def log_exception(self, ex):
         t = {
@@ -155,7 +805,23 @@ class RaftUtils():
             'severity' : 'Error',
             'tags' : self.telemetry_properties
         }
-        requests.post(f'{self.report_status_url}/messaging/trace', json=t)
+        self.sender.send('/messaging/trace', t, block=False)
+
+    def flush(self, timeout=None):
+        '''
+            Waits until all queued messages are sent to agent utilities,
+            then asks agent utilities to flush telemetry.
+
+            Parameters:
+                timeout: maximum number of seconds to wait for the queue
+                         to drain, or None to wait until it is drained
+        '''
+        self.sender.send('/messaging/flush', None)
+        self.sender.wait_until_sent(timeout)
 
-    def flush(self):
-        requests.post(f'{self.report_status_url}/messaging/flush')
+    def sender_stats(self):
+        '''
+            Returns counters of the message sender: queue depth,
+            messages sent, failed, dropped and coalesced
+        '''
+        return self.sender.stats()
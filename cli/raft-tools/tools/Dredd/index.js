@@ -8,7 +8,11 @@ console.log(raft);
 
 const raftUtils = new raft.RaftUtils("Dredd");
 
-raftUtils.waitForAgentUtilities(_ => {
+raftUtils.waitForAgentUtilities((error, _) => {
+    if (error) {
+        console.error(error);
+        process.exit(1);
+    }
     console.log("Agent utilities are ready. Proceeding with the job run...");
 
     raftUtils.reportStatusCreated();
@@ -0,0 +1,196 @@
+import json
+import re
+import yaml
+from urllib.parse import urlparse
+
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
+# Every interaction in a cassette starts on a line like this one
+interaction_start = re.compile(r"^- id: '(\d+)'$")
+key_value = re.compile(r'^(\s*-?\s*[\w-]+):')
+
+# Lines longer than this, mostly request and response bodies, are not kept in memory
+max_line_length = 64 * 1024
+# Maximum number of interaction IDs listed in a bug report
+max_bug_interactions = 10
+
+def iter_lines(f, limit=max_line_length):
+    '''
+        Reads lines of a cassette, reading at most limit characters of
+        a line into memory. The value of a longer line is replaced with
+        an empty value, so the line is still valid YAML.
+    '''
+    while True:
+        line = f.readline(limit)
+        if not line:
+            return
+        if line.endswith('\n') or len(line) < limit:
+            yield line
+        else:
+            # skip the rest of the line
+            rest = line
+            while rest and not rest.endswith('\n'):
+                rest = f.readline(limit)
+            m = key_value.match(line)
+            if m:
+                yield f"{m.group(1)}: ''\n"
+
+def iter_interaction_texts(path):
+    '''
+        Reads YAML text of cassette interactions one at a time
+    '''
+    with open(path, 'r') as f:
+        lines = None
+        for line in iter_lines(f):
+            if interaction_start.match(line.rstrip('\n')):
+                if lines:
+                    yield ''.join(lines)
+                lines = [line]
+            elif lines is not None:
+                lines.append(line)
+        if lines:
+            yield ''.join(lines)
+
+def iter_interactions(path):
+    '''
+        Reads interactions recorded in a Schemathesis cassette one at
+        a time, without loading the whole cassette into memory
+    '''
+    for text in iter_interaction_texts(path):
+        interaction = yaml.load(text, Loader=SafeLoader)
+        if interaction:
+            yield interaction[0]
+
+def merge_cassettes(paths, merged_path):
+    '''
+        Merges cassettes into one, renumbering interactions.
+        The header of the merged cassette is copied from the first cassette.
+    '''
+    current_id = 0
+    with open(merged_path, 'w') as merged:
+        header_written = False
+        for path in paths:
+            with open(path, 'r') as f:
+                in_header = True
+                line_start = True
+                while True:
+                    # copy long lines in parts
+                    line = f.readline(max_line_length)
+                    if not line:
+                        break
+                    at_line_start = line_start
+                    line_start = line.endswith('\n')
+
+                    if in_header:
+                        if not header_written:
+                            merged.write(line)
+                        if at_line_start and line.startswith('http_interactions:'):
+                            in_header = False
+                            header_written = True
+                            if not line_start:
+                                merged.write('\n')
+                                line_start = True
+                        continue
+
+                    if at_line_start and interaction_start.match(line.rstrip('\n')):
+                        line = f"- id: '{current_id}'" + ('\n' if line_start else '')
+                        current_id += 1
+                    merged.write(line)
+                if not line_start:
+                    merged.write('\n')
+
+class OperationMatcher():
+    '''
+        Finds the path template of the API specification that an URI
+        recorded in a cassette was generated from
+    '''
+    def __init__(self, paths):
+        self.templates = []
+        for p in paths or []:
+            parameters = p.count('{')
+            pattern = re.sub(r'\\\{[^/]*?\\\}', '[^/]+', re.escape(p.rstrip('/')))
+            self.templates.append((parameters, p, re.compile(f'{pattern}/?$')))
+        # prefer the template with the fewest parameters
+        self.templates.sort(key=lambda t: t[0])
+
+    def match(self, uri):
+        path = urlparse(uri).path
+        for _, p, pattern in self.templates:
+            if pattern.search(path):
+                return p
+        return path
+
+class CassetteSummary():
+    '''
+        Groups failed checks of cassette interactions by operation,
+        response status code and check, and counts response codes
+    '''
+    def __init__(self, matcher=None):
+        self.matcher = matcher or OperationMatcher([])
+        self.total_request_count = 0
+        self.response_code_counts = {}
+        self.failed_check_count = 0
+        # (method, operation, status code, check) -> bug details
+        self.groups = {}
+
+    def add(self, interaction, cassette=None):
+        request = interaction.get('request') or {}
+        response = interaction.get('response') or {}
+        status_code = (response.get('status') or {}).get('code')
+
+        self.total_request_count += 1
+        if status_code is not None:
+            self.response_code_counts[status_code] = self.response_code_counts.get(status_code, 0) + 1
+
+        operation = None
+        for check in interaction.get('checks') or []:
+            if check.get('status') != 'FAILURE':
+                continue
+            self.failed_check_count += 1
+            if operation is None:
+                operation = self.matcher.match(request.get('uri') or '')
+
+            key = (request.get('method'), operation, status_code, check.get('name'))
+            bug = self.groups.get(key)
+            if bug is None:
+                bug = {
+                    'check': check.get('name'),
+                    'method': request.get('method'),
+                    'operation': operation,
+                    'statusCode': status_code,
+                    'message': check.get('message'),
+                    'uri': request.get('uri'),
+                    'cassette': cassette,
+                    'count': 0,
+                    'interactionIds': []
+                }
+                self.groups[key] = bug
+            bug['count'] += 1
+            if len(bug['interactionIds']) < max_bug_interactions:
+                bug['interactionIds'].append(interaction.get('id'))
+
+    def add_cassette(self, path, cassette=None):
+        for interaction in iter_interactions(path):
+            self.add(interaction, cassette)
+
+    def bugs(self):
+        '''
+            Bug details of every group of failed checks,
+            as a map of strings without missing values
+        '''
+        bugs = []
+        for bug in self.groups.values():
+            details = {k: f'{v}' for k, v in bug.items() if v is not None}
+            details['interactionIds'] = json.dumps(bug['interactionIds'])
+            bugs.append(details)
+        return bugs
+
+    def metrics(self):
+        return {
+            'totalRequestCount': self.total_request_count,
+            'responseCodeCounts': {int(k): v for k, v in self.response_code_counts.items()},
+            'totalBugBucketsCount': len(self.groups)
+        }
@@ -1,13 +1,105 @@
 import json
 import os
+import re
 import subprocess
 import sys
+import requests
+import yaml
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import urlparse
 
 run_directory = os.environ['RAFT_TOOL_RUN_DIRECTORY']
 raft_libs_dir = os.path.join(run_directory, '..', '..', 'libs', 'python3')
 sys.path.append(raft_libs_dir)
 import raft
+import cassette
+
+http_methods = ['get', 'put', 'post', 'delete', 'options', 'head', 'patch', 'trace']
+# schemathesis exits with this code when checks failed
+failed_checks_exit_code = 1
+
+def load_specification(t):
+    if urlparse(t).scheme in ['http', 'https']:
+        r = requests.get(t)
+        r.raise_for_status()
+        text = r.text
+    else:
+        with open(t, 'r') as f:
+            text = f.read()
+    return yaml.safe_load(text)
+
+def operations(t):
+    '''
+        Returns:
+            Dictionary of path to number of operations on the path
+            in the API specification, or None if it fails to load
+    '''
+    try:
+        spec = load_specification(t)
+    except Exception as ex:
+        print(f'Failed to load {t}: {ex}')
+        return None
+
+    paths = {}
+    for path, item in (spec.get('paths') or {}).items():
+        n = len([m for m in item if m.lower() in http_methods])
+        if n > 0:
+            paths[path] = n
+    return paths
+
+def operation_groups(paths):
+    '''
+        Paths of the API specification grouped by their first segment,
+        so that operations on the same resource, which are most likely
+        connected by links, are tested by the same shard.
+
+        Returns:
+            List of (number of operations, list of paths)
+    '''
+    groups = {}
+    for path, n in paths.items():
+        resource = path.strip('/').split('/')[0]
+        count, group_paths = groups.get(resource, (0, []))
+        groups[resource] = (count + n, group_paths + [path])
+    return list(groups.values())
+
+def shards(paths, n_shards):
+    '''
+        Splits paths of the API specification into at most n_shards
+        shards with a similar number of operations
+
+        Returns:
+            List of path lists, or [None] if the specification is not split
+    '''
+    if n_shards <= 1 or not paths:
+        return [None]
+
+    groups = operation_groups(paths)
+    if len(groups) <= 1:
+        return [None]
+
+    n_shards = min(n_shards, len(groups))
+    bins = [(0, []) for _ in range(n_shards)]
+    # largest groups first, each into the least loaded shard
+    for count, paths in sorted(groups, key=lambda g: g[0], reverse=True):
+        i = min(range(n_shards), key=lambda b: bins[b][0])
+        bins[i] = (bins[i][0] + count, bins[i][1] + paths)
+    return [paths for _, paths in bins]
+
+def schemathesis_args(t, token, endpoint, cassette_path, paths=None):
+    args = ["schemathesis", "run", "--stateful", "links", "--checks", "all"]
+    if token:
+        args.extend(["-H", f"Authorization: {token}"])
+
+    if endpoint:
+        args.extend(['--base-url', endpoint])
+
+    if paths:
+        for p in paths:
+            args.extend(['--endpoint', f'^{re.escape(p)}$'])
+
+    args.extend(["--store-network-log", cassette_path, t])
+    return args
 
 if __name__ == "__main__":
     #sys.path.append('/tmp/usr/local/lib/python3.9/site-packages')
@@ -20,30 +112,86 @@ if __name__ == "__main__":
 
     work_directory = os.environ['RAFT_WORK_DIRECTORY']
 
-    i = 0
-    test_target_config = config['targetConfiguration']
-    endpoint = test_target_config.get('endpoint')
+    endpoint = config.endpoint
+    targets = config.api_specifications
 
-    n_targets = len(test_target_config.get("apiSpecifications"))
-    for t in test_target_config.get("apiSpecifications"):
-        print(f'Starting schemathesis for target {t}')
-        args = ["schemathesis", "run", "--stateful", "links", "--checks", "all"]
-        if token:
-            args.extend(["-H", f"Authorization: {token}"])
-
-        if endpoint:
-            args.extend(['--base-url', endpoint])
+    workers = 1
+    if config.tool_configuration and config.tool_configuration.get('workers'):
+        workers = int(config.tool_configuration['workers'])
 
-        cassette = f'cassette-{i}.yaml'
+    # every API specification is split into shards, every shard is tested by its own process
+    runs = []
+    target_paths = [operations(t) for t in targets]
+    for i, t in enumerate(targets):
+        target_shards = shards(target_paths[i], workers)
+        for j, paths in enumerate(target_shards):
+            if len(target_shards) == 1:
+                cassette_path = f'{work_directory}/cassette-{i}.yaml'
+            else:
+                cassette_path = f'{work_directory}/cassette-{i}-{j}.yaml'
+            runs.append((i, t, paths, cassette_path))
 
-        args.extend(["--store-network-log", f'{work_directory}/{cassette}', t])
+    def run(r):
+        i, t, paths, cassette_path = r
+        print(f'Starting schemathesis for target {t}')
+        args = schemathesis_args(t, token, endpoint, cassette_path, paths)
         print(f'Running with args: {args}')
-        raft.report_status_running({"endpoint" : endpoint})
+        raft.report_status_running({"endpoint" : endpoint, "target" : t})
         result = subprocess.run(args)
-        if (result.returncode == 1):
-            raft.report_bug({"cassette": f'config.outputFolder/cassette'})
-        print(f'Finished run on API specification: {t}')
-        i = i + 1 
+        print(f'Finished run on API specification: {t} shard: {cassette_path}')
+        return result.returncode
+
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as pool:
+        return_codes = list(pool.map(run, runs))
+
+    # a run with failed checks still recorded its cassette,
+    # any other failure means the shard was not tested
+    failed_runs = []
+    for r, code in zip(runs, return_codes):
+        i, t, paths, cassette_path = r
+        if code == 0 or (code == failed_checks_exit_code and os.path.exists(cassette_path)):
+            continue
+        print(f'Schemathesis failed on API specification: {t} shard: {cassette_path}'
+              f' with exit code: {code}')
+        failed_runs.append(f'{os.path.basename(cassette_path)}: exit code {code}')
+
+    total_request_count = 0
+    response_code_counts = {}
+    total_bug_count = 0
+    for i, t in enumerate(targets):
+        target_runs = [r for r in runs if r[0] == i]
+        cassette_path = f'{work_directory}/cassette-{i}.yaml'
+        shard_cassettes = [r[3] for r in target_runs if os.path.exists(r[3])]
+        if len(target_runs) > 1:
+            cassette.merge_cassettes(shard_cassettes, cassette_path)
+            for c in shard_cassettes:
+                os.remove(c)
+
+        if os.path.exists(cassette_path):
+            # failed checks are reported once per operation, response status code and check
+            summary = cassette.CassetteSummary(cassette.OperationMatcher(target_paths[i]))
+            summary.add_cassette(cassette_path, os.path.basename(cassette_path))
+            bugs = summary.bugs()
+            raft.report_bugs(bugs)
+            total_bug_count += len(bugs)
+
+            metrics = summary.metrics()
+            total_request_count += metrics['totalRequestCount']
+            for code, count in metrics['responseCodeCounts'].items():
+                response_code_counts[code] = response_code_counts.get(code, 0) + count
+            print(f'{t}: {metrics["totalRequestCount"]} requests, '
+                  f'{summary.failed_check_count} failed checks, {len(bugs)} bugs')
 
-    raft.report_status_completed()
-    raft.flush()
\ No newline at end of file
+    metrics = {
+        "totalRequestCount" : total_request_count,
+        "responseCodeCounts" : response_code_counts,
+        "totalBugBucketsCount" : total_bug_count
+    }
+    if failed_runs:
+        raft.report_status_error({
+            "totalBugCount" : f"{total_bug_count}",
+            "failedRuns" : "; ".join(failed_runs)
+        }, metrics)
+    else:
+        raft.report_status_completed({"totalBugCount" : total_bug_count}, metrics)
+    raft.flush()
@@ -1,7 +1,9 @@
 import json
 import os
+import socket
 import subprocess
 import sys
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import urlparse
 
 run_directory = os.environ['RAFT_TOOL_RUN_DIRECTORY']
@@ -9,6 +11,45 @@ raft_libs_dir = os.path.join(run_directory, '..', '..', 'libs', 'python3')
 sys.path.append(raft_libs_dir)
 import raft
 
+def free_ports(n):
+    # keep all of the sockets bound until every port is picked,
+    # so that the ports are distinct
+    sockets = []
+    try:
+        for _ in range(n):
+            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            s.bind(('', 0))
+            sockets.append(s)
+        return [s.getsockname()[1] for s in sockets]
+    finally:
+        for s in sockets:
+            s.close()
+
+def scan_args(i, n_targets, t, token, endpoint, port=None, home=None):
+    args = [sys.executable, "scan.py", f"{i}", f"{n_targets}", '--target', t]
+    if token:
+        args.extend(['--token', token])
+
+    if endpoint:
+        url = urlparse(endpoint)
+        args.extend(['--host', url.netloc])
+
+    if port:
+        args.extend(['--port', f'{port}'])
+
+    if home:
+        args.extend(['--home', home])
+    return args
+
+def completed_details(n_targets):
+    details = {"numberOfTargets" : n_targets, "totalBugCount" : 0}
+    for i in range(n_targets):
+        status_path = f'/zap/wrk/{i}-status.json'
+        if os.path.exists(status_path):
+            with open(status_path) as f:
+                details["totalBugCount"] += json.load(f).get("totalBugCount", 0)
+    return details
+
 if __name__ == "__main__":
     config = raft.task_config()
 
@@ -18,20 +59,38 @@ if __name__ == "__main__":
     token = raft.auth_token()
     work_directory = os.environ['RAFT_WORK_DIRECTORY']
 
-    i = 0
-    test_target_config = config['targetConfiguration']
-    endpoint = test_target_config.get('endpoint')
+    endpoint = config.endpoint
+    targets = config.api_specifications
+    n_targets = len(targets)
+
+    max_parallel_scans = 1
+    if config.tool_configuration and config.tool_configuration.get('maxParallelScans'):
+        max_parallel_scans = int(config.tool_configuration['maxParallelScans'])
+
+    if max_parallel_scans <= 1 or n_targets <= 1:
+        i = 0
+        for t in targets:
+            print(f'Starting zap for target {t}')
+            subprocess.check_call(scan_args(i, n_targets, t, token, endpoint))
+            i = i + 1
+    else:
+        # Every scan runs its own ZAP daemon, on its own port and with its own home directory
+        ports = free_ports(n_targets)
+
+        def scan(i):
+            t = targets[i]
+            print(f'Starting zap for target {t}')
+            args = scan_args(i, n_targets, t, token, endpoint, ports[i], f'/zap/scan-{i}')
+            r = subprocess.call(args)
+            print(f'Zap for target {t} exited with exit code: {r}')
+            return r
 
-    n_targets = len(test_target_config.get("apiSpecifications"))
-    for t in test_target_config.get("apiSpecifications"):
-        print(f'Starting zap for target {t}')
-        args = [sys.executable, "scan.py", f"{i}", f"{n_targets}", '--target', t]
-        if token:
-            args.extend(['--token', token])
+        with ThreadPoolExecutor(max_workers=max_parallel_scans) as pool:
+            results = list(pool.map(scan, range(n_targets)))
 
-        if endpoint:
-            url = urlparse(endpoint)
-            args.extend(['--host', url.netloc])
+        failed = [targets[i] for i in range(n_targets) if results[i] != 0]
+        if failed:
+            raise Exception(f'ZAP scan failed for targets: {failed}')
 
-        subprocess.check_call(args)
-        i = i + 1
+    raft_utils.report_status_completed(completed_details(n_targets))
+    raft_utils.flush()
@@ -4,6 +4,8 @@ import logging
 from logging import StreamHandler
 import shutil
 import json
+import re
+import time
 
 run_directory = os.environ['RAFT_TOOL_RUN_DIRECTORY']
 raft_libs_dir = os.path.join(run_directory, '..', '..', 'libs', 'python3')
@@ -16,66 +18,146 @@ sys.path.append(zap_dir)
 raftUtils = raft.RaftUtils('ZAP')
 
 class StatusReporter(StreamHandler):
-    def __init__(self, details):
+    '''
+        Reports ZAP scan progress found in ZAP log records.
+
+        Progress is reported when it moved by at least step percent since
+        the last report, or when it changed and interval seconds passed
+        since the last report. Records that do not mention progress are
+        skipped without formatting them. Reports are queued on the RAFT
+        message sender, so the logging thread does not wait for them.
+    '''
+    active_scan_progress = re.compile(r'Active Scan progress %:\s*(\d+)')
+
+    def __init__(self, details, step=5, interval=30):
         StreamHandler.__init__(self)
-        self.last_txt = None
         self.details = details
+        self.step = step
+        self.interval = interval
+        self.progress = None
+        self.reported_progress = None
+        self.reported_time = 0
 
     def emit(self, record):
-        txt = self.format(record)
-        if txt != self.last_txt:
-            self.last_txt = txt
-            progress='Active Scan progress %:'
-            i = txt.find(progress)
-            if i != -1:
-                self.details["Scan progress"] = txt[i :]
-                raftUtils.report_status_running(self.details)
-            else:
-                progress='Passive scanning complete'
-                i = txt.find(progress)
-                if i != -1:
-                    self.details["Scan progress"] = "Active and Passive Scan progress %100"
-                    raftUtils.report_status_running(self.details)
+        msg = record.msg if isinstance(record.msg, str) else f'{record.msg}'
+        if 'progress' in msg:
+            m = self.active_scan_progress.search(record.getMessage())
+            if m:
+                self.update(int(m.group(1)))
+        elif 'Passive scanning complete' in msg:
+            self.details["Scan progress"] = "Active and Passive Scan progress %100"
+            raftUtils.report_status_running(self.details)
+
+    def update(self, progress):
+        if progress == self.progress:
+            return
+        self.progress = progress
+
+        now = time.monotonic()
+        if (self.reported_progress is None or
+                progress - self.reported_progress >= self.step or
+                progress == 100 or
+                now - self.reported_time >= self.interval):
+            self.reported_progress = progress
+            self.reported_time = now
+            self.details["Scan progress"] = f'Active Scan progress %: {progress}'
+            raftUtils.report_status_running(self.details)
 
 zap = __import__("zap-api-scan")
 
+# Maximum number of instances reported with every alert
+max_alert_instances = 20
+# Number of bugs queued for reporting at a time
+bugs_batch_size = 50
+
+alerts_start = re.compile(r'"alerts"\s*:\s*\[')
+alerts_separator = re.compile(r'\s*,?\s*')
+
+def iter_alerts(path, chunk_size=1024 * 1024):
+    '''
+        Reads alerts of all sites from ZAP JSON report one at a time,
+        without loading the whole report into memory
+    '''
+    decoder = json.JSONDecoder()
+    with open(path) as f:
+        buf = ''
+        pos = 0
+        in_alerts = False
+        eof = False
+        while True:
+            if not in_alerts:
+                m = alerts_start.search(buf, pos)
+                if m:
+                    pos = m.end()
+                    in_alerts = True
+                    continue
+                # keep the tail in case "alerts" is split between chunks
+                pos = max(pos, len(buf) - 64)
+            else:
+                m = alerts_separator.match(buf, pos)
+                i = m.end()
+                if i < len(buf):
+                    if buf[i] == ']':
+                        pos = i + 1
+                        in_alerts = False
+                        continue
+                    try:
+                        alert, end = decoder.raw_decode(buf, i)
+                        pos = end
+                        yield alert
+                        continue
+                    except ValueError:
+                        if eof:
+                            raise
+                elif eof:
+                    raise ValueError(f'Unexpected end of {path}')
+
+            if eof:
+                return
+            chunk = f.read(chunk_size)
+            eof = len(chunk) == 0
+            buf = buf[pos:] + chunk
+            pos = 0
+
+def alert_bug_details(alert):
+    # Every alert is a bug. Instances are reported as a JSON list,
+    # up to max_alert_instances of them.
+    bugDetails = {}
+    for item in alert:
+        if item != 'instances':
+            bugDetails[item] = alert[item]
+    instances = alert.get('instances') or []
+    bugDetails['instanceCount'] = f'{len(instances)}'
+    bugDetails['instances'] = json.dumps(instances[:max_alert_instances])
+    return bugDetails
+
 def post_bugs(target_index):
-    if os.path.exists(f'/zap/wrk/{target_index}-report.json'):
+    '''
+        Reports every alert in the ZAP report as a bug
+
+        Returns:
+            Number of bugs found
+    '''
+    report_path = f'/zap/wrk/{target_index}-report.json'
+    bugCount = 0
+    if os.path.exists(report_path):
         print(f'Using file {target_index}-report.json for reported bugs.')
-        with open(f'/zap/wrk/{target_index}-report.json') as f:
-            reportData = json.load(f)
-
-        # Walk though the report, flattening the alert structure for bug reporting.
-        # The only nested item is the instances array.
-        for site in reportData['site']:
-            print(str(len(site['alerts'])) + " bugs found.")
-            for alert in site['alerts']:
-                bugDetails = {}
-                for item in alert:
-                    if item == 'instances':
-                        instanceList = alert['instances']
-                        for instanceCount in range(0, len(instanceList)):
-                            for instanceItem in instanceList[instanceCount]:
-                                bugDetails.update({"Instance" + str(instanceCount) + "-" + instanceItem : instanceList[instanceCount][instanceItem]})
-                    else:
-                        bugDetails.update({item : alert[item]})
-                raftUtils.report_bug(bugDetails)
+        batch = []
+        for alert in iter_alerts(report_path):
+            batch.append(alert_bug_details(alert))
+            bugCount += 1
+            if len(batch) == bugs_batch_size:
+                raftUtils.report_bugs(batch)
+                batch = []
+        if batch:
+            raftUtils.report_bugs(batch)
+        print(f'{bugCount} bugs found.')
     else:
         print(f'File {target_index}-report.json does NOT exist.')
-
-def count_bugs(target_index):
-    bugCount = 0
-    if os.path.exists(f'/zap/wrk/{target_index}-report.json'):
-        with open(f'/zap/wrk/{target_index}-report.json') as f:
-            reportData = json.load(f)
-
-        # Every alert is a bug
-        for site in reportData['site']:
-            bugCount = len(site['alerts'])
-
     return bugCount
 
-def run_zap(target_index, targets_total, host, target, token):
+def run_zap(target_index, targets_total, host, target, token, port=None, home=None):
+    zap_options = []
     if token:
         raftUtils.log_trace('Authentication token is set')
         auth = ('-config replacer.full_list(0).description=auth1'
@@ -84,21 +166,39 @@ def run_zap(target_index, targets_total, host, target, token):
                 ' -config replacer.full_list(0).matchstr=Authorization'
                 ' -config replacer.full_list(0).regex=false'
                 f' -config replacer.full_list(0).replacement="{token}"')
-        zap_auth_config = ['-z', auth]
+        zap_options.append(auth)
     else:
         raftUtils.log_trace('Authentication token is not set')
-        zap_auth_config = []
+
+    # Scans running in parallel need their own ZAP home directory and port.
+    # ZAP writes zap.out to the current directory, so run from the home directory.
+    if home:
+        os.makedirs(home, exist_ok=True)
+        zap_options.append(f'-dir {os.path.join(home, ".ZAP")}')
+        work_dir = home
+    else:
+        work_dir = zap_dir
+
+    if zap_options:
+        zap_options_config = ['-z', ' '.join(zap_options)]
+    else:
+        zap_options_config = []
+
+    if port:
+        port_config = ['-P', f'{port}']
+    else:
+        port_config = []
 
     if host:
         host_config = ['-O', host]
         raftUtils.log_trace(f'OpenAPI host override is set to {host}')
     else:
         host_config = []
-    os.chdir(zap_dir)
+    os.chdir(work_dir)
     r = 0
     try:
         print('Removing zap.out if exists')
-        os.remove('/zap/zap.out')
+        os.remove(os.path.join(work_dir, 'zap.out'))
     except:
         pass
 
@@ -107,13 +207,17 @@ def run_zap(target_index, targets_total, host, target, token):
         print(f"Starting ZAP target: {target} host_config: {host_config}")
 
         if os.path.exists(target):
-            shutil.copy(target, '/zap/wrk/swagger.json')
-            target='swagger.json'
+            shutil.copy(target, f'/zap/wrk/{target_index}-swagger.json')
+            target=f'{target_index}-swagger.json'
 
         raftUtils.log_trace(f"Starting ZAP")
         raftUtils.report_status_running(details)
 
-        status_reporter = StatusReporter(details)
+        tool_configuration = raft.task_config().tool_configuration or {}
+        status_reporter = StatusReporter(
+                            details,
+                            tool_configuration.get('progressReportStep', 5),
+                            tool_configuration.get('progressReportIntervalSeconds', 30))
         logger = logging.getLogger()
         logger.addHandler(status_reporter)
 
@@ -123,32 +227,31 @@ def run_zap(target_index, targets_total, host, target, token):
                    '-r', f'{target_index}-report.html',
                    '-w', f'{target_index}-report.md',
                    '-x', f'{target_index}-report.xml',
-                   '-d'] + zap_auth_config + host_config)
+                   '-d'] + zap_options_config + host_config + port_config)
 
     except SystemExit as e:
         r = e.code
 
     raftUtils.log_trace(f"ZAP exited with exit code: {r}")
-    shutil.copy('/zap/zap.out', f'/zap/wrk/{target_index}-zap.out')
+    shutil.copy(os.path.join(work_dir, 'zap.out'), f'/zap/wrk/{target_index}-zap.out')
 
     # Update the status with the total bug count.
-    details["totalBugCount"] = count_bugs(target_index)
+    details["totalBugCount"] = post_bugs(target_index)
     raftUtils.report_status_running(details)
 
-    post_bugs(target_index)
-
     if r <= 2:
         r = 0
-        
-    if target_index + 1 == targets_total:
-        raftUtils.report_status_completed(details)
+
+    # run.py reports the job completed once all of the targets are scanned
+    with open(f'/zap/wrk/{target_index}-status.json', 'w') as f:
+        json.dump(details, f)
 
     return r
 
-def run(target_index, targets_total, host, target, token):
+def run(target_index, targets_total, host, target, token, port=None, home=None):
     try:
         raftUtils.report_status_created()
-        return run_zap(target_index, targets_total, host, target, token)
+        return run_zap(target_index, targets_total, host, target, token, port, home)
     except Exception as ex:
         raftUtils.log_exception(ex)
         raftUtils.report_status_error({"Error" : f"{ex}"})
@@ -165,6 +268,8 @@ if __name__ == "__main__":
     host = None
     target = None
     token = None
+    port = None
+    home = None
 
     args = sys.argv
     i = 1
@@ -177,6 +282,12 @@ if __name__ == "__main__":
 
         if arg == '--host':
             host = args[i+1]
+
+        if arg == '--port':
+            port = int(args[i+1])
+
+        if arg == '--home':
+            home = args[i+1]
         i=i+1
 
-    run(target_index, targets_total, host, target, token)
+    run(target_index, targets_total, host, target, token, port, home)
@@ -3,7 +3,6 @@
 import argparse
 import json
 import os
-import uuid
 import textwrap
 import sys
 
@@ -135,7 +134,8 @@ def run(args):
     service_cli = RaftServiceCLI(
                     defaults,
                     defaults_path,
-                    args.get('secret'))
+                    args.get('secret'),
+                    args.get('use_az_cli') is True)
 
     # If we try to run the compatibility test before deployment
     # it will fail because we don't have a clientId and tenantId
@@ -153,12 +153,22 @@ def run(args):
         elif service_action == 'deploy':
             skip_sp_deployment = args.get('skip_sp_deployment')
             service_cli.deploy(
-                args['sku'], skip_sp_deployment and skip_sp_deployment is True)
+                args['sku'], skip_sp_deployment and skip_sp_deployment is True,
+                resume=args.get('resume') is True,
+                force=args.get('force') is True)
         elif service_action == 'upload-tools' or service_action == 'update':
-            utils_file_share = f'{uuid.uuid4()}'
-            service_cli.upload_utils(
-                utils_file_share, args.get('custom_tools_path'))
-            service_cli.restart()
+            tools_changed = service_cli.upload_utils(
+                                None, args.get('custom_tools_path'))
+            if tools_changed or service_action == 'update':
+                service_cli.restart()
+            else:
+                print('Tools are up to date')
+        elif service_action == 'clean-secrets':
+            service_cli.cleanup_function_secret_snapshots(
+                service_cli.definitions.storage_utils,
+                service_cli.definitions.orchestrator,
+                prefix=args.get('prefix'),
+                dry_run=args.get('dry_run') is True)
         elif service_action == 'config-vnet':
             vnetName = args.get('vnetName')
             if vnetName is None:
@@ -398,7 +408,7 @@ version     - Prints CLI version
     service_parser.add_argument(
         'service-action',
         choices=['deploy', 'restart', 'info', 'upload-tools',
-                 'update', 'config-vnet', 'clear-vnet'],
+                 'update', 'clean-secrets', 'config-vnet', 'clear-vnet'],
         help=textwrap.dedent('''\
 deploy       - Deploys the service
 
@@ -412,6 +422,10 @@ upload-tools - Uploads the tools definitions to the service
 update       - Uploads the tools definitions to the service and
                restarts service to get latest service components
 
+clean-secrets - Deletes the host secret snapshots of the orchestrator
+               function. Use --dry-run to only count them and --prefix
+               to select the blobs to delete.
+
 config-vnet  - Defines the VNET that Azure Container Instances are deployed
                into. The --vnetName, --vnetSubnetName, --vnetResourceGroup
                and --vnetRegion parameters are required. Note that the subnet
@@ -436,6 +450,31 @@ clear-vnet   - Removes the vnet configuration. The --vnetResourceGroup
     service_parser.add_argument(
         '--custom-tools-path', default=None, required=False)
 
+    service_parser.add_argument(
+        '--resume', required=False, action='store_true',
+        help=('Resume a failed deployment, skipping the deployment'
+              ' steps that completed'))
+
+    service_parser.add_argument(
+        '--force', required=False, action='store_true',
+        help=('Deploy every resource, including the resources that did not'
+              ' change since the last deployment'))
+
+    service_parser.add_argument(
+        '--use-az-cli', required=False, action='store_true',
+        help=('Run every Azure command with the az CLI instead of'
+              ' Azure Resource Manager REST calls'))
+
+    service_parser.add_argument(
+        '--dry-run', required=False, action='store_true',
+        help='Only count the secret snapshots clean-secrets would delete')
+
+    service_parser.add_argument(
+        '--prefix', default=None, required=False,
+        help=('Prefix of the blobs clean-secrets deletes from the'
+              ' azure-webjobs-secrets container. Default value:'
+              ' <orchestrator>/host.snapshot'))
+
     service_parser.add_argument(
         '--vnetName', default=None, required=False)
 
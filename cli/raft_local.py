@@ -10,11 +10,28 @@ import datetime
 import time
 import requests
 import logging
+import threading
+import queue
+import sys
+import struct
+import ctypes
+import ctypes.util
+import socket
+import shlex
+import http.client
+import urllib.parse
+import hashlib
+import glob
+import copy
+
+from collections import OrderedDict
+
+from concurrent.futures import ThreadPoolExecutor
 
 from dateutil import parser as DateParser
 from subprocess import PIPE
 from raft_sdk.raft_common import  RaftJsonDict, get_version
-from raft_sdk.raft_service import RaftJobConfig, print_status
+from raft_sdk.raft_service import RaftJobConfig, print_status, print_status_diff, status_by_agent, status_diff
 
 from opencensus.ext.azure.log_exporter import AzureEventHandler
 
@@ -56,6 +73,708 @@ def docker(args):
         return stdout
 
 
+class DockerCliEventsStream():
+    '''
+        docker events stream read from the docker CLI
+    '''
+    def __init__(self, containers, since=None):
+        args = ['docker', 'events',
+                '--format', '{{json .}}',
+                '--filter', 'type=container',
+                '--filter', 'event=die']
+        for c in containers:
+            args.extend(['--filter', f'container={c}'])
+        if since is not None:
+            args.extend(['--since', f'{since}'])
+        self.process = subprocess.Popen(args, stdout=PIPE, stderr=subprocess.DEVNULL)
+
+    def __iter__(self):
+        return iter(self.process.stdout)
+
+    def close(self):
+        if self.process.poll() is None:
+            self.process.terminate()
+            self.process.wait()
+
+
+class DockerCliBackend():
+    '''
+        Container backend that runs the docker CLI for every operation
+    '''
+    name = 'cli'
+
+    def run_args(self, spec):
+        args = 'run -d -t --no-healthcheck --privileged --user="root"'
+        if spec['cmd']:
+            args += ' --entrypoint=""'
+            args += ' --workdir="/"'
+        if spec['name']:
+            args += f' --name {spec["name"]}'
+        if spec['network']:
+            args += f' --network {spec["network"]}'
+        for m in spec['mounts']:
+            args += f' --mount type=bind,source="{m["Source"]}",target="{m["Target"]}"'
+            if m['ReadOnly']:
+                args += ',readonly'
+        for p in spec['ports']:
+            args += f' --publish {p}:{p}/tcp'
+        for name, value in spec['env']:
+            vv = value.replace('"', '\\"')
+            args += f' --env {name}="{vv}"'
+        args += f' {spec["image"]}'
+        if spec['cmd']:
+            args += f' {spec["cmd"]}'
+        return args
+
+    def describe(self, spec):
+        return self.run_args(spec)
+
+    def pull(self, image):
+        return docker('pull ' + image)
+
+    def image_exists(self, image):
+        try:
+            docker(f'image inspect --format "{{{{.Id}}}}" {image}')
+            return True
+        except RaftLocalCliDockerException:
+            return False
+
+    def run(self, spec):
+        return docker(self.run_args(spec))
+
+    def inspect(self, containers):
+        return json.loads(docker('container inspect ' + ' '.join(containers)))
+
+    def stop(self, containers):
+        docker(f'container stop -t 0 {" ".join(containers)}')
+
+    def remove(self, containers):
+        docker(f'container rm {" ".join(containers)}')
+
+    def logs(self, container, tail):
+        return docker(f'logs {container} --tail {tail}')
+
+    def exec(self, container, cmd):
+        return docker(f'container exec -t --user="root" --privileged {container} ' + cmd)
+
+    def create_network(self, name):
+        docker(f'network create --driver bridge {name}')
+
+    def remove_network(self, name):
+        docker(f'network rm {name}')
+
+    def events(self, containers, since=None):
+        return DockerCliEventsStream(containers, since)
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, socket_path, timeout=None):
+        super(UnixHTTPConnection, self).__init__('localhost', timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+class DockerEngineEventsStream():
+    '''
+        docker events stream read from the Docker Engine API
+    '''
+    def __init__(self, backend, containers, since=None):
+        filters = {'type': ['container'], 'event': ['die'], 'container': containers}
+        query = {'filters': json.dumps(filters)}
+        if since is not None:
+            query['since'] = f'{since}'
+        self.connection = UnixHTTPConnection(backend.socket_path)
+        self.connection.request('GET', backend.url('/events', query))
+        self.response = self.connection.getresponse()
+        if self.response.status != 200:
+            raise RaftLocalCliDockerException(self.response.read().decode(), 'GET /events')
+
+    def __iter__(self):
+        return iter(self.response.readline, b'')
+
+    def close(self):
+        try:
+            self.connection.sock.shutdown(socket.SHUT_RDWR)
+        except (AttributeError, OSError):
+            pass
+        self.connection.close()
+
+
+class DockerEngineBackend():
+    '''
+        Container backend that talks to the Docker Engine API over
+        the docker unix socket. Mounts and environment variables are
+        passed as structured data, and every thread keeps its own
+        keep-alive connection to the daemon.
+    '''
+    name = 'engine'
+    api_version = 'v1.40'
+
+    def __init__(self, socket_path):
+        self.socket_path = socket_path
+        self.connections = threading.local()
+        self.cli = DockerCliBackend()
+
+    def url(self, path, query=None):
+        url = f'/{self.api_version}{path}'
+        if query:
+            url += '?' + urllib.parse.urlencode(query)
+        return url
+
+    def request(self, method, path, query=None, body=None):
+        headers = {}
+        data = None
+        if body is not None:
+            data = json.dumps(body).encode()
+            headers['Content-Type'] = 'application/json'
+
+        connection = getattr(self.connections, 'connection', None)
+        reused = connection is not None
+        if connection is None:
+            connection = UnixHTTPConnection(self.socket_path)
+            self.connections.connection = connection
+        try:
+            connection.request(method, self.url(path, query), body=data, headers=headers)
+            response = connection.getresponse()
+        except (ConnectionError, http.client.HTTPException):
+            connection.close()
+            if not reused:
+                raise
+            # keep-alive connection was closed by the daemon, which shows
+            # up either when sending the request or reading the response
+            connection.request(method, self.url(path, query), body=data, headers=headers)
+            response = connection.getresponse()
+
+        content = response.read()
+        if response.status >= 400:
+            try:
+                message = json.loads(content)['message']
+            except (ValueError, KeyError):
+                message = content.decode()
+            raise RaftLocalCliDockerException(message, f'{method} {path}')
+        return response.status, content
+
+    def ping(self):
+        self.request('GET', '/_ping')
+
+    def quote(self, name):
+        return urllib.parse.quote(name, safe='/:@')
+
+    def describe(self, spec):
+        return f'container {spec["name"]} from image {spec["image"]}'
+
+    def pull(self, image):
+        name = image.split('/')[-1]
+        if '@' in image or ':' in name:
+            query = {'fromImage': image}
+        else:
+            query = {'fromImage': image, 'tag': 'latest'}
+        try:
+            _, content = self.request('POST', '/images/create', query)
+        except RaftLocalCliDockerException as ex:
+            # registry credentials are only available to the docker CLI
+            print(f'Failed to pull {image} through Docker Engine API due to {ex}. Using docker CLI')
+            return self.cli.pull(image)
+
+        status = []
+        for line in content.splitlines():
+            progress = json.loads(line)
+            if progress.get('error'):
+                print(f'Failed to pull {image} through Docker Engine API due to {progress["error"]}. Using docker CLI')
+                return self.cli.pull(image)
+            if progress.get('status') and not progress.get('id'):
+                status.append(progress['status'])
+        return os.linesep.join(status)
+
+    def image_exists(self, image):
+        try:
+            self.request('GET', f'/images/{self.quote(image)}/json')
+            return True
+        except RaftLocalCliDockerException:
+            return False
+
+    def run(self, spec):
+        host_config = {
+            'Privileged': True,
+            'Mounts': [{'Type': 'bind',
+                        'Source': m['Source'],
+                        'Target': m['Target'],
+                        'ReadOnly': m['ReadOnly']} for m in spec['mounts']]
+        }
+        if spec['network']:
+            host_config['NetworkMode'] = spec['network']
+
+        config = {
+            'Image': spec['image'],
+            'Tty': True,
+            'User': 'root',
+            'Healthcheck': {'Test': ['NONE']},
+            'Env': [f'{name}={value}' for name, value in spec['env']],
+            'HostConfig': host_config
+        }
+        if spec['ports']:
+            config['ExposedPorts'] = {f'{p}/tcp': {} for p in spec['ports']}
+            host_config['PortBindings'] = {f'{p}/tcp': [{'HostPort': f'{p}'}] for p in spec['ports']}
+        if spec['cmd']:
+            config['Entrypoint'] = ['']
+            config['WorkingDir'] = '/'
+            config['Cmd'] = shlex.split(spec['cmd'])
+
+        query = {'name': spec['name']} if spec['name'] else None
+        _, content = self.request('POST', '/containers/create', query, config)
+        container_id = json.loads(content)['Id']
+        self.request('POST', f'/containers/{container_id}/start')
+        return container_id
+
+    def inspect(self, containers):
+        infos = []
+        for c in containers:
+            _, content = self.request('GET', f'/containers/{c}/json')
+            infos.append(json.loads(content))
+        return infos
+
+    def for_each_container(self, f, containers):
+        with ThreadPoolExecutor(max_workers=min(len(containers), 8)) as pool:
+            list(pool.map(f, containers))
+
+    def stop(self, containers):
+        self.for_each_container(
+            lambda c: self.request('POST', f'/containers/{c}/stop', {'t': 0}), containers)
+
+    def remove(self, containers):
+        self.for_each_container(
+            lambda c: self.request('DELETE', f'/containers/{c}'), containers)
+
+    def logs(self, container, tail):
+        _, content = self.request(
+            'GET', f'/containers/{container}/logs', {'stdout': 1, 'stderr': 1, 'tail': tail})
+        return content.decode(errors='replace')
+
+    def exec(self, container, cmd):
+        exec_config = {
+            'Cmd': shlex.split(cmd),
+            'User': 'root',
+            'Privileged': True,
+            'Tty': True,
+            'AttachStdout': True,
+            'AttachStderr': True
+        }
+        _, content = self.request('POST', f'/containers/{container}/exec', body=exec_config)
+        exec_id = json.loads(content)['Id']
+        _, content = self.request('POST', f'/exec/{exec_id}/start', body={'Detach': False, 'Tty': True})
+        return content.decode(errors='replace')
+
+    def create_network(self, name):
+        self.request('POST', '/networks/create', body={'Name': name, 'Driver': 'bridge'})
+
+    def remove_network(self, name):
+        self.request('DELETE', f'/networks/{name}')
+
+    def events(self, containers, since=None):
+        return DockerEngineEventsStream(self, containers, since)
+
+
+def docker_socket_path():
+    docker_host = os.environ.get('DOCKER_HOST')
+    if docker_host:
+        if docker_host.startswith('unix://'):
+            return docker_host[len('unix://'):]
+        return None
+    if os.path.exists('/var/run/docker.sock'):
+        return '/var/run/docker.sock'
+    return None
+
+
+def docker_backend(backend='auto'):
+    '''
+        Selects container backend
+
+        Parameters:
+            backend: 'engine' - Docker Engine API over unix socket
+                     'cli' - docker CLI
+                     'auto' - Docker Engine API if available, otherwise docker CLI
+
+        Returns:
+            Container backend
+    '''
+    if backend in ['auto', 'engine']:
+        socket_path = docker_socket_path()
+        if socket_path:
+            engine = DockerEngineBackend(socket_path)
+            try:
+                engine.ping()
+                return engine
+            except (OSError, http.client.HTTPException, RaftLocalCliDockerException) as ex:
+                if backend == 'engine':
+                    raise
+                print(f'Docker Engine API is not available due to {ex}. Using docker CLI')
+        elif backend == 'engine':
+            raise RaftLocalException('Docker Engine API unix socket is not available')
+    return DockerCliBackend()
+
+
+class DockerEventsWatcher():
+    '''
+        Follows the docker events stream for a set of containers
+        and queues names of the containers as soon as they exit
+    '''
+    def __init__(self, docker_backend, containers, since=None):
+        '''
+            Parameters:
+                docker_backend: container backend
+                containers: names of the containers to follow
+                since: UNIX timestamp. Containers that exited since then
+                       are reported too, even if they exited before
+                       the events stream was established.
+        '''
+        self.exited = queue.Queue()
+        self.closed = False
+        self.stream = docker_backend.events(containers, since)
+        self.reader = threading.Thread(target=self.read_events, daemon=True)
+        self.reader.start()
+
+    def read_events(self):
+        try:
+            for line in self.stream:
+                try:
+                    event = json.loads(line)
+                    self.exited.put(event['Actor']['Attributes']['name'])
+                except (ValueError, KeyError):
+                    pass
+        except (OSError, ValueError, AttributeError, http.client.HTTPException):
+            # stream was closed while reading
+            pass
+        # None marks the end of the stream
+        self.exited.put(None)
+
+    def wait_for_exits(self, timeout):
+        '''
+            Waits until at least one container exits or timeout expires
+
+            Parameters:
+                timeout: maximum number of seconds to wait
+
+            Returns:
+                Set of names of containers that exited
+        '''
+        exited = set()
+        try:
+            name = self.exited.get(timeout=timeout)
+            while True:
+                if name is None:
+                    self.closed = True
+                else:
+                    exited.add(name)
+                name = self.exited.get_nowait()
+        except queue.Empty:
+            pass
+        return exited
+
+    def stop(self):
+        self.stream.close()
+
+
+class InotifyWatcher():
+    '''
+        Minimal inotify binding that reports files written to
+        and directories created in the watched directories
+    '''
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_Q_OVERFLOW = 0x00004000
+    IN_ISDIR = 0x40000000
+
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.watches = {}
+
+    def add_watch(self, path):
+        mask = self.IN_CLOSE_WRITE | self.IN_MOVED_TO | self.IN_CREATE
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), f'inotify_add_watch failed for {path}')
+        self.watches[wd] = path
+
+    def read(self):
+        '''
+            Reads all queued inotify events without blocking
+
+            Returns:
+                List of written file paths, list of created directory paths
+                and True if the kernel event queue overflowed
+        '''
+        files = []
+        directories = []
+        overflow = False
+        while True:
+            try:
+                buf = os.read(self.fd, 65536)
+            except BlockingIOError:
+                break
+            i = 0
+            while i < len(buf):
+                wd, mask, _, name_length = struct.unpack_from('iIII', buf, i)
+                name = buf[i + 16 : i + 16 + name_length].rstrip(b'\0')
+                i += 16 + name_length
+                if mask & self.IN_Q_OVERFLOW:
+                    overflow = True
+                elif wd in self.watches and name:
+                    path = os.path.join(self.watches[wd], os.fsdecode(name))
+                    if mask & self.IN_ISDIR:
+                        directories.append(path)
+                    elif mask & (self.IN_CLOSE_WRITE | self.IN_MOVED_TO):
+                        files.append(path)
+        return files, directories, overflow
+
+    def close(self):
+        os.close(self.fd)
+
+
+class JobEventsSink():
+    '''
+        Incrementally consumes job event files written to the events
+        sink of a job. New files are discovered with inotify when it is
+        available, otherwise by a sorted scan of the sink directories.
+        The latest status of every agent is kept in memory.
+    '''
+    def __init__(self, path, watch=True):
+        '''
+            Parameters:
+                path: events sink directory of the job
+                watch: if False, then the directories are always scanned
+                       and no inotify file descriptor is kept open
+        '''
+        self.path = path
+        self.directories = set()
+        # dictionary is used as an ordered set of file paths
+        self.pending = {}
+        self.failed = set()
+        self.status = {}
+        self.watcher = None
+        if watch and sys.platform.startswith('linux'):
+            try:
+                self.watcher = InotifyWatcher()
+            except (OSError, AttributeError) as ex:
+                print(f'Failed to initialize inotify due to {ex}. Scanning events sink instead')
+        self.add_directory(path)
+
+    def add_directory(self, path):
+        # watch is added before scanning the directory,
+        # so files written in between are not missed
+        if self.watcher:
+            self.watcher.add_watch(path)
+        self.directories.add(path)
+        self.scan_directory(path)
+
+    def scan_directory(self, path):
+        with os.scandir(path) as entries:
+            for entry in sorted(entries, key=lambda e: e.name):
+                if entry.is_dir():
+                    if entry.path not in self.directories:
+                        self.add_directory(entry.path)
+                elif entry.path not in self.failed:
+                    self.pending[entry.path] = None
+
+    def new_files(self, full_scan):
+        if self.watcher:
+            files, directories, overflow = self.watcher.read()
+            for d in directories:
+                if d not in self.directories:
+                    self.add_directory(d)
+            for f in files:
+                self.pending[f] = None
+            full_scan = full_scan or overflow
+
+        if full_scan or not self.watcher:
+            for d in sorted(self.directories):
+                self.scan_directory(d)
+
+        files = list(self.pending)
+        self.pending.clear()
+        return files
+
+    def update_status(self, event):
+        message = event['Message']
+        agent_name = message['AgentName']
+        utc_event_time = parse_utc_time(message['UtcEventTime'])
+        current = self.status.get(agent_name)
+        if current is None or utc_event_time > current[0]:
+            self.status[agent_name] = (utc_event_time, message)
+
+    def latest_status(self):
+        return [message for _, message in self.status.values()]
+
+    def read_events(self, full_scan=False):
+        '''
+            Parses job event files written since the last call
+            and deletes them
+
+            Parameters:
+                full_scan: if True, then rescan all sink directories
+                           in addition to files reported by inotify
+
+            Returns:
+                List of BugFound events
+        '''
+        bugs = []
+        processed = []
+        for file_path in self.new_files(full_scan):
+            try:
+                with open(file_path, 'r') as event_file:
+                    j = json.load(event_file, object_hook=json_hook)
+                if j['EventType'] == 'BugFound':
+                    bugs.append(j)
+                elif j['EventType'] == 'JobStatus':
+                    self.update_status(j)
+                processed.append(file_path)
+            except FileNotFoundError:
+                pass
+            except Exception as ex:
+                print(f"FAILED TO PROCESS STATUS MESSAGE:\
+                        {file_path} due to {ex}")
+                # files reported by inotify are complete, so there
+                # is no point in parsing them again
+                if self.watcher:
+                    self.failed.add(file_path)
+
+        for file_path in processed:
+            try:
+                os.remove(file_path)
+            except FileNotFoundError:
+                pass
+        return bugs
+
+    def close(self):
+        if self.watcher:
+            self.watcher.close()
+            self.watcher = None
+
+
+def bug_message(bug):
+    # When running locally in raft-action the key is
+    # Data instead of Message.
+    if 'Message' in bug:
+        return bug['Message']
+    else:
+        return bug['Data']
+
+
+# Bug details keys identifying the endpoint and the error of a bug
+bug_endpoint_keys = ['site', 'target', 'endpoint', 'uri', 'url', 'path', 'operation', 'method']
+bug_signature_keys = ['BugHash', 'pluginId', 'alertRef', 'name', 'check', 'statusCode', 'error']
+# Bug details keys that differ between reports of the same bug
+bug_volatile_keys = ['jobId', 'outputFolder', 'BugBucket', 'utcEventTime']
+
+
+def bug_instance_endpoints(details):
+    # ZAP alerts carry their endpoints in the JSON list of alert instances
+    instances = details.get('instances')
+    if isinstance(instances, str):
+        try:
+            instances = json.loads(instances)
+        except ValueError:
+            return []
+    if not isinstance(instances, list):
+        return []
+    endpoints = set()
+    for i in instances:
+        if isinstance(i, dict) and i.get('uri') is not None:
+            endpoints.add(f'{i.get("method") or ""} {i["uri"]}')
+    return sorted(endpoints)
+
+
+def bug_fingerprint(bug):
+    '''
+        Stable fingerprint of a bug computed from the tool name,
+        endpoint and error signature found in the bug details
+
+        Parameters:
+            bug: BugFound event
+
+        Returns:
+            Fingerprint string
+    '''
+    message = bug_message(bug)
+    details = message.get('BugDetails') or {}
+
+    endpoint = [f'{details.get(k)}' for k in bug_endpoint_keys if details.get(k) is not None]
+    if not endpoint:
+        endpoint = bug_instance_endpoints(details)
+    signature = [f'{details.get(k)}' for k in bug_signature_keys if details.get(k) is not None]
+    if not signature or not endpoint:
+        # without an endpoint the signature alone would merge bugs
+        # found on different endpoints, hash all stable details instead
+        volatile = set(k.lower() for k in bug_volatile_keys)
+        signature = [json.dumps({k: details[k] for k in details if k.lower() not in volatile},
+                                sort_keys=True, default=str)]
+
+    h = hashlib.sha1()
+    for part in [message.get('Tool')] + endpoint + ['|'] + signature:
+        h.update(f'{part}'.encode())
+        h.update(b'\0')
+    return h.hexdigest()
+
+
+class BugStore():
+    '''
+        Append-only on-disk store of the bugs found by a job.
+        Bugs are deduplicated by fingerprint, and only the fingerprints
+        and per-tool counts are kept in memory. Bugs already in the
+        store, for example from another process, are loaded on creation.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.fingerprints = set()
+        self.count_per_tool = {}
+        self.duplicates = 0
+        for bug in self:
+            self.fingerprints.add(bug_fingerprint(bug))
+            tool = bug_message(bug)['Tool']
+            self.count_per_tool[tool] = self.count_per_tool.get(tool, 0) + 1
+
+    def extend(self, bugs):
+        '''
+            Appends bugs that were not seen before to the store
+
+            Parameters:
+                bugs: list of BugFound events
+
+            Returns:
+                Number of new bugs
+        '''
+        new_bugs = 0
+        with open(self.path, 'a') as store:
+            for bug in bugs:
+                fingerprint = bug_fingerprint(bug)
+                if fingerprint in self.fingerprints:
+                    self.duplicates += 1
+                    continue
+                self.fingerprints.add(fingerprint)
+                store.write(json.dumps(bug) + '\n')
+
+                tool = bug_message(bug)['Tool']
+                self.count_per_tool[tool] = self.count_per_tool.get(tool, 0) + 1
+                new_bugs += 1
+        return new_bugs
+
+    def __len__(self):
+        return len(self.fingerprints)
+
+    def __iter__(self):
+        if os.path.exists(self.path):
+            with open(self.path, 'r') as store:
+                for line in store:
+                    yield json.loads(line, object_hook=json_hook)
+
+
 def init_tools(tools_path):
     '''
         Load tool configurations and create mount
@@ -117,7 +836,7 @@ def time_span_to_seconds(time_span):
 def parse_utc_time(t):
     return DateParser.parse(t)
 
-def trigger_webhook(url, data, metadata=None):
+def webhook_events(data, metadata=None):
     for d in data:
         d['Subject'] = d['EventType']
         d['Id'] = f'{uuid.uuid4()}'
@@ -129,20 +848,196 @@ def trigger_webhook(url, data, metadata=None):
         d['EventTime'] = f'{datetime.datetime.utcnow()}'
         d['DataVersion'] = '1.0'
         d['metadataVersion'] = '1'
+    return data
 
-    response = requests.post(url, json=data)
+def trigger_webhook(url, data, metadata=None):
+    response = requests.post(url, json=webhook_events(data, metadata))
     return response
-        
+
+def job_status_event(status):
+    return RaftJsonDict({'EventType': 'JobStatus', 'Message': status})
+
+
+class WebhookDispatcher():
+    '''
+        Delivers webhook events from a background thread, so callers
+        never wait on the webhook receiver.
+
+        Bug events go through a bounded queue. Job status events are
+        coalesced per webhook and agent, so only the latest status of
+        an agent is sent if the receiver is falling behind. Events for
+        the same webhook are sent in batches over a pooled session and
+        failed POSTs are retried with exponential backoff.
+    '''
+    def __init__(self, metadata=None, max_queue_size=1000, max_batch_size=50, max_retries=5,
+                 request_timeout=30):
+        self.metadata = metadata
+        self.max_batch_size = max_batch_size
+        self.max_retries = max_retries
+        self.request_timeout = request_timeout
+
+        self.queue = queue.Queue(maxsize=max_queue_size)
+        self.status_lock = threading.Lock()
+        self.pending_status = OrderedDict()
+        self.session = requests.Session()
+        self.metrics = {
+            'queued': 0,
+            'coalesced': 0,
+            'dropped': 0,
+            'sent': 0,
+            'batches': 0,
+            'retries': 0,
+            'failed': 0
+        }
+        self.closing = threading.Event()
+        self.sender = threading.Thread(target=self.send_events, daemon=True)
+        self.sender.start()
+
+    def post_status(self, url, status):
+        '''
+            Queues job status event. Replaces a status of the same
+            agent that was not sent yet.
+
+            Parameters:
+                url: webhook URL
+                status: job status message
+        '''
+        key = (url, status.get('AgentName'))
+        # the caller keeps updating its status, send a snapshot
+        event = job_status_event(copy.deepcopy(status))
+        with self.status_lock:
+            if key in self.pending_status:
+                self.metrics['coalesced'] += 1
+            else:
+                self.metrics['queued'] += 1
+            self.pending_status[key] = event
+
+    def post_bug(self, url, bug, block=True):
+        '''
+            Queues bug found event
+
+            Parameters:
+                url: webhook URL
+                bug: bug found event
+                block: if False, then the event is dropped when the queue is full
+        '''
+        event = (url, copy.deepcopy(bug))
+        try:
+            # nothing drains the queue once the sender thread is gone
+            while True:
+                try:
+                    self.queue.put(event, block=block, timeout=1.0 if block else None)
+                    break
+                except queue.Full:
+                    if not block or not self.sender.is_alive():
+                        raise
+            self.metrics['queued'] += 1
+        except queue.Full:
+            self.metrics['dropped'] += 1
+
+    def queue_depth(self):
+        return self.queue.qsize() + len(self.pending_status)
+
+    def next_batch(self):
+        batches = OrderedDict()
+        with self.status_lock:
+            for (url, _), event in self.pending_status.items():
+                batches.setdefault(url, []).append(event)
+            self.pending_status.clear()
+
+        try:
+            # wait for bugs only if there is nothing else to send
+            timeout = 0 if len(batches) > 0 else 0.5
+            url, bug = self.queue.get(timeout=timeout)
+            batches.setdefault(url, []).append(bug)
+            while True:
+                url, bug = self.queue.get_nowait()
+                batches.setdefault(url, []).append(bug)
+        except queue.Empty:
+            pass
+        return batches
+
+    def send_events(self):
+        while True:
+            batches = self.next_batch()
+            if len(batches) == 0:
+                if self.closing.is_set() and self.queue_depth() == 0:
+                    return
+                continue
+
+            for url in batches:
+                events = batches[url]
+                for i in range(0, len(events), self.max_batch_size):
+                    batch = events[i : i + self.max_batch_size]
+                    try:
+                        self.send_batch(url, batch)
+                    except Exception as ex:
+                        # keep the sender alive for the events that follow
+                        print(f'Failed to send webhook events to {url} due to {ex}')
+                        self.metrics['failed'] += len(batch)
+
+    def send_batch(self, url, events):
+        data = webhook_events(events, self.metadata)
+        for attempt in range(self.max_retries + 1):
+            if attempt > 0:
+                self.metrics['retries'] += 1
+                time.sleep(min(0.5 * 2 ** attempt, 30))
+            try:
+                response = self.session.post(url, json=data, timeout=self.request_timeout)
+                if response.status_code < 500 and response.status_code != 429:
+                    self.metrics['sent'] += len(events)
+                    self.metrics['batches'] += 1
+                    return
+            except requests.exceptions.RequestException as ex:
+                print(f'Failed to post webhook to {url} due to {ex}')
+        self.metrics['failed'] += len(events)
+
+    def close(self, timeout=60):
+        '''
+            Waits until all queued events are delivered
+            and stops the background thread.
+
+            Parameters:
+                timeout: seconds to wait for the delivery, events
+                         not delivered by then are abandoned
+
+            Returns:
+                Dispatcher metrics
+        '''
+        self.closing.set()
+        self.sender.join(timeout)
+        if self.sender.is_alive():
+            # the daemon thread is abandoned together with its session
+            m = self.metrics
+            m['abandoned'] = m['queued'] - m['sent'] - m['failed']
+            print(f'Gave up on delivering {m["abandoned"]} webhook events'
+                  f' after {timeout} seconds')
+        else:
+            self.session.close()
+        return self.metrics
+
 
 class RaftLocalCLI():
-    def __init__(self, network='host', telemetry=True):
-        # This will hole a cumulative count of the bugs found over the course of the job. 
-        self.bugs = []
+    def __init__(self, network='host', telemetry=True, supervision='events',
+                 pull_policy='always', max_workers=8, backend='auto'):
+        # This will hold all of the bugs found over the course of the job.
+        # Set to the BugStore of the job when the job starts.
+        self.bugs = None
+        # job ID -> BugStore
+        self.bug_stores = {}
+        # job ID -> job results directory of jobs created by this instance
+        self.job_dirs = {}
         self.status = []
+        self.events_sinks = {}
         self.appinsights_instrumentation_key = '9d67f59d-4f44-475c-9363-d0ae7ea61e95'
         self.telemetry = telemetry
 
         self.network = network
+        self.docker = docker_backend(backend)
+        self.supervision = supervision
+        self.pull_policy = pull_policy
+        self.max_workers = max_workers
+        self.phase_timings = {}
         self.work_directory = work_directory
         self.tools, self.tool_paths =\
             init_tools(os.path.join(script_dir, 'raft-tools', 'tools'))
@@ -193,36 +1088,24 @@ class RaftLocalCLI():
 
     # Record how many bugs were found by each tool
     def log_bugs_per_tool(self):
-        tools = {}
-        
-        for bug in self.bugs:
-            # When running locally in raft-action the key is
-            # Data instead of Message.
-            if 'Message' in bug:
-                key = 'Message'
-            else:
-                key = 'Data'
-            toolname = bug[key]['Tool']
-            if toolname in tools:
-                tools[toolname] += 1
-            else:
-                tools[toolname] = 1
+        if self.bugs is None:
+            return
 
+        tools = self.bugs.count_per_tool
         for toolname in tools:
             self.logger.info("BugsFound", extra=self.log_bugs_found_telemetry('Task: ' + toolname, 'Bugs', tools[toolname]))
 
     def mount_read_write(self, source, target):
-        return f'--mount type=bind,source="{source}",target="{target}" '
+        return [{'Source': source, 'Target': target, 'ReadOnly': False}]
 
     def mount_read_only(self, source, target):
-        return f'--mount type=bind,source="{source}",target="{target}",readonly '
+        return [{'Source': source, 'Target': target, 'ReadOnly': True}]
 
     def env_variable(self, name, value):
-        vv = (f"{value}").replace('"', '\\"')
-        return f'--env {name}="{vv}" '
+        return [(name, f'{value}')]
 
     def common_environment_variables(self, job_id, work_dir):
-        env = ' '
+        env = []
         env += self.env_variable('RAFT_JOB_ID', job_id)
         env += self.env_variable('RAFT_CONTAINER_GROUP_NAME', job_id)
         env += self.env_variable('RAFT_WORK_DIRECTORY', work_dir)
@@ -241,89 +1124,158 @@ class RaftLocalCLI():
             self.source = customLocal
         return env
 
-    def process_job_events_sink(self, job_events_path):
-        bugs = []
-        job_status = {}
-        for root_folder_path, dirs, files in os.walk(job_events_path):
-            for file_name in files:
-                file_path = os.path.join(root_folder_path, file_name)
-                status = open(file_path, 'r')
-                try:
-                    j = json.load(status,\
-                            object_hook=RaftJsonDict.raft_json_object_hook)
-                    status.close()
-                    os.remove(file_path) 
-                    if j['EventType'] == 'BugFound':
-                        bugs.append(j) 
-                    elif j['EventType'] == 'JobStatus':
-                        js = job_status.get(j['Message']['AgentName']) 
-                        if js:
-                            if parse_utc_time(j['Message']['UtcEventTime']) >\
-                                parse_utc_time(js['Message']['UtcEventTime']):
-                                job_status[j['Message']['AgentName']] = j
-                        else:
-                            job_status[j['Message']['AgentName']] = j
-                except Exception as ex:
-                    print(f"FAILED TO PROCESS STATUS MESSAGE:\
-                            {file_path} due to {ex}")
-
-        if len(job_status) > 0:
-            status = []
-            for s in job_status:
-                status.append(job_status[s]['Message'])
-            self.status = status
+    def job_results_directory(self, job_id):
+        '''
+            Results directory of a job. Jobs with a root file share
+            keep their results in a directory of the file share.
+        '''
+        job_dir = self.job_dirs.get(job_id)
+        if job_dir is None:
+            job_dir = os.path.join(self.storage, job_id)
+            if not os.path.isdir(job_dir):
+                shared = sorted(glob.glob(os.path.join(self.storage, '*', job_id)))
+                if shared:
+                    job_dir = shared[0]
+        return job_dir
+
+    def bug_store(self, job_id):
+        '''
+            Returns:
+                BugStore of the job, kept as bugs.jsonl
+                in the job results directory
+        '''
+        store = self.bug_stores.get(job_id)
+        if store is None:
+            store = BugStore(os.path.join(self.job_results_directory(job_id), 'bugs.jsonl'))
+            self.bug_stores[job_id] = store
+        return store
+
+    def process_job_events_sink(self, job_id, full_scan=False, watch=True):
+        sink = self.events_sinks.get(job_id)
+        if sink is None:
+            sink = JobEventsSink(os.path.join(self.events_sink, job_id), watch)
+            self.events_sinks[job_id] = sink
+
+        bugs = sink.read_events(full_scan)
+        if len(sink.status) > 0:
+            self.status = sink.latest_status()
         if len(bugs) > 0:
-            self.bugs = self.bugs + bugs
+            store = self.bug_store(job_id)
+            os.makedirs(os.path.dirname(store.path), exist_ok=True)
+            store.extend(bugs)
+
+    def close_job_events_sink(self, job_id):
+        sink = self.events_sinks.pop(job_id, None)
+        if sink:
+            sink.close()
 
     def docker_create_bridge(self, network, job_id):
         if network == 'host':
             return 'host'
         elif network == 'bridge':
             bridge = 'raft-' + job_id.replace('-', '')
-            docker(f'network create --driver bridge {bridge}')
+            self.docker.create_network(bridge)
             return bridge
         else:
             raise RaftLocalException('Unhandled docker network driver: ' + network)
 
     def docker_remove_bridge(self, bridge_name):
         if bridge_name != 'none' and bridge_name != 'host':
-            docker(f'network rm {bridge_name}')
+            self.docker.remove_network(bridge_name)
 
     def docker_stop_containers(self, container_names):
         if len(container_names) > 0:
-            docker(f'container stop -t 0 {" ".join(container_names)}')
+            self.docker.stop(container_names)
 
     def docker_remove_containers(self, container_names):
         if len(container_names) > 0:
-            docker(f'container rm {" ".join(container_names)}')
+            self.docker.remove(container_names)
 
-    def docker_run_cmd(self, container, container_name, mounts, ports,\
+    def docker_run_spec(self, container, container_name, mounts, ports,\
             environment_variables, shell, run_cmd, bridge_name):
-        docker_run_cmd = 'run -d -t --no-healthcheck --privileged --user="root"'
-        if shell and run_cmd:
-            docker_run_cmd += ' --entrypoint=""'
-            docker_run_cmd += ' --workdir="/"'
-        if container_name:
-            docker_run_cmd += f' --name {container_name}'
-        if bridge_name:
-            docker_run_cmd += f' --network {bridge_name}'
-        if mounts:
-            docker_run_cmd += f' {mounts}'
-        if ports and bridge_name != 'host':
-            docker_run_cmd += f' {ports}'
-        if environment_variables:
-            docker_run_cmd += f' {environment_variables}'
-        if container:
-            docker_run_cmd += f' {container}'
-        if shell and run_cmd:
-            docker_run_cmd += f' {run_cmd}'
-        return docker_run_cmd
+        if not ports or bridge_name == 'host':
+            ports = []
+        if not (shell and run_cmd):
+            run_cmd = None
+        return {
+            'image': container,
+            'name': container_name,
+            'network': bridge_name,
+            'mounts': mounts or [],
+            'ports': ports,
+            'env': environment_variables or [],
+            'cmd': run_cmd
+        }
+
+    def job_images(self, job_config):
+        '''
+            Lists container images used by the job without duplicates
+
+            Parameters:
+                job_config: job configuration
 
+            Returns:
+                List of container images
+        '''
+        images = [self.container_utils['agent-utilities']['container']]
+        testTargets = job_config.config.get('testTargets')
+        if testTargets and testTargets.get('services'):
+            for service in testTargets['services']:
+                images.append(service['container'])
+
+        testTasks = job_config.config.get('testTasks')
+        if testTasks and testTasks.get('tasks'):
+            for testTask in testTasks['tasks']:
+                images.append(self.tools[testTask['toolName']]['container'])
+
+        return list(dict.fromkeys(images))
+
+    def pull_image(self, image):
+        # Images pinned by digest cannot change, so are only pulled when missing
+        if (self.pull_policy == 'missing' or '@sha256:' in image) and\
+                self.docker.image_exists(image):
+            return f'Using local image {image}'
+        return self.docker.pull(image)
+
+    def pull_images(self, images):
+        '''
+            Pulls container images concurrently
+
+            Parameters:
+                images: list of container images
+        '''
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            for std_out in pool.map(self.pull_image, images):
+                print(std_out)
+
+    def run_containers(self, run_specs):
+        '''
+            Starts containers concurrently
+
+            Parameters:
+                run_specs: list of container specifications
+                           created by docker_run_spec
+        '''
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            for spec, out in zip(run_specs, pool.map(self.docker.run, run_specs)):
+                print(f"Running docker with command : {self.docker.describe(spec)}")
+                print(out)
+
+    def timed_phase(self, phase, f, *args):
+        start = time.monotonic()
+        try:
+            return f(*args)
+        finally:
+            self.phase_timings[phase] = time.monotonic() - start
+
+    def print_phase_timings(self):
+        if len(self.phase_timings) > 0:
+            print('Job startup timings:')
+            for phase in self.phase_timings:
+                print(f'    {phase}: {self.phase_timings[phase]:.1f} seconds')
 
     def start_agent_utils(self, bridge_name, job_id, job_events, secrets):
         config = self.container_utils['agent-utilities']
-        std_out = docker('pull ' + config['container'])
-        print(std_out)
 
         env = self.env_variable( 'ASPNETCORE_URLS', f'http://*:{config["port"]}')
         for s in secrets:
@@ -335,7 +1287,7 @@ class RaftLocalCLI():
         mounts = self.mount_read_only((os.path.join(script_dir, "raft-tools")), "/raft-tools")
         mounts += self.mount_read_write(job_events, '/raft-events-sink')
 
-        cmd = self.docker_run_cmd(
+        spec = self.docker_run_spec(
                 container=config['container'],
                 container_name=container_name,
                 mounts=mounts,
@@ -345,9 +1297,7 @@ class RaftLocalCLI():
                 run_cmd=None,
                 bridge_name=bridge_name)
 
-        print(f"Running docker with command : {cmd}")
-        out = docker(cmd)
-        print(out)
+        self.run_containers([spec])
         if bridge_name == 'host':
             return container_name, 'localhost', config['port']
         else:
@@ -359,14 +1309,11 @@ class RaftLocalCLI():
         test_services_startup_delay = 0
         testTargets = job_config.config.get('testTargets')
         test_target_container_names = []
+        run_specs = []
         post_run_wait = 0
         if testTargets:
             services = testTargets.get('services')
             if services:
-                for service in services:
-                    std_out = docker('pull ' + service['container'])
-                    print(std_out)
-
                 for service in services:
                     d = service.get('ExpectedDurationUntilReady')
                     if d:
@@ -430,18 +1377,14 @@ class RaftLocalCLI():
                     #when using bridge networking - no need to expose ports,
                     #since those are accessible from within the network to other
                     #containers
-                    #expose_ports = ''
-                    #ports = service.get('Ports')
-                    #if ports:
-                    #    for port in ports:
-                    #        expose_ports += f'--publish {port}:{port}/tcp '
+                    #expose_ports = service.get('Ports')
 
                     if not run_cmd:
                         run_cmd = None
                         shell = None
 
                     container_name = f'raft-service-{job_id}-{task_index}'
-                    cmd = self.docker_run_cmd(
+                    spec = self.docker_run_spec(
                             container=service['container'],
                             container_name=container_name,
                             mounts=mounts,
@@ -451,11 +1394,10 @@ class RaftLocalCLI():
                             run_cmd=run_cmd,
                             bridge_name=bridge_name)
                     test_target_container_names.append(container_name)
-                    print(f"Running docker with command : {cmd}")
-                    out = docker(cmd)
-                    print(out)
+                    run_specs.append(spec)
                     task_index += 1
 
+        self.run_containers(run_specs)
         return task_index, test_services_startup_delay,\
                 test_target_container_names, post_run_wait
 
@@ -479,11 +1421,9 @@ class RaftLocalCLI():
             for testTask in testTasks['tasks']:
                 # Record in telemetry that we are using a particular tool
                 self.logger.info("Created", extra=self.log_telemetry("Task: " + testTask['toolName'], "task", 1))
-                config = self.tools[testTask['toolName']]
-                std_out = docker('pull ' + config['container'])
-                print(std_out)
 
         test_tasks_container_names = []
+        run_specs = []
         if testTasks.get('tasks'):
             target_config = testTasks.get('targetConfiguration')
             if target_config:
@@ -562,7 +1502,7 @@ class RaftLocalCLI():
                 container_name = f'raft-{testTask["toolName"]}-{job_id}-{task_index}'
 
                 # add command to execute
-                cmd = self.docker_run_cmd(
+                spec = self.docker_run_spec(
                         container=config['container'],
                         container_name=container_name,
                         mounts=mounts,
@@ -573,13 +1513,12 @@ class RaftLocalCLI():
                         bridge_name=bridge_name
                     )
                 test_tasks_container_names.append(container_name)
-                print(f"Running docker with command : {cmd}")
-                out = docker(cmd)
-                print(out)
+                run_specs.append(spec)
                 task_index += 1
         else:
             raise Exception("Test tasks are missing from job config")
 
+        self.run_containers(run_specs)
         return test_tasks_container_names
 
 
@@ -587,8 +1526,7 @@ class RaftLocalCLI():
         if len(containers) == 0:
             return True, True, []
         else:
-            container_info = docker('container inspect ' + ' '.join(containers))
-            infos = json.loads(container_info)
+            infos = self.docker.inspect(containers)
             all_exited = True
             any_exited = False
             for j in infos:
@@ -603,80 +1541,154 @@ class RaftLocalCLI():
             print(f"-------------------------- LOGS for [{c}] -------------------")
             print()
             print()
-            stdout = docker(f'logs {c} --tail 64')
+            stdout = self.docker.logs(c, 64)
             print(stdout)
 
+    def check_supervised_containers(self, service_containers, raft_utilities, exited=None):
+        '''
+            Raises an exception if any of the service or RAFT utilities
+            containers exited.
+
+            Parameters:
+                service_containers: test target container names
+                raft_utilities: RAFT utilities container names
+                exited: set of names of containers known to have exited.
+                        If None, then containers are inspected
+        '''
+        if service_containers and len(service_containers) > 0:
+            if exited is None:
+                _, service_any_exited, _ = self.check_containers_exited(service_containers)
+            else:
+                service_any_exited = any(c in exited for c in service_containers)
+            if service_any_exited:
+                self.print_logs(service_containers)
+                raise RaftLocalException("At least one service container exited\
+                                        before the end of the job run")
+
+        if raft_utilities and len(raft_utilities) > 0:
+            if exited is None:
+                _, raft_utilities_any_exited, _ = self.check_containers_exited(raft_utilities)
+            else:
+                raft_utilities_any_exited = any(c in exited for c in raft_utilities)
+            if raft_utilities_any_exited:
+                self.print_logs(raft_utilities)
+                raise RaftLocalException("At least one RAFT utilities container exited\
+                                        before the end of the job run")
+
     def wait_for_container_termination(self, containers, service_containers,\
         raft_utilities,\
-        job_events_path, duration, metadata, job_status_webhook_url,\
+        job_id, duration, metadata, job_status_webhook_url,\
         bug_found_webhook_url):
         saved_duration = duration
         print('Waiting for containers: ' + '; '.join(containers))
         wait_seconds = 5
-        while(True):
-            if service_containers and len(service_containers) > 0:
-                _, service_any_exited, _ = self.check_containers_exited(service_containers)
-                if service_any_exited:
-                    self.print_logs(service_containers)
-                    raise RaftLocalException("At least one service container exited\
-                                            before the end of the job run")
-
-            if raft_utilities and len(raft_utilities) > 0:
-                _, raft_utilities_any_exited, _ = self.check_containers_exited(raft_utilities)
-                if raft_utilities_any_exited:
-                    self.print_logs(raft_utilities)
-                    raise RaftLocalException("At least one RAFT utilities container exited\
-                                            before the end of the job run")
-
-            all_exited, _, infos = self.check_containers_exited(containers)
-            if all_exited:
-                # Some status and bugs are not processed once the tasks finish
-                # so process them now
-                self.process_job_events_sink(job_events_path)
-                print_status(self.status)
-
-                # Trigger bug found webhook for all the bugs we found.
-                # Since self.bugs is a cumulative list of bugs found, just trigger
-                # the webhooks once at the end of the run so there aren't multiple triggers
-                # happening.
-                if bug_found_webhook_url:
-                    for bug in self.bugs:
-                        trigger_webhook(bug_found_webhook_url, [bug], metadata)
-
-                exit_infos = []
-                for j in infos:
-                    exit_infos.append(
-                            {
-                                'Name': j['Name'],
-                                'Status': j['State']['Status'],
-                                'ExitCode': j['State']['ExitCode'],
-                                'ErrorMessage': j['State']['Error']
-                            })
-                return exit_infos
-            else:
-                self.process_job_events_sink(job_events_path)
-                print_status(self.status)
-
-                # Trigger job status webhook
-                if job_status_webhook_url:
-                    for k in self.status:
-                        trigger_webhook(job_status_webhook_url, [{'Message' : k}], metadata)
-
-                time.sleep(wait_seconds)
-                if duration:
-                    duration = duration - wait_seconds
-                    if duration <= 0:
+        # containers are inspected every this many cycles, in case
+        # an exit was missed by the events stream
+        inspect_cycles = 12
+        deadline = None
+        if duration:
+            deadline = time.monotonic() + duration
+
+        watcher = None
+        if self.supervision == 'events':
+            # events stream replays exits since before the first inspect,
+            # so containers exiting while the stream is being established
+            # are not missed. Second resolution, one second of margin.
+            since = int(time.time()) - 1
+            try:
+                watcher = DockerEventsWatcher(self.docker,
+                    containers + (service_containers or []) + (raft_utilities or []),
+                    since)
+            except (OSError, http.client.HTTPException, RaftLocalCliDockerException) as ex:
+                print(f'Failed to follow docker events due to {ex}. Falling back to polling')
+
+        # The first pass always inspects the containers.
+        dispatcher = None
+        if job_status_webhook_url or bug_found_webhook_url:
+            dispatcher = WebhookDispatcher(metadata)
+
+        exited = None
+        previous_status = None
+        cycle = 0
+        try:
+            while(True):
+                cycle += 1
+                if exited is not None and cycle % inspect_cycles == 0:
+                    exited = None
+                if exited is None:
+                    self.check_supervised_containers(service_containers, raft_utilities)
+                    all_exited, _, infos = self.check_containers_exited(containers)
+                    if watcher:
+                        exited = set(i['Name'].lstrip('/') for i in infos if not i['State']['Running'])
+                else:
+                    exited.update(watcher.wait_for_exits(wait_seconds))
+                    if watcher.closed:
+                        print('Docker events stream closed. Falling back to polling')
+                        watcher.stop()
+                        watcher = None
+                        exited = None
+                        continue
+                    self.check_supervised_containers(service_containers, raft_utilities, exited)
+                    all_exited = all(c in exited for c in containers)
+                    if all_exited:
+                        _, _, infos = self.check_containers_exited(containers)
+
+                if all_exited:
+                    # Some status and bugs are not processed once the tasks finish
+                    # so process them now
+                    self.process_job_events_sink(job_id, full_scan=True)
+                    print_status(self.status)
+
+                    # Trigger bug found webhook for all the bugs we found.
+                    # Since self.bugs is a cumulative store of bugs found, just trigger
+                    # the webhooks once at the end of the run so there aren't multiple triggers
+                    # happening. Bugs are streamed from the store on disk.
+                    if bug_found_webhook_url and self.bugs is not None:
+                        for bug in self.bugs:
+                            dispatcher.post_bug(bug_found_webhook_url, bug)
+
+                    exit_infos = []
+                    for j in infos:
+                        exit_infos.append(
+                                {
+                                    'Name': j['Name'],
+                                    'Status': j['State']['Status'],
+                                    'ExitCode': j['State']['ExitCode'],
+                                    'ErrorMessage': j['State']['Error']
+                                })
+                    return exit_infos
+                else:
+                    self.process_job_events_sink(job_id)
+                    changes = status_diff(previous_status, self.status)
+                    if changes:
+                        print_status_diff(changes)
+                        previous_status = status_by_agent(self.status)
+
+                    # Trigger job status webhook
+                    if job_status_webhook_url:
+                        for k in self.status:
+                            dispatcher.post_status(job_status_webhook_url, k)
+
+                    if not watcher:
+                        time.sleep(wait_seconds)
+                    if deadline and time.monotonic() >= deadline:
                         print(f'Job run exceeded duration of {saved_duration} seconds. Exiting...')
                         return None
+        finally:
+            if watcher:
+                watcher.stop()
+            if dispatcher:
+                print(f'Waiting for {dispatcher.queue_depth()} webhook events to be delivered')
+                print(f'Webhook delivery: {dispatcher.close()}')
 
     def job_status(self, job_id):
-        job_events_path = os.path.join(self.events_sink, job_id)
-        self.process_job_events_sink(job_events_path)
+        # events sink is scanned, so that querying many jobs
+        # does not keep an inotify descriptor open per job
+        self.process_job_events_sink(job_id, watch=False)
         return self.status
 
     def post_run(self, containers):
-        container_info = docker('container inspect ' + ' '.join(containers))
-        infos = json.loads(container_info)
+        infos = self.docker.inspect(containers)
 
         container_info = {}
         for info in infos:
@@ -689,7 +1701,7 @@ class RaftLocalCLI():
         for container in containers:
             pr = container_info.get("/" + container)
             if pr:
-                stdout = docker(f'container exec -t --user="root" --privileged {container} ' + pr)
+                stdout = self.docker.exec(container, pr)
                 print(stdout)
 
 
@@ -710,23 +1722,29 @@ class RaftLocalCLI():
 
         os.mkdir(job_dir)
         print(f"------------------------  Job results: {job_dir}")
+        self.job_dirs[job_id] = job_dir
+        self.bugs = self.bug_store(job_id)
         work_dir = '/work_dir_' + job_id
         test_task_container_names = []
         test_target_container_names = []
         agent_utils = None
         try:
             bridge_name = self.docker_create_bridge(self.network, job_id)
-            agent_utils, agent_utils_endpoint, agent_utils_port = self.start_agent_utils(bridge_name, job_id,\
-                job_events, self.secrets_to_import(job_config))
+            self.timed_phase('Pull images', self.pull_images, self.job_images(job_config))
+
+            agent_utils, agent_utils_endpoint, agent_utils_port =\
+                self.timed_phase('Start agent utilities', self.start_agent_utils,\
+                bridge_name, job_id, job_events, self.secrets_to_import(job_config))
 
             task_index, test_services_startup_delay, test_target_container_names, post_run_wait =\
-                self.start_test_targets(job_config, job_id,\
-                work_dir, job_dir, bridge_name)
+                self.timed_phase('Start test targets', self.start_test_targets,\
+                job_config, job_id, work_dir, job_dir, bridge_name)
 
             test_task_container_names =\
-                self.start_test_tasks(job_config, task_index,\
-                test_services_startup_delay, job_id, work_dir,\
+                self.timed_phase('Start test tasks', self.start_test_tasks,\
+                job_config, task_index, test_services_startup_delay, job_id, work_dir,\
                 job_dir, job_events, bridge_name, f'http://{agent_utils_endpoint}:{agent_utils_port}')
+            self.print_phase_timings()
 
             duration = None
             if job_config.config.get('duration'):
@@ -742,7 +1760,7 @@ class RaftLocalCLI():
 
             stats = self.wait_for_container_termination(test_task_container_names,\
                         test_target_container_names, [agent_utils],\
-                        job_events, duration, metadata,\
+                        job_id, duration, metadata,\
                         job_status_webhook_url, bug_found_webhook_url)
             if stats:
                 print(stats)
@@ -777,6 +1795,7 @@ class RaftLocalCLI():
             except Exception as ex:
                 print(f'Failed to stop agent utilities due to {ex}')
 
+            self.close_job_events_sink(job_id)
             self.log_bugs_per_tool()
 
             print("Job finished, cleaning up job containers")
@@ -821,7 +1840,11 @@ def run(args):
         print(f'Created events_sink folder: {event_sink}')
 
     if job_action == 'create':
-        cli = RaftLocalCLI(network=args.get('network'), telemetry=args.get('no_telemetry'))
+        cli = RaftLocalCLI(network=args.get('network'),
+                           telemetry=args.get('no_telemetry'),
+                           supervision=args.get('supervision'),
+                           pull_policy=args.get('pull_policy'),
+                           backend=args.get('docker_backend'))
         json_config_path = args.get('file')
         if json_config_path is None:
             ArgumentRequired('--file')
@@ -915,6 +1938,48 @@ bridge - create a network-bridge with a random name.
 This allows running of multiple jobs in parallel on the same device.
         '''))
 
+    job_parser.add_argument(
+        '--supervision',
+        choices=['events', 'poll'],
+        default='events',
+        help=textwrap.dedent('''\
+Select how job containers are supervised. If not set then 'events' is used.
+
+events - follow the docker events stream and react to containers
+exiting as soon as it happens. Falls back to 'poll' if the stream is not available.
+
+poll - inspect containers every 5 seconds.
+        '''))
+
+    job_parser.add_argument(
+        '--pull-policy',
+        choices=['always', 'missing'],
+        default='always',
+        help=textwrap.dedent('''\
+Select when container images are pulled. If not set then 'always' is used.
+
+always - pull every image used by the job. Images pinned by digest
+are only pulled when they are missing locally.
+
+missing - only pull images that are missing locally.
+        '''))
+
+    job_parser.add_argument(
+        '--docker-backend',
+        choices=['auto', 'engine', 'cli'],
+        default='auto',
+        help=textwrap.dedent('''\
+Select how raft_local.py talks to docker. If not set then 'auto' is used.
+
+auto - use the Docker Engine API if the docker unix socket is available,
+otherwise use the docker CLI.
+
+engine - use the Docker Engine API over the docker unix socket
+(DOCKER_HOST if it is set to a unix:// address, otherwise /var/run/docker.sock).
+
+cli - run the docker CLI for every operation.
+        '''))
+
     job_parser.add_argument(
         '--no-telemetry',
         action='store_false',
@@ -8,8 +8,12 @@ import string
 from pathlib import Path
 import time
 import json
+import copy
 import yaml
 import shutil
+import threading
+from collections import OrderedDict
+from requests.adapters import HTTPAdapter
 
 script_dir = os.path.dirname(os.path.abspath(__file__))
 cache_dir = os.path.join(str(Path.home()), '.cache', 'raft')
@@ -42,36 +46,108 @@ def get_version():
         return ''
 
 class RaftJsonDict(dict):
-    def __init__(self):
-        super(RaftJsonDict, self).__init__()
+    '''
+        Dictionary with case-insensitive lookup of string keys.
+
+        Keys keep the casing they were first inserted with. Exact-case
+        lookups go straight to the dictionary; other lookups use an index
+        of lowered keys which is built on first use and kept up to date
+        by every mutating method, so no lookup scans all of the keys.
+    '''
+    lowered_keys = None
+
+    def index(self):
+        if self.lowered_keys is None:
+            # built in reverse so that the first of several keys
+            # differing only in casing wins
+            self.lowered_keys = {k.lower(): k for k in reversed(dict.keys(self))
+                                 if isinstance(k, str)}
+        return self.lowered_keys
+
+    def stored_key(self, key):
+        if dict.__contains__(self, key) or not isinstance(key, str):
+            return key
+        if self.lowered_keys is None:
+            self.index()
+        return self.lowered_keys.get(key.lower(), key)
+
+    def unindex(self, key):
+        if self.lowered_keys is not None and isinstance(key, str):
+            lowered = key.lower()
+            if self.lowered_keys.get(lowered) == key:
+                del self.lowered_keys[lowered]
 
     def __getitem__(self, key):
-        for k in self.keys():
-            if k.lower() == key.lower():
-                key = k
-                break
-        return super(RaftJsonDict, self).__getitem__(key)
-
-    def pop(self, key):
-        for k in self.keys():
-            if k.lower() == key.lower():
-                key = k
-                break
-        return super(RaftJsonDict, self).pop(key)
-
-    def get(self, key):
-        for k in self.keys():
-            if k.lower() == key.lower():
-                key = k
-                break
-        return super(RaftJsonDict, self).get(key)
+        return dict.__getitem__(self, self.stored_key(key))
+
+    def __setitem__(self, key, value):
+        key = self.stored_key(key)
+        if isinstance(key, str) and not dict.__contains__(self, key):
+            self.index()[key.lower()] = key
+        dict.__setitem__(self, key, value)
+
+    def __delitem__(self, key):
+        key = self.stored_key(key)
+        dict.__delitem__(self, key)
+        self.unindex(key)
+
+    def __contains__(self, key):
+        return dict.__contains__(self, self.stored_key(key))
+
+    def get(self, key, default=None):
+        return dict.get(self, self.stored_key(key), default)
+
+    def pop(self, key, *default):
+        key = self.stored_key(key)
+        self.unindex(key)
+        return dict.pop(self, key, *default)
+
+    def popitem(self):
+        key, value = dict.popitem(self)
+        self.unindex(key)
+        return key, value
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def update(self, *args, **kwargs):
+        if args:
+            other = args[0]
+            if hasattr(other, 'keys'):
+                for k in other.keys():
+                    self[k] = other[k]
+            else:
+                for k, v in other:
+                    self[k] = v
+        for k in kwargs:
+            self[k] = kwargs[k]
+
+    def clear(self):
+        dict.clear(self)
+        self.lowered_keys = None
+
+    def copy(self):
+        return RaftJsonDict(self)
+
+    def __copy__(self):
+        return self.copy()
+
+    def __deepcopy__(self, memo):
+        r = RaftJsonDict()
+        memo[id(self)] = r
+        for k in dict.keys(self):
+            dict.__setitem__(r, copy.deepcopy(k, memo),
+                             copy.deepcopy(dict.__getitem__(self, k), memo))
+        return r
+
+    def __reduce__(self):
+        return (RaftJsonDict, (dict(self),))
 
     @staticmethod
     def raft_json_object_hook(x):
-        r = RaftJsonDict()
-        for k in x:
-            r[k] = x[k]
-        return r
+        return RaftJsonDict(x)
 
 
 def delete_token_cache():
@@ -135,8 +211,58 @@ class RaftApiException(Exception):
         self.status_code = status_code
 
 
+class AuthHeaderCache():
+    '''
+        Bounded in-memory cache of authorization headers.
+
+        Headers are reused until the token is within refresh_margin seconds
+        of expiring, so MSAL is only consulted when a refresh is due.
+    '''
+    def __init__(self, max_size=16, refresh_margin=300):
+        self.max_size = max_size
+        self.refresh_margin = refresh_margin
+        self.headers = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.refreshes = 0
+
+    def get(self, client_id, tenant_id, secret):
+        key = (client_id, tenant_id, secret)
+        with self.lock:
+            cached = self.headers.get(key)
+            if cached and cached['expires_on'] - self.refresh_margin > time.time():
+                self.headers.move_to_end(key)
+                self.hits += 1
+                return cached['header']
+
+            token = get_auth_token(client_id, tenant_id, secret)
+            if 'error_description' in token:
+                raise RaftApiException(token['error_description'], 400)
+
+            header = {
+                'Authorization': f"{token['token_type']} {token['access_token']}"
+            }
+            self.headers[key] = {
+                'header': header,
+                'expires_on': time.time() + int(token.get('expires_in', 0))
+            }
+            self.headers.move_to_end(key)
+            while len(self.headers) > self.max_size:
+                self.headers.popitem(last=False)
+            self.refreshes += 1
+            return header
+
+    def invalidate(self, client_id, tenant_id, secret):
+        with self.lock:
+            self.headers.pop((client_id, tenant_id, secret), None)
+
+
+auth_header_cache = AuthHeaderCache()
+
+
 class RestApiClient():
-    def __init__(self, endpoint, client_id, tenant_id, secret):
+    def __init__(self, endpoint, client_id, tenant_id, secret,
+                 pool_maxsize=10):
         self.endpoint = endpoint
         self.client_id = client_id
         self.tenant_id = tenant_id
@@ -144,59 +270,80 @@ class RestApiClient():
 
         self.retry_status_code = [503]
 
+        # Single keep-alive session, so repeated calls to the service
+        # reuse TLS connections instead of doing a handshake per request
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_maxsize)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.request_count = 0
+
     def auth_header(self):
-        token = get_auth_token(self.client_id, self.tenant_id, self.secret)
-        if 'error_description' in token:
-            raise RaftApiException(token['error_description'], 400)
-        return {
-            'Authorization': f"{token['token_type']} {token['access_token']}"
-            }
+        return auth_header_cache.get(
+                    self.client_id, self.tenant_id, self.secret)
+
+    def request(self, method, relative_url, json_data=None,
+                seconds_to_wait=10):
+        while True:
+            self.request_count += 1
+            response = self.session.request(
+                method,
+                self.endpoint + relative_url,
+                json=json_data,
+                headers=self.auth_header())
+            if response.status_code == 401:
+                # token might have been revoked before its expiry time
+                auth_header_cache.invalidate(
+                    self.client_id, self.tenant_id, self.secret)
+            if (response.status_code in self.retry_status_code and
+                    seconds_to_wait > 0.0):
+                time.sleep(2.0)
+                seconds_to_wait -= 2.0
+            else:
+                return response
 
     def post(self, relative_url, json_data, seconds_to_wait=10):
-        response = requests.post(
-            self.endpoint + relative_url,
-            json=json_data,
-            headers=self.auth_header())
-        if (response.status_code in self.retry_status_code and
-                seconds_to_wait > 0.0):
-            time.sleep(2.0)
-            return self.post(relative_url, json_data, seconds_to_wait-2.0)
-        else:
-            return response
+        return self.request('POST', relative_url, json_data, seconds_to_wait)
 
     def put(self, relative_url, json_data, seconds_to_wait=10):
-        response = requests.put(
-            self.endpoint + relative_url,
-            json=json_data,
-            headers=self.auth_header())
-        if (response.status_code in self.retry_status_code and
-                seconds_to_wait > 0.0):
-            time.sleep(2.0)
-            return self.put(relative_url, json_data, seconds_to_wait-2.0)
-        else:
-            return response
+        return self.request('PUT', relative_url, json_data, seconds_to_wait)
 
     def delete(self, relative_url, seconds_to_wait=10):
-        response = requests.delete(
-            self.endpoint + relative_url,
-            headers=self.auth_header())
-        if (response.status_code in self.retry_status_code and
-                seconds_to_wait > 0.0):
-            time.sleep(2.0)
-            return self.delete(relative_url, seconds_to_wait-2.0)
-        else:
-            return response
+        return self.request('DELETE', relative_url, None, seconds_to_wait)
 
     def get(self, relative_url, seconds_to_wait=10):
-        response = requests.get(
-            self.endpoint + relative_url,
-            headers=self.auth_header())
-        if (response.status_code in self.retry_status_code and
-                seconds_to_wait > 0.0):
-            time.sleep(2.0)
-            return self.get(relative_url, seconds_to_wait-2.0)
+        return self.request('GET', relative_url, None, seconds_to_wait)
+
+    def transport_stats(self):
+        '''
+            Connection pool and token cache counters
+
+            Returns:
+                Dictionary with number of requests made by this client,
+                number of connections opened, connection reuse rate
+                and token cache hits and refreshes
+        '''
+        connections = 0
+        for adapter in set(self.session.adapters.values()):
+            for key in adapter.poolmanager.pools.keys():
+                pool = adapter.poolmanager.pools[key]
+                connections += pool.num_connections
+
+        if self.request_count > 0:
+            reuse_rate = 1.0 - min(connections, self.request_count) / self.request_count
         else:
-            return response
+            reuse_rate = 0.0
+
+        return {
+            'requests': self.request_count,
+            'connections': connections,
+            'connection_reuse_rate': reuse_rate,
+            'token_cache_hits': auth_header_cache.hits,
+            'token_refreshes': auth_header_cache.refreshes
+        }
+
+    def close(self):
+        self.session.close()
 
 
 class RaftDefinitions():
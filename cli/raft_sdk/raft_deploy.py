@@ -5,15 +5,24 @@ import json
 import hashlib
 import os
 import pathlib
+import re
+import shlex
+import shutil
 import sys
 import string
 import subprocess
+import threading
 import time
 import uuid
 
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from datetime import datetime, timedelta, timezone
 from subprocess import PIPE
+from urllib.parse import quote
+from xml.etree import ElementTree
 
 import requests
+from requests.adapters import HTTPAdapter
 from .raft_common import RaftApiException, RestApiClient, RaftDefinitions, RaftJsonDict
 
 script_dir = os.path.dirname(os.path.abspath(__file__))
@@ -22,6 +31,10 @@ if not os.path.isdir(tmp_dir):
     os.mkdir(tmp_dir)
 
 dos2unix_file_types = [".sh", ".bash"]
+# Content hashes of the files in the tools file share,
+# stored in the root of the share
+tools_manifest_name = '.raft-tools-manifest.json'
+arm_endpoint = 'https://management.azure.com'
 
 
 class RaftAzCliException(Exception):
@@ -35,21 +48,539 @@ class RaftAzCliException(Exception):
                 f"std error: {self.error_message}")
 
 
-def az(args):
-    r = subprocess.run("az " + args, shell=True, stdout=PIPE, stderr=PIPE)
-    stdout = r.stdout.decode()
-    stderr = r.stderr.decode()
+class AzCliBackend():
+    '''
+        Runs every command with the az CLI, one process per command.
+        Commands run one at a time, az CLI processes share the
+        login and configuration files and are not safe to run
+        concurrently.
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+
+    def run(self, args):
+        with self.lock:
+            r = subprocess.run("az " + args, shell=True, stdout=PIPE, stderr=PIPE)
+        stdout = r.stdout.decode()
+        stderr = r.stderr.decode()
+
+        if stderr and not stdout:
+            raise RaftAzCliException(stderr, r.args)
+        else:
+            return stdout
+
+
+def parse_az_args(args):
+    '''
+        Splits az command arguments into the command and its options
+
+        Returns:
+            (list of command words, dictionary of option name to
+            list of option values)
+    '''
+    def unquote(w):
+        if len(w) >= 2 and w[0] == w[-1] and w[0] in '"\'':
+            return w[1:-1]
+        return w
+
+    # posix=False keeps backslashes of Windows paths
+    words = [unquote(w) for w in shlex.split(args, posix=False)]
+    command = []
+    options = {}
+    option = None
+    for w in words:
+        if w.startswith('--'):
+            option = w[2:]
+            options[option] = []
+        elif option is None:
+            command.append(w)
+        else:
+            options[option].append(w)
+    return command, options
+
+
+# App Service plan pricing tiers by SKU name prefix
+app_service_plan_tiers = [
+    ('PC', 'PremiumContainer'), ('P', 'PremiumV2'), ('B', 'Basic'),
+    ('S', 'Standard'), ('I', 'Isolated'), ('D', 'Shared'), ('F', 'Free')]
+
+
+class ArmBackend():
+    '''
+        Runs the az commands used by the deployment as Azure Resource
+        Manager REST calls over one pooled, authenticated session,
+        instead of starting an az process per command.
+        Commands without an ARM equivalent here, such as data plane
+        and Active Directory commands, fall back to the az CLI.
+    '''
+    def __init__(self, subscription, endpoint=arm_endpoint,
+                 token=None, fallback=None, pool_maxsize=10, request_timeout=60):
+        '''
+            Parameters:
+                subscription: default subscription ID
+                endpoint: Azure Resource Manager endpoint
+                token: bearer token to use. If not set, the token of the
+                       account the az CLI is logged in with is used.
+                fallback: backend for commands that are not ARM calls
+                pool_maxsize: maximum number of pooled connections
+                request_timeout: seconds to wait for a response of
+                                 a request
+        '''
+        self.subscription = subscription
+        self.endpoint = endpoint.rstrip('/')
+        self.fallback = fallback or AzCliBackend()
+
+        self.token = token
+        self.token_expiry = float('inf') if token else 0
+        self.token_lock = threading.Lock()
+
+        self.retry_status_code = [429, 503]
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_maxsize)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.request_timeout = request_timeout
+        self.stats_lock = threading.Lock()
+        self.request_count = 0
+        self.fallback_count = 0
+
+        self.commands = {
+            ('group', 'create'): self.group_create,
+            ('storage', 'account', 'create'): self.storage_account_create,
+            ('storage', 'account', 'show-connection-string'):
+                self.storage_account_connection_string,
+            ('servicebus', 'namespace', 'create'): self.servicebus_namespace_create,
+            ('servicebus', 'namespace', 'authorization-rule', 'create'):
+                self.servicebus_authorization_rule_create,
+            ('servicebus', 'namespace', 'authorization-rule', 'keys', 'list'):
+                self.servicebus_authorization_rule_keys,
+            ('servicebus', 'queue', 'create'): self.servicebus_queue_create,
+            ('servicebus', 'topic', 'create'): self.servicebus_topic_create,
+            ('servicebus', 'topic', 'authorization-rule', 'create'):
+                self.servicebus_authorization_rule_create,
+            ('servicebus', 'topic', 'authorization-rule', 'keys', 'list'):
+                self.servicebus_authorization_rule_keys,
+            ('servicebus', 'topic', 'subscription', 'create'):
+                self.servicebus_subscription_create,
+            ('eventgrid', 'domain', 'create'): self.eventgrid_domain_create,
+            ('eventgrid', 'domain', 'show'): self.eventgrid_domain_show,
+            ('eventgrid', 'domain', 'key', 'list'): self.eventgrid_domain_keys,
+            ('appservice', 'plan', 'create'): self.app_service_plan_create,
+            ('functionapp', 'config', 'appsettings', 'list'): self.appsettings_list,
+            ('webapp', 'config', 'appsettings', 'list'): self.appsettings_list,
+            ('functionapp', 'config', 'appsettings', 'set'): self.appsettings_set,
+            ('webapp', 'config', 'appsettings', 'set'): self.appsettings_set,
+            ('functionapp', 'restart'): self.site_restart,
+            ('webapp', 'restart'): self.site_restart,
+            ('provider', 'register'): self.provider_register,
+            ('rest',): self.rest
+        }
+
+    def run(self, args):
+        try:
+            command, options = parse_az_args(args)
+        except ValueError:
+            command, options = None, None
+
+        handler = self.commands.get(tuple(command or []))
+        if handler is None:
+            with self.stats_lock:
+                self.fallback_count += 1
+            return self.fallback.run(args)
+
+        result = handler(options, args)
+        if result is None:
+            return ''
+        return json.dumps(result)
+
+    def access_token(self):
+        with self.token_lock:
+            # refresh tokens 5 minutes before they expire
+            if time.time() > self.token_expiry - 300:
+                token = json.loads(self.fallback.run(
+                    'account get-access-token'
+                    f' --resource {arm_endpoint}/ --output json'))
+                self.token = token['accessToken']
+                if token.get('expires_on'):
+                    self.token_expiry = float(token['expires_on'])
+                else:
+                    self.token_expiry = datetime.strptime(
+                        token['expiresOn'], '%Y-%m-%d %H:%M:%S.%f').timestamp()
+            return self.token
+
+    def invalidate_token(self):
+        with self.token_lock:
+            self.token_expiry = 0
+
+    def error(self, response, args):
+        try:
+            error = response.json()['error']
+            message = f"({error['code']}) {error['message']}"
+        except (ValueError, KeyError, TypeError):
+            message = f'({response.status_code}) {response.text}'
+        return RaftAzCliException(message, args)
+
+    def send(self, method, url, body, args, seconds_to_wait=30):
+        retried_unauthorized = False
+        while True:
+            with self.stats_lock:
+                self.request_count += 1
+            try:
+                response = self.session.request(
+                                method, url, json=body,
+                                headers={'Authorization': f'Bearer {self.access_token()}'},
+                                timeout=self.request_timeout)
+            except requests.ConnectionError as ex:
+                # pooled connections can be reset, ARM requests are idempotent
+                if seconds_to_wait <= 0.0:
+                    raise RaftAzCliException(f'{ex}', args)
+                print(f'Failed to connect to {url}: {ex}. Trying again...')
+                time.sleep(2.0)
+                seconds_to_wait -= 2.0
+                continue
+            except requests.Timeout as ex:
+                raise RaftAzCliException(f'{ex}', args)
+
+            if response.status_code == 401 and not retried_unauthorized:
+                # token might have been revoked before its expiry time
+                self.invalidate_token()
+                retried_unauthorized = True
+            elif (response.status_code in self.retry_status_code and
+                    seconds_to_wait > 0.0):
+                delay = float(response.headers.get('Retry-After', 2))
+                time.sleep(delay)
+                seconds_to_wait -= delay
+            elif response.status_code >= 400:
+                raise self.error(response, args)
+            else:
+                return response
+
+    def wait_for_operation(self, response, args):
+        '''
+            Polls a long running operation started by the response
+            until it completes
+
+            Returns:
+                Final response of the operation, or None if the resource
+                has to be read again to get the result
+        '''
+        async_operation = response.headers.get('Azure-AsyncOperation')
+        location = response.headers.get('Location')
+        delay = float(response.headers.get('Retry-After', 1))
+        while async_operation or location:
+            time.sleep(delay)
+            r = self.send('GET', async_operation or location, None, args)
+            delay = float(r.headers.get('Retry-After', delay))
+            if async_operation:
+                status = r.json().get('status')
+                if status in ['Failed', 'Canceled']:
+                    raise self.error(r, args)
+                if status == 'Succeeded':
+                    if location:
+                        return self.send('GET', location, None, args)
+                    return None
+            elif r.status_code != 202:
+                return r
+
+    def request(self, method, path, body=None, args=None):
+        url = path if path.startswith('http') else self.endpoint + path
+        response = self.send(method, url, body, args)
+        if response.status_code in [201, 202]:
+            final = self.wait_for_operation(response, args)
+            if final is not None:
+                response = final
+            elif method == 'PUT':
+                response = self.send('GET', url, None, args)
+
+        result = response.json() if response.content else None
+        if method == 'PUT':
+            # some resources are still provisioning when the request completes
+            state = ((result or {}).get('properties') or {}).get('provisioningState')
+            while state and state not in ['Succeeded', 'Failed', 'Canceled']:
+                time.sleep(2.0)
+                result = self.send('GET', url, None, args).json()
+                state = result['properties'].get('provisioningState')
+            if state in ['Failed', 'Canceled']:
+                raise RaftAzCliException(
+                    f'Provisioning of {path} ended with state {state}', args)
+        return result
+
+    def resource_path(self, options, provider, *names, api_version):
+        subscription = self.option(options, 'subscription') or self.subscription
+        path = (f'/subscriptions/{subscription}'
+                f'/resourceGroups/{self.option(options, "resource-group")}'
+                f'/providers/{provider}')
+        for n in names:
+            path += f'/{n}'
+        return f'{path}?api-version={api_version}'
+
+    @staticmethod
+    def option(options, name, default=None):
+        values = options.get(name)
+        if not values:
+            return default
+        return ' '.join(values)
+
+    @staticmethod
+    def flag(options, name):
+        return name in options and options[name] in [[], ['true']]
+
+    @staticmethod
+    def flatten(resource):
+        # az CLI shows the properties of most resources at the top level
+        flat = dict(resource)
+        flat.update(resource.get('properties') or {})
+        return flat
+
+    def group_create(self, options, args):
+        subscription = self.option(options, 'subscription') or self.subscription
+        return self.request(
+            'PUT',
+            f'/subscriptions/{subscription}'
+            f'/resourcegroups/{self.option(options, "name")}'
+            '?api-version=2021-04-01',
+            {'location': self.option(options, 'location')},
+            args)
+
+    def storage_account_create(self, options, args):
+        path = self.resource_path(
+                    options, 'Microsoft.Storage', 'storageAccounts',
+                    self.option(options, 'name'), api_version='2021-04-01')
+        body = {
+            'location': self.option(options, 'location'),
+            'sku': {'name': self.option(options, 'sku', 'Standard_RAGRS')},
+            'kind': self.option(options, 'kind', 'StorageV2'),
+            'properties': {
+                'supportsHttpsTrafficOnly': self.flag(options, 'https-only')
+            }
+        }
+        return self.request('PUT', path, body, args)
+
+    def storage_account_connection_string(self, options, args):
+        name = self.option(options, 'name')
+        path = self.resource_path(
+                    options, 'Microsoft.Storage', 'storageAccounts',
+                    name, 'listKeys', api_version='2021-04-01')
+        keys = self.request('POST', path, None, args)
+        connection_string = ('DefaultEndpointsProtocol=https;'
+                             'EndpointSuffix=core.windows.net;'
+                             f'AccountName={name};'
+                             f'AccountKey={keys["keys"][0]["value"]}')
+        if self.option(options, 'query') == 'connectionString':
+            return connection_string
+        return {'connectionString': connection_string}
+
+    def servicebus_path(self, options, *names):
+        namespace = [self.option(options, 'namespace-name')]
+        if self.option(options, 'topic-name'):
+            namespace += ['topics', self.option(options, 'topic-name')]
+        return self.resource_path(
+                    options, 'Microsoft.ServiceBus', 'namespaces',
+                    *namespace, *names, api_version='2017-04-01')
+
+    def servicebus_namespace_create(self, options, args):
+        sku = self.option(options, 'sku', 'Standard')
+        path = self.resource_path(
+                    options, 'Microsoft.ServiceBus', 'namespaces',
+                    self.option(options, 'name'), api_version='2017-04-01')
+        body = {
+            'location': self.option(options, 'location'),
+            'sku': {'name': sku, 'tier': sku}
+        }
+        return self.flatten(self.request('PUT', path, body, args))
+
+    def servicebus_authorization_rule_create(self, options, args):
+        path = self.servicebus_path(
+                    options, 'authorizationRules', self.option(options, 'name'))
+        body = {'properties': {'rights': options.get('rights', [])}}
+        return self.flatten(self.request('PUT', path, body, args))
+
+    def servicebus_authorization_rule_keys(self, options, args):
+        path = self.servicebus_path(
+                    options, 'authorizationRules',
+                    self.option(options, 'name'), 'listKeys')
+        return self.request('POST', path, None, args)
+
+    def servicebus_queue_create(self, options, args):
+        path = self.servicebus_path(options, 'queues', self.option(options, 'name'))
+        body = {'properties': {'requiresSession': self.flag(options, 'enable-session')}}
+        return self.flatten(self.request('PUT', path, body, args))
+
+    def servicebus_topic_create(self, options, args):
+        path = self.servicebus_path(options, 'topics', self.option(options, 'name'))
+        body = {'properties': {'supportOrdering': self.flag(options, 'enable-ordering')}}
+        return self.flatten(self.request('PUT', path, body, args))
+
+    def servicebus_subscription_create(self, options, args):
+        path = self.servicebus_path(
+                    options, 'subscriptions', self.option(options, 'name'))
+        return self.flatten(self.request('PUT', path, {'properties': {}}, args))
+
+    def eventgrid_domain_create(self, options, args):
+        path = self.resource_path(
+                    options, 'Microsoft.EventGrid', 'domains',
+                    self.option(options, 'name'), api_version='2020-06-01')
+        body = {'location': self.option(options, 'location'), 'properties': {}}
+        return self.flatten(self.request('PUT', path, body, args))
+
+    def eventgrid_domain_show(self, options, args):
+        path = self.resource_path(
+                    options, 'Microsoft.EventGrid', 'domains',
+                    self.option(options, 'name'), api_version='2020-06-01')
+        return self.flatten(self.request('GET', path, None, args))
+
+    def eventgrid_domain_keys(self, options, args):
+        path = self.resource_path(
+                    options, 'Microsoft.EventGrid', 'domains',
+                    self.option(options, 'name'), 'listKeys',
+                    api_version='2020-06-01')
+        return self.request('POST', path, None, args)
+
+    def app_service_plan_create(self, options, args):
+        sku = self.option(options, 'sku', 'B1').upper()
+        tier = next(t for p, t in app_service_plan_tiers if sku.startswith(p))
+        path = self.resource_path(
+                    options, 'Microsoft.Web', 'serverfarms',
+                    self.option(options, 'name'), api_version='2020-12-01')
+        body = {
+            'location': self.option(options, 'location'),
+            'kind': 'linux' if self.flag(options, 'is-linux') else 'app',
+            'sku': {
+                'name': sku,
+                'tier': tier,
+                'capacity': int(self.option(options, 'number-of-workers', 1))
+            },
+            'properties': {'reserved': self.flag(options, 'is-linux')}
+        }
+        return self.request('PUT', path, body, args)
+
+    def site_path(self, options, *names):
+        return self.resource_path(
+                    options, 'Microsoft.Web', 'sites',
+                    self.option(options, 'name'), *names,
+                    api_version='2020-12-01')
+
+    def appsettings_list(self, options, args):
+        settings = self.request(
+                        'POST', self.site_path(options, 'config', 'appsettings', 'list'),
+                        None, args)
+        return [{'name': k, 'value': v, 'slotSetting': False}
+                for k, v in (settings.get('properties') or {}).items()]
+
+    def appsettings_set(self, options, args):
+        properties = {}
+        for s in options.get('settings', []):
+            if s.startswith('@'):
+                with open(s[1:], 'r') as f:
+                    for setting in json.load(f):
+                        properties[setting['name']] = setting['value']
+            else:
+                name, _, value = s.partition('=')
+                properties[name] = value
+
+        current = self.request(
+                        'POST', self.site_path(options, 'config', 'appsettings', 'list'),
+                        None, args)
+        settings = dict(current.get('properties') or {})
+        settings.update(properties)
+        self.request(
+            'PUT', self.site_path(options, 'config', 'appsettings'),
+            {'properties': settings}, args)
+        return [{'name': k, 'value': v, 'slotSetting': False}
+                for k, v in settings.items()]
+
+    def site_restart(self, options, args):
+        self.request('POST', self.site_path(options, 'restart'), None, args)
+
+    def provider_register(self, options, args):
+        subscription = self.option(options, 'subscription') or self.subscription
+        path = (f'/subscriptions/{subscription}'
+                f'/providers/{self.option(options, "namespace")}')
+        provider = self.request(
+                        'POST', f'{path}/register?api-version=2021-04-01', None, args)
+        while self.flag(options, 'wait') and provider.get('registrationState') != 'Registered':
+            time.sleep(5.0)
+            provider = self.request('GET', f'{path}?api-version=2021-04-01', None, args)
+
+    def rest(self, options, args):
+        uri = self.option(options, 'uri')
+        if uri.startswith('http') and not uri.startswith(arm_endpoint):
+            with self.stats_lock:
+                self.fallback_count += 1
+            return json.loads(self.fallback.run(args) or 'null')
+
+        body = self.option(options, 'body')
+        if body and body.startswith('@'):
+            with open(body[1:], 'r') as f:
+                body = f.read()
+        if uri.startswith(arm_endpoint):
+            uri = uri[len(arm_endpoint):]
+        return self.request(
+                    self.option(options, 'method', 'get').upper(),
+                    uri,
+                    json.loads(body) if body else None,
+                    args)
+
+    def stats(self):
+        '''
+            Returns:
+                Dictionary with number of ARM requests made and
+                number of commands run by the fallback backend
+        '''
+        with self.stats_lock:
+            return {
+                'requests': self.request_count,
+                'fallbackCommands': self.fallback_count
+            }
+
+
+az_backend = AzCliBackend()
 
-    if stderr and not stdout:
-        raise RaftAzCliException(stderr, r.args)
-    else:
-        return stdout
+
+def use_az_backend(backend):
+    '''
+        Sets the backend that runs the az commands of the deployment
+    '''
+    global az_backend
+    az_backend = backend
+
+
+def az(args):
+    return az_backend.run(args)
 
 
 def az_json(args):
     return json.loads(az(args))
 
 
+def share_copy_patterns(paths, excluded):
+    '''
+        Patterns of `az storage file copy start-batch` that match all of
+        the paths and none of the excluded paths. Every folder without
+        excluded paths in it is matched by one pattern.
+    '''
+    def escape(p):
+        return re.sub(r'([\[\]*?])', r'[\1]', p)
+
+    excluded_folders = set()
+    for p in excluded:
+        parts = p.split('/')
+        for i in range(1, len(parts)):
+            excluded_folders.add('/'.join(parts[:i]))
+
+    patterns = set()
+    for p in paths:
+        parts = p.split('/')
+        for i in range(1, len(parts)):
+            folder = '/'.join(parts[:i])
+            if folder not in excluded_folders:
+                patterns.add(f'{escape(folder)}/*')
+                break
+        else:
+            patterns.add(escape(p))
+    return sorted(patterns)
+
+
 def azure_function_keys(
         subscription_id, resource_group, function_app, function):
     uri = (f"/subscriptions/{subscription_id}"
@@ -59,8 +590,293 @@ def azure_function_keys(
     return az_json(f'rest --method post --uri {uri} --output json')
 
 
+class DeploymentGraph():
+    '''
+        Deployment steps and the steps they depend on.
+        Every step runs as soon as all of its dependencies completed,
+        independent steps run concurrently.
+
+        Results of completed steps are saved to a state file after every
+        step, so that a failed deployment can resume from the steps that
+        completed. Results of steps marked as secret are not saved, those
+        steps run again when the deployment resumes if a step that did not
+        complete needs their results.
+    '''
+    def __init__(self, state_path, state_key, max_workers=4):
+        self.state_path = state_path
+        self.state_key = state_key
+        self.max_workers = max_workers
+        self.steps = {}
+        self.timings = {}
+
+    def step(self, name, run, dependencies=None, secret=False):
+        '''
+            Parameters:
+                name: name of the step
+                run: function called with a dictionary of results of
+                     completed steps by step name. Returns the result of
+                     the step, which must be JSON serializable.
+                dependencies: names of the steps that must complete
+                              before this step runs
+                secret: result of the step contains secrets
+        '''
+        self.steps[name] = {
+            'run': run,
+            'dependencies': dependencies or [],
+            'secret': secret
+        }
+
+    def validate(self):
+        for name, step in self.steps.items():
+            for d in step['dependencies']:
+                if d not in self.steps:
+                    raise Exception(f'Deployment step {name} depends on'
+                                    f' unknown step {d}')
+
+        # Kahn's algorithm: every step must be reachable
+        # from steps without dependencies
+        resolved = set()
+        while len(resolved) < len(self.steps):
+            ready = [n for n, s in self.steps.items()
+                     if n not in resolved and
+                     all(d in resolved for d in s['dependencies'])]
+            if not ready:
+                cycle = [n for n in self.steps if n not in resolved]
+                raise Exception(f'Deployment steps have circular dependencies: {cycle}')
+            resolved.update(ready)
+
+    def load_state(self):
+        '''
+            Returns:
+                (names of completed steps, dictionary of results of
+                completed steps that are not secret by step name),
+                read from the state file of a failed deployment
+                with the same parameters
+        '''
+        if not os.path.exists(self.state_path):
+            return (set(), {})
+        try:
+            with open(self.state_path, 'r') as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return (set(), {})
+
+        if state.get('key') != self.state_key:
+            print('Deployment parameters changed since the failed deployment,'
+                  ' starting over')
+            return (set(), {})
+        completed = set(n for n in state.get('completed', []) if n in self.steps)
+        results = {n: r for n, r in state.get('results', {}).items()
+                   if n in completed and not self.steps[n]['secret']}
+        return (completed, results)
+
+    def save_state(self, completed, results):
+        state = {
+            'key': self.state_key,
+            'completed': [n for n in self.steps if n in completed],
+            'results': {n: r for n, r in results.items()
+                        if not self.steps[n]['secret']},
+            'timings': self.timings
+        }
+        tmp_path = self.state_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f, indent=4)
+        os.replace(tmp_path, self.state_path)
+
+    def clear_state(self):
+        if os.path.exists(self.state_path):
+            os.remove(self.state_path)
+
+    def steps_to_run(self, completed, results):
+        '''
+            Steps that did not complete, and completed secret steps
+            whose results are needed by those steps
+        '''
+        needed = set(n for n in self.steps if n not in completed)
+        stack = list(needed)
+        while stack:
+            for d in self.steps[stack.pop()]['dependencies']:
+                if d not in results and d not in needed:
+                    needed.add(d)
+                    stack.append(d)
+        return [n for n in self.steps if n in needed]
+
+    def run_step(self, name, results):
+        start = time.time()
+        try:
+            return self.steps[name]['run'](results)
+        finally:
+            self.timings[name] = time.time() - start
+
+    def run(self, resume=False):
+        '''
+            Runs all steps that did not complete yet.
+
+            Parameters:
+                resume: skip the steps that completed in the
+                        previous failed deployment
+
+            Returns:
+                Dictionary of results of the steps that ran by step name
+        '''
+        self.validate()
+        completed, results = self.load_state() if resume else (set(), {})
+        pending = self.steps_to_run(completed, results)
+        resumed = [n for n in self.steps if n not in pending]
+        if resumed:
+            print('Resuming deployment, skipping completed steps:'
+                  f' {", ".join(resumed)}')
+
+        start = time.time()
+        running = {}
+        failure = None
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            while pending or running:
+                # no new steps are started after a failure,
+                # the steps that are already running are let to complete
+                if failure is None:
+                    ready = [n for n in pending
+                             if all(d in results for d in self.steps[n]['dependencies'])]
+                    for name in ready:
+                        pending.remove(name)
+                        running[pool.submit(self.run_step, name, dict(results))] = name
+
+                if not running:
+                    break
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    try:
+                        results[name] = future.result()
+                    except Exception as ex:
+                        print(f'Deployment step {name} failed: {ex}')
+                        if failure is None:
+                            failure = ex
+                        continue
+                    completed.add(name)
+                    self.save_state(completed, results)
+
+        self.print_timings(resumed, time.time() - start)
+        if failure is not None:
+            self.save_state(completed, results)
+            print(f'Deployment state saved to {self.state_path}.'
+                  ' Run the deployment again with --resume to continue'
+                  ' from the completed steps')
+            raise failure
+        return results
+
+    def print_timings(self, resumed, elapsed):
+        print('Deployment step timings:')
+        width = max(len(n) for n in list(self.steps) + ['sum of steps'])
+        for name in self.steps:
+            if name in resumed:
+                print(f'    {name:<{width}}  resumed')
+            elif name in self.timings:
+                print(f'    {name:<{width}}  {self.timings[name]:8.1f}s')
+            else:
+                print(f'    {name:<{width}}  not run')
+        print(f'    {"sum of steps":<{width}}  {sum(self.timings.values()):8.1f}s')
+        print(f'    {"elapsed":<{width}}  {elapsed:8.1f}s')
+
+
+class ResourceStateCache():
+    '''
+        Hashes of the desired state of deployed resources, together with
+        an ETag of the remote resource read right after it was deployed.
+        A resource is up to date if neither its desired state nor its
+        remote ETag changed since. Only hashes are stored, never secrets.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.resources = {}
+        if os.path.exists(path):
+            try:
+                with open(path, 'r') as f:
+                    self.resources = json.load(f)
+            except (OSError, ValueError):
+                self.resources = {}
+
+    @staticmethod
+    def hash(desired):
+        return hashlib.sha256(
+            json.dumps(desired, sort_keys=True, default=str).encode()).hexdigest()
+
+    def reset(self):
+        '''
+            Treats every resource as changed. Resources deployed
+            afterwards are still recorded.
+        '''
+        with self.lock:
+            self.resources = {}
+
+    def unchanged(self, resource, desired, etag, max_age=None):
+        '''
+            Parameters:
+                resource: name of the resource
+                desired: JSON serializable desired state of the resource
+                etag: current ETag of the remote resource,
+                      None if the resource does not exist
+                max_age: seconds after which the resource is deployed
+                         again even if nothing changed
+
+            Returns:
+                True if the resource was deployed with the same desired
+                state and the remote resource did not change since
+        '''
+        with self.lock:
+            entry = self.resources.get(resource)
+        if entry is None or etag is None:
+            return False
+        if max_age is not None and time.time() - entry['time'] > max_age:
+            return False
+        return entry['hash'] == self.hash(desired) and entry['etag'] == etag
+
+    def record(self, resource, desired, etag):
+        with self.lock:
+            self.resources[resource] = {
+                'hash': self.hash(desired),
+                'etag': etag,
+                'time': time.time()
+            }
+            tmp_path = f'{self.path}.{threading.get_ident()}.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(self.resources, f, indent=4)
+            os.replace(tmp_path, self.path)
+
+    def apply(self, resource, desired, deploy, etag):
+        '''
+            Deploys the resource unless it is up to date
+
+            Parameters:
+                resource: name of the resource
+                desired: JSON serializable desired state of the resource
+                deploy: function that deploys the resource
+                etag: function that returns the current ETag of the
+                      remote resource, or None if it does not exist
+
+            Returns:
+                True if the resource was deployed
+        '''
+        if self.unchanged(resource, desired, etag()):
+            print(f'{resource} is up to date')
+            return False
+        deploy()
+        self.record(resource, desired, etag())
+        return True
+
+
 class RaftServiceCLI():
-    def __init__(self, context, defaults_path, secret=None):
+    def __init__(self, context, defaults_path, secret=None, use_az_cli=False):
+        '''
+            Parameters:
+                context: deployment context
+                defaults_path: path of the deployment context file
+                secret: service principal secret to log in with
+                use_az_cli: run every Azure command with the az CLI
+                            instead of Azure Resource Manager REST calls
+        '''
         self.defaults_path = defaults_path
         self.context = context
         self.definitions = RaftDefinitions(self.context)
@@ -72,6 +888,8 @@ class RaftServiceCLI():
             self.metrics_app_insights_key = ''
         self.site_hash = self.hash(
             self.definitions.subscription + self.definitions.deployment)
+        self.resource_state = ResourceStateCache(
+            os.path.join(tmp_dir, f'{self.site_hash}-resource-state.json'))
 
         if not secret:
             self.is_logged_in()
@@ -83,6 +901,9 @@ class RaftServiceCLI():
 
         az(f'account set --subscription {self.definitions.subscription}')
 
+        if not use_az_cli:
+            use_az_backend(ArmBackend(self.definitions.subscription))
+
     def is_logged_in(self):
         # If your not logged in this command will throw
         # an exception and say in the error message
@@ -276,6 +1097,112 @@ class RaftServiceCLI():
             time.sleep(2.0)
             self.create_keyvault_event_subscription()
 
+    def keyvault_event_subscription_state(self):
+        '''
+            Returns:
+                (desired state of the Key Vault event subscription,
+                ETag of the deployed subscription or None if it does
+                not exist)
+        '''
+        rg_id = (f'/subscriptions/{self.definitions.subscription}'
+                 f'/resourceGroups/{self.definitions.resource_group}')
+        source = f'{rg_id}/providers/Microsoft.KeyVault/vaults/{self.definitions.key_vault}'
+        desired = {
+            'source': source,
+            'endpoint': (f'{rg_id}/providers/Microsoft.Web/sites'
+                         f'/{self.definitions.orchestrator}/functions/OnSecretChanged'),
+            'includedEventTypes': ['Microsoft.KeyVault.SecretNewVersionCreated']
+        }
+
+        try:
+            subscription = az_json(
+                'rest --method get --uri'
+                f' {source}/providers/Microsoft.EventGrid'
+                '/eventSubscriptions/OnSecretChanged?api-version=2020-06-01')
+        except (RaftAzCliException, ValueError):
+            return desired, None
+
+        properties = subscription.get('properties') or {}
+        if properties.get('provisioningState') != 'Succeeded':
+            return desired, None
+        destination = (properties.get('destination') or {}).get('properties') or {}
+        included = (properties.get('filter') or {}).get('includedEventTypes')
+        return desired, ResourceStateCache.hash([destination.get('resourceId'), included])
+
+    def app_settings_etag(self, app_kind, name):
+        '''
+            Parameters:
+                app_kind: webapp or functionapp
+
+            Returns:
+                Hash of the application settings of the app,
+                or None if the app does not exist. The tools file share
+                is switched by upload_utils and is not part of the hash.
+        '''
+        try:
+            settings = az_json(f'{app_kind} config appsettings list'
+                               f' --name {name}'
+                               f' --resource-group {self.definitions.resource_group}')
+        except (RaftAzCliException, ValueError):
+            return None
+        return ResourceStateCache.hash({s['name']: s['value'] for s in settings
+                                        if s['name'] != 'RAFT_UTILS_FILESHARE'})
+
+    def key_vault_service_principal(self):
+        '''
+            Returns:
+                (version ID of the service principal credentials secret,
+                service principal stored in the Key Vault), or
+                (None, None) if there is no secret
+        '''
+        try:
+            secret = az_json('keyvault secret show'
+                             ' --name RaftServicePrincipal'
+                             f' --vault-name {self.definitions.key_vault}')
+            auth = json.loads(secret['value'])
+            return secret['id'], {
+                'appId': auth['client'],
+                'tenant': auth['tenant'],
+                'password': auth['secret']
+            }
+        except (RaftAzCliException, ValueError, KeyError):
+            return None, None
+
+    def service_principal_etag(self, secret_id, sp_app_id):
+        '''
+            Parameters:
+                secret_id: version ID of the service principal
+                           credentials secret in the Key Vault
+                sp_app_id: application ID of the service principal
+
+            Returns:
+                ETag of the service principal credentials and role
+                assignments, or None if the service principal lost
+                any of the roles assigned by the deployment
+        '''
+        try:
+            credentials = az_json(f'ad sp credential list --id {sp_app_id}')
+            assignments = az_json(f'role assignment list --all --assignee {sp_app_id}')
+        except (RaftAzCliException, ValueError):
+            return None
+
+        rg_scope = (f'/subscriptions/{self.definitions.subscription}'
+                    f'/resourceGroups/{self.definitions.resource_group}')
+        required = set([
+            ('contributor', rg_scope.lower()),
+            ('key vault secrets user',
+             f'{rg_scope}/providers/Microsoft.KeyVault/vaults/{self.definitions.key_vault}'.lower())
+        ])
+        assigned = set((f'{a.get("roleDefinitionName")}'.lower(), f'{a.get("scope")}'.lower())
+                       for a in assignments)
+        if not required.issubset(assigned):
+            return None
+
+        # a credential that was removed or added since the
+        # deployment changes the ETag
+        key_ids = sorted(f'{c.get("keyId")}' for c in credentials)
+        return ResourceStateCache.hash({'secret': secret_id, 'keyIds': key_ids})
+
     def assign_resource_group_roles(self, sp_app_id):
         print('Assigning Resource Group roles')
         try:
@@ -370,35 +1297,93 @@ class RaftServiceCLI():
         return (f"TableEndpoint=https://{storage_account}"
                 f".table.core.windows.net/;SharedAccessSignature={sas_url}")
 
-    def cleanup_function_secret_snapshots(self, storage_account, function_name):
-        container_exists = az_json(
-            'storage container exists'
-            f' --account-name {storage_account}'
-            ' --name "azure-webjobs-secrets"'
-        )
-
-        if container_exists['exists'] == True:
-            snapshots = az_json(
-                'storage blob list'
-                f' --account-name {storage_account}'
-                ' --container-name "azure-webjobs-secrets"'
-                f' --prefix "{function_name}/host.snapshot"') 
-
-            for snapshot in snapshots:
-                name = snapshot['name']
-                try:
-                    az(
-                        'storage blob delete'
-                        f' --account-name {storage_account}'
-                        f' --container-name {snapshot["container"]}'
-                        f' --name "{name}"'
-                        ' --delete-snapshots include'
-                    ) 
-                except RaftAzCliException as ex:
-                    if ex.error_message.startswith("WARNING:"):
-                        pass
-                    else:
-                        raise
+    def container_sas(self, connection_string, container, permissions):
+        expiry = (datetime.now(timezone.utc) + timedelta(hours=1)).strftime('%Y-%m-%dT%H:%MZ')
+        return az_json(
+            'storage container generate-sas'
+            f' --name "{container}"'
+            f' --permissions {permissions}'
+            f' --expiry {expiry}'
+            f' --connection-string "{connection_string}"')
+
+    def cleanup_function_secret_snapshots(
+            self, storage_account, function_name,
+            prefix=None, dry_run=False, max_workers=8, timeout=60):
+        '''
+            Deletes host secret snapshots of an Azure function.
+            Blobs are listed and deleted with Blob service REST calls
+            authorized by a short lived container SAS, concurrently over
+            one pooled session.
+
+            Parameters:
+                storage_account: storage account of the function
+                function_name: name of the function
+                prefix: prefix of the blobs to delete, by default the host
+                        secret snapshots of the function
+                dry_run: only count the blobs that would be deleted
+                max_workers: maximum number of concurrent delete requests
+                timeout: seconds to wait for a response of a request
+
+            Returns:
+                Number of blobs deleted, or that would be deleted
+                on a dry run
+        '''
+        container = 'azure-webjobs-secrets'
+        if prefix is None:
+            prefix = f'{function_name}/host.snapshot'
+
+        connection_string = self.storage_account_connection_string(storage_account)
+        suffix = 'core.windows.net'
+        for part in connection_string.split(';'):
+            if part.startswith('EndpointSuffix='):
+                suffix = part[len('EndpointSuffix='):]
+        container_url = f'https://{storage_account}.blob.{suffix}/{container}'
+        sas = self.container_sas(connection_string, container, 'ld')
+        headers = {'x-ms-version': '2020-04-08'}
+
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_workers)
+        session.mount('https://', adapter)
+        try:
+            names = []
+            marker = ''
+            while True:
+                response = session.get(
+                    f'{container_url}?restype=container&comp=list'
+                    f'&prefix={quote(prefix)}&marker={quote(marker)}&{sas}',
+                    headers=headers, timeout=timeout)
+                if response.status_code == 404:
+                    # the function did not create any secrets yet
+                    return 0
+                if not response.ok:
+                    raise RaftApiException(response.text, response.status_code)
+
+                result = ElementTree.fromstring(response.content)
+                names += [b.findtext('Name') for b in result.iter('Blob')]
+                marker = result.findtext('NextMarker') or ''
+                if not marker:
+                    break
+
+            if dry_run:
+                print(f'{len(names)} secret snapshots of {function_name}'
+                      f' would be deleted')
+                return len(names)
+
+            def delete(name):
+                response = session.delete(
+                    f'{container_url}/{quote(name)}?{sas}',
+                    headers=dict(headers, **{'x-ms-delete-snapshots': 'include'}),
+                    timeout=timeout)
+                # blobs deleted by the function in the meantime are fine
+                if not response.ok and response.status_code != 404:
+                    raise RaftApiException(response.text, response.status_code)
+
+            with ThreadPoolExecutor(max_workers=max_workers) as pool:
+                list(pool.map(delete, names))
+            print(f'Deleted {len(names)} secret snapshots of {function_name}')
+            return len(names)
+        finally:
+            session.close()
 
     def container_image_name(self, registry_image_name):
         return (
@@ -1015,13 +2000,18 @@ class RaftServiceCLI():
                     break
 
     def dos2unix(self, file_path):
+        with open(file_path, 'rb') as dos_file:
+            file_contents = dos_file.read()
+
+        # rewrite only files that have DOS line endings,
+        # so unchanged files keep their content hash
+        if b'\r' not in file_contents:
+            return
+
         print(f'Converting dos2unix {file_path}')
         dos_file_path = file_path + ".dos"
         os.rename(file_path, dos_file_path)
 
-        with open(dos_file_path, 'rb') as dos_file:
-            file_contents = dos_file.read()
-
         with open(file_path, 'wb') as unix_file:
             for line in file_contents.splitlines():
                 unix_file.write(line + b'\n')
@@ -1034,40 +2024,175 @@ class RaftServiceCLI():
                 if pathlib.Path(file_path).suffix in dos2unix_file_types:
                     self.dos2unix(file_path)
 
-    def upload_utils(self, file_share, custom_tools=None):
+    def tools_manifest(self, folders):
+        '''
+            Content hashes of the files in the folders.
+            Files in later folders override files with the same relative
+            path in earlier folders.
+
+            Returns:
+                Dictionary of relative file path to
+                (SHA-256 of file content, local file path)
+        '''
+        manifest = {}
+        for folder in folders:
+            for root_folder_path, dirs, files in os.walk(folder):
+                dirs[:] = [d for d in dirs if d != '__pycache__']
+                for file_name in files:
+                    file_path = os.path.join(root_folder_path, file_name)
+                    relative_path = pathlib.Path(os.path.relpath(file_path, folder)).as_posix()
+                    h = hashlib.sha256()
+                    with open(file_path, 'rb') as f:
+                        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                            h.update(chunk)
+                    manifest[relative_path] = (h.hexdigest(), file_path)
+        return manifest
+
+    def current_utils_file_share(self):
+        '''
+            Name of the tools file share used by the orchestrator,
+            or None if the orchestrator is not deployed yet
+        '''
+        try:
+            settings = az_json('functionapp config appsettings list'
+                               f' --name {self.definitions.orchestrator}'
+                               f' --resource-group {self.definitions.resource_group}')
+        except (RaftAzCliException, ValueError):
+            return None
+
+        for setting in settings:
+            if setting['name'] == 'RAFT_UTILS_FILESHARE':
+                return setting['value']
+        return None
+
+    def download_tools_manifest(self, file_share, connection_string):
+        manifest_path = os.path.join(tmp_dir, f'{file_share}{tools_manifest_name}')
+        try:
+            az('storage file download'
+               f' --connection-string "{connection_string}"'
+               f' --share-name {file_share}'
+               f' --path {tools_manifest_name}'
+               f' --dest "{manifest_path}"')
+            with open(manifest_path, 'r') as m:
+                return json.load(m)
+        except (RaftAzCliException, OSError, ValueError):
+            return {}
+        finally:
+            if os.path.exists(manifest_path):
+                os.remove(manifest_path)
+
+    def upload_utils(self, file_share=None, custom_tools=None):
+        '''
+            Uploads raft-tools and custom tools to the tools file share.
+
+            Running jobs mount the tools file share used by the service,
+            so that share is never changed. If the content hashes of the
+            tools differ from the manifest stored in that share, the tools
+            are uploaded to a new share: unchanged files are copied
+            server side from the current share, only changed files are
+            uploaded, and then the service is switched to the new share.
+
+            Parameters:
+                file_share: name of the new file share. If not set,
+                            a name is generated.
+                custom_tools: path to custom tools folder
+
+            Returns:
+                True if the file share used by the service changed
+        '''
         utils = os.path.join(f'{script_dir}', '..', 'raft-tools')
         self.convert_dir_dos2unix(utils)
 
+        folders = [utils]
+        if custom_tools:
+            print(f'Uploading custom tools {custom_tools}')
+            folders.append(custom_tools)
+        local_manifest = self.tools_manifest(folders)
+
         connection_string = self.storage_account_connection_string(
                                 self.definitions.storage_utils)
 
-        exists = az_json('storage share exists'
-                         f' --name {file_share}'
-                         f' --connection-string "{connection_string}"')
+        def share_exists(share):
+            return az_json('storage share exists'
+                           f' --name {share}'
+                           f' --connection-string "{connection_string}"')['exists'] is True
 
-        if exists['exists'] is True:
-            print(f'Uploading tools to an existing share {file_share}')
+        service_file_share = self.current_utils_file_share()
+        current_file_share = service_file_share
+        if current_file_share and share_exists(current_file_share):
+            remote_manifest = self.download_tools_manifest(current_file_share, connection_string)
         else:
+            # the service refers to a share that was not created yet,
+            # no job can be using it
+            if not file_share:
+                file_share = current_file_share
+            current_file_share = None
+            remote_manifest = {}
+
+        changed = [p for p in local_manifest if remote_manifest.get(p) != local_manifest[p][0]]
+        removed = [p for p in remote_manifest if p not in local_manifest]
+        unchanged = [p for p in local_manifest if p not in changed]
+        if current_file_share and not changed and not removed:
+            print(f'Tools in file share {current_file_share} are up to date')
+            return False
+
+        print(f'{len(changed)} files changed, {len(removed)} files removed,'
+              f' {len(unchanged)} files up to date')
+
+        if not file_share or file_share == current_file_share:
+            file_share = f'{uuid.uuid4()}'
+        if not share_exists(file_share):
             print(f'Creating new file share {file_share}')
-            share = az_json('storage share create'
-                            f' --name {file_share}'
-                            f' --connection-string "{connection_string}"')
-
-        upload = az('storage file upload-batch'
-                    f' --connection-string "{connection_string}"'
-                    f' --destination {file_share}'
-                    f' --source {utils}'
-                    f' --pattern "*"'
-                    ' --validate-content')
-
-        if custom_tools:
-            print(f'Uploading custom tools {custom_tools}')
-            az('storage file upload-batch'
+            az_json('storage share create'
+                    f' --name {file_share}'
+                    f' --connection-string "{connection_string}"')
+
+        if current_file_share and unchanged:
+            # copies within the same storage account complete synchronously
+            patterns = share_copy_patterns(unchanged, changed + removed)
+            print(f'Copying {len(unchanged)} unchanged files from'
+                  f' file share {current_file_share}')
+            for pattern in patterns:
+                az('storage file copy start-batch'
+                   f' --connection-string "{connection_string}"'
+                   f' --source-share {current_file_share}'
+                   f' --destination-share {file_share}'
+                   f' --pattern "{pattern}"')
+
+        # stage changed files, so that they are uploaded by one
+        # parallel batch upload
+        staging = os.path.join(tmp_dir, f'tools-{uuid.uuid4()}')
+        try:
+            for p in changed:
+                staged_path = os.path.join(staging, *p.split('/'))
+                os.makedirs(os.path.dirname(staged_path), exist_ok=True)
+                shutil.copyfile(local_manifest[p][1], staged_path)
+
+            if changed:
+                az('storage file upload-batch'
+                   f' --connection-string "{connection_string}"'
+                   f' --destination {file_share}'
+                   f' --source "{staging}"'
+                   f' --pattern "*"'
+                   ' --max-connections 8'
+                   ' --validate-content')
+
+            # the manifest is uploaded last, so that it never lists
+            # files which failed to upload
+            manifest_path = os.path.join(staging, tools_manifest_name)
+            os.makedirs(staging, exist_ok=True)
+            with open(manifest_path, 'w') as m:
+                json.dump({p: local_manifest[p][0] for p in local_manifest}, m, indent=1)
+            az('storage file upload'
                f' --connection-string "{connection_string}"'
-               f' --destination {file_share}'
-               f' --source {custom_tools}'
-               f' --pattern "*"'
-               ' --validate-content')
+               f' --share-name {file_share}'
+               f' --source "{manifest_path}"'
+               f' --path {tools_manifest_name}')
+        finally:
+            shutil.rmtree(staging, ignore_errors=True)
+
+        if file_share == service_file_share:
+            return True
 
         print('Updating orchestrator utils file share')
         az('functionapp config appsettings set'
@@ -1080,149 +2205,322 @@ class RaftServiceCLI():
             f' --name {self.definitions.api_service_webapp}'
             f' --resource-group {self.definitions.resource_group}'
             f' --settings "RAFT_UTILS_FILESHARE={file_share}"')
-        return
-
-    def deploy(self, sku, skip_sp_deployment):
-        if skip_sp_deployment and not (
-                self.context.get('clientId') and
-                self.context.get('tenantId') and
-                self.context.get('secret')):
-            raise Exception('Only can skip Service Principal'
-                            'deployment when redeploying existing'
-                            'service and passing secret'
-                            'as deployment parameter')
-
-        self.test_az_version()
-
-        # if opt-out-from-metrics is not present, then assume that user
-        # is opt-in and patch the defaults.json with that
-        print(f'Creating deployment with hash {self.site_hash}')
-        az("group create"
-           f" --name {self.definitions.resource_group}"
-           f" --location {self.context['region']}")
-        print(f"Deployment Resource Group: {self.definitions.resource_group}")
+        return True
 
+    def init_key_vault_if_missing(self):
         try:
             self.init_key_vault()
         except RaftAzCliException as ex:
             if ex.error_message == f'The specified vault: {self.definitions.key_vault} already exists':
                 pass
 
+    def deploy_service_principal(self, skip_sp_deployment):
         service_principal = {}
         if skip_sp_deployment:
             print('Skipping Service Principal deployment...')
             service_principal['appId'] = self.context['clientId']
             service_principal['tenant'] = self.context['tenantId']
             service_principal['password'] = self.context['secret']
-        else:
-            service_principal = self.init_service_principal(
-                                    self.definitions.deployment + "-raft",
-                                    self.definitions.subscription,
-                                    self.definitions.resource_group,
-                                    [self.assign_resource_group_roles,
-                                     self.assign_keyvault_roles])
-
-            # add service principal information to the keyvault
-            auth = {
-                'client': service_principal['appId'],
-                'tenant': service_principal['tenant'],
-                'secret': service_principal['password']
-            }
-            sp_path = os.path.join(tmp_dir, 'sp.json')
-            with open(sp_path, 'w') as sp_json:
-                json.dump(auth, sp_json)
-
-            az('keyvault secret set'
-                f' --description "{self.definitions.deployment}'
-                ' Service Principal authentication credentials"'
-                f" --file {sp_path}"
-                ' --name RaftServicePrincipal'
-                f' --vault-name {self.definitions.key_vault}')
+            return service_principal
+
+        name = self.definitions.deployment + "-raft"
+        desired = {
+            'name': name,
+            'subscription': self.definitions.subscription,
+            'resourceGroup': self.definitions.resource_group,
+            'keyVault': self.definitions.key_vault
+        }
+        # credentials are rotated every 180 days, even if nothing changed
+        secret_id, service_principal = self.key_vault_service_principal()
+        etag = None
+        if secret_id:
+            etag = self.service_principal_etag(secret_id, service_principal['appId'])
+        if self.resource_state.unchanged(
+                'service_principal', desired, etag, max_age=180 * 24 * 3600):
+            print('Service Principal is up to date,'
+                  ' using its credentials from the Key Vault')
+            return service_principal
+
+        service_principal = self.init_service_principal(
+                                name,
+                                self.definitions.subscription,
+                                self.definitions.resource_group,
+                                [self.assign_resource_group_roles,
+                                 self.assign_keyvault_roles])
+
+        # add service principal information to the keyvault
+        auth = {
+            'client': service_principal['appId'],
+            'tenant': service_principal['tenant'],
+            'secret': service_principal['password']
+        }
+        sp_path = os.path.join(tmp_dir, 'sp.json')
+        with open(sp_path, 'w') as sp_json:
+            json.dump(auth, sp_json)
 
+        try:
+            secret = az_json('keyvault secret set'
+                             f' --description "{self.definitions.deployment}'
+                             ' Service Principal authentication credentials"'
+                             f" --file {sp_path}"
+                             ' --name RaftServicePrincipal'
+                             f' --vault-name {self.definitions.key_vault}')
+        finally:
             try:
                 os.remove(sp_path)
             except OSError:
                 pass
 
-        if self.context.get('isPrivateRegistry'):
-            if 'getToken' in self.context:
-                print('Getting container registry token')
-                token_name = f"token-{self.site_hash}"
-                response = requests.get(
-                    f"{self.context['getToken']}&name={token_name}")
-                if response.ok:
-                    content = json.loads(response.text, object_hook=RaftJsonDict.raft_json_object_hook)
-                    container_registry_username = content['tokenName']
-                    container_registry_password = content['password']
-                else:
-                    raise RaftApiException(response.text, response.status_code)
+        self.resource_state.record(
+            'service_principal', desired,
+            self.service_principal_etag(secret.get('id'), service_principal['appId']))
+        return service_principal
+
+    def container_registry_credentials(self, service_principal):
+        '''
+            Returns:
+                (username, password) of the container registry,
+                (None, None) if the registry is public
+        '''
+        if not self.context.get('isPrivateRegistry'):
+            return (None, None)
+
+        if 'getToken' in self.context:
+            print('Getting container registry token')
+            token_name = f"token-{self.site_hash}"
+            response = requests.get(
+                f"{self.context['getToken']}&name={token_name}")
+            if response.ok:
+                content = json.loads(response.text, object_hook=RaftJsonDict.raft_json_object_hook)
+                return (content['tokenName'], content['password'])
             else:
-                container_registry_username = service_principal['appId']
-                container_registry_password = service_principal['password']
+                raise RaftApiException(response.text, response.status_code)
         else:
-            container_registry_username = None
-            container_registry_password = None
-
-        sb_connection_strings = self.init_service_bus()
-        app_insights = self.init_app_insights()
-
-        self.init_storage_account(self.definitions.storage_utils)
-        storage_connection_string_with_sas = (
-            self.create_storage_connection_string_with_sas(
-                self.definitions.storage_utils))
-        self.init_file_storage(self.definitions.storage_results)
+            return (service_principal['appId'], service_principal['password'])
 
-        self.init_event_grid_domain()
-
-        self.init_app_service_plan(sku)
-        tools_file_share = f'{uuid.uuid4()}'
-
-        self.init_api_app_service(
-            sb_connection_strings,
-            app_insights,
-            storage_connection_string_with_sas,
-            service_principal,
-            container_registry_username,
-            container_registry_password,
-            tools_file_share)
-
-        self.init_orchestrator(
-            sb_connection_strings,
-            app_insights,
-            storage_connection_string_with_sas,
-            service_principal,
-            container_registry_username,
-            container_registry_password,
-            tools_file_share)
-
-        self.cleanup_function_secret_snapshots(self.definitions.storage_utils, self.definitions.orchestrator)
+    def deploy_app(self, resource, app_kind, name, registry_image_name, inputs, deploy):
+        '''
+            Deploys a web app or function app, unless its inputs and
+            its application settings did not change since the last deployment
+
+            Parameters:
+                resource: name of the resource in the resource state cache
+                app_kind: webapp or functionapp
+                name: name of the app
+                registry_image_name: name of the container image of the app
+                inputs: keyword arguments of deploy
+                deploy: function that deploys the app
+
+            Returns:
+                True if the app was deployed
+        '''
+        desired = {
+            'image': self.container_image_name(registry_image_name),
+            'plan': self.definitions.asp,
+            'useAppInsights': self.context['useAppInsights'],
+            'metricsAppInsightsKey': self.metrics_app_insights_key,
+            # the tools file share changes on every tools update,
+            # the app does not have to be deployed again for it
+            'inputs': {k: v for k, v in inputs.items() if k != 'utils_file_share'}
+        }
+        return self.resource_state.apply(
+                    resource, desired,
+                    lambda: deploy(**inputs),
+                    lambda: self.app_settings_etag(app_kind, name))
 
-        self.upload_utils(tools_file_share)
+    def deployment_graph(self, sku, skip_sp_deployment, max_workers=4):
+        '''
+            Deployment steps of the service.
+            Steps that do not depend on each other run concurrently.
+        '''
+        state_key = self.hash(json.dumps([
+            self.definitions.subscription,
+            self.definitions.deployment,
+            self.context['region'],
+            sku,
+            skip_sp_deployment]))
+        graph = DeploymentGraph(
+                    os.path.join(tmp_dir, f'{self.definitions.deployment}-deployment-state.json'),
+                    state_key,
+                    max_workers)
+
+        def resource_group(r):
+            az("group create"
+               f" --name {self.definitions.resource_group}"
+               f" --location {self.context['region']}")
+            print(f"Deployment Resource Group: {self.definitions.resource_group}")
+
+        def web_app_args(r):
+            username, password = r['registry_credentials']
+            return {
+                'service_bus': r['service_bus'],
+                'app_insights': r['app_insights'],
+                'storage_connection_string_with_sas': r['storage_connection_string'],
+                'sp': r['service_principal'],
+                'container_registry_username': username,
+                'container_registry_password': password
+            }
 
+        web_app_dependencies = [
+            'service_bus', 'app_insights', 'storage_connection_string',
+            'service_principal', 'registry_credentials', 'app_service_plan']
+
+        graph.step('resource_group', resource_group)
+        graph.step('key_vault',
+                   lambda r: self.init_key_vault_if_missing(),
+                   ['resource_group'])
+        # service principal is assigned roles on the resource group and key vault
+        graph.step('service_principal',
+                   lambda r: self.deploy_service_principal(skip_sp_deployment),
+                   [] if skip_sp_deployment else ['key_vault'],
+                   secret=True)
+        graph.step('registry_credentials',
+                   lambda r: self.container_registry_credentials(r['service_principal']),
+                   ['service_principal'],
+                   secret=True)
+        graph.step('service_bus',
+                   lambda r: self.init_service_bus(),
+                   ['resource_group'],
+                   secret=True)
+        graph.step('app_insights',
+                   lambda r: self.init_app_insights(),
+                   ['resource_group'])
+        graph.step('storage_utils',
+                   lambda r: self.init_storage_account(self.definitions.storage_utils),
+                   ['resource_group'])
+        graph.step('storage_connection_string',
+                   lambda r: self.create_storage_connection_string_with_sas(
+                                self.definitions.storage_utils),
+                   ['storage_utils'],
+                   secret=True)
+        graph.step('storage_results',
+                   lambda r: self.init_file_storage(self.definitions.storage_results),
+                   ['resource_group'])
+        graph.step('event_grid_domain',
+                   lambda r: self.init_event_grid_domain(),
+                   ['resource_group'])
+        graph.step('app_service_plan',
+                   lambda r: self.init_app_service_plan(sku),
+                   ['resource_group'])
+        # keep using the tools file share of an existing deployment,
+        # upload_utils switches to a new share only if the tools changed
+        graph.step('tools_file_share',
+                   lambda r: self.current_utils_file_share() or f'{uuid.uuid4()}')
+        graph.step('api_service',
+                   lambda r: self.deploy_app(
+                                'api_service', 'webapp',
+                                self.definitions.api_service_webapp, 'apiservice',
+                                dict(web_app_args(r), utils_file_share=r['tools_file_share']),
+                                self.init_api_app_service),
+                   web_app_dependencies + ['event_grid_domain', 'tools_file_share'])
+        graph.step('orchestrator',
+                   lambda r: self.deploy_app(
+                                'orchestrator', 'functionapp',
+                                self.definitions.orchestrator, 'orchestrator',
+                                dict(web_app_args(r), utils_file_share=r['tools_file_share']),
+                                self.init_orchestrator),
+                   web_app_dependencies + [
+                       'key_vault', 'storage_results',
+                       'event_grid_domain', 'tools_file_share'])
+        graph.step('function_secret_snapshots',
+                   lambda r: self.cleanup_function_secret_snapshots(
+                                self.definitions.storage_utils,
+                                self.definitions.orchestrator),
+                   ['orchestrator'])
+        graph.step('upload_tools',
+                   lambda r: self.upload_utils(),
+                   ['api_service', 'orchestrator'])
+
+        # old function secret snapshots are only cleaned up,
+        # the service does not need to wait for it
+        service_dependencies = ['upload_tools']
         if self.context.get('isDevelop') and not skip_sp_deployment:
-            self.init_test_infra(
-                sb_connection_strings,
-                app_insights,
-                storage_connection_string_with_sas,
-                service_principal,
-                container_registry_username,
-                container_registry_password)
+            graph.step('test_infra',
+                       lambda r: self.deploy_app(
+                                    'test_infra', 'functionapp',
+                                    self.definitions.test_infra, 'test-infra',
+                                    web_app_args(r),
+                                    self.init_test_infra),
+                       web_app_dependencies)
+            service_dependencies.append('test_infra')
 
         if not skip_sp_deployment:
-            self.add_resource_providers()
+            graph.step('resource_providers',
+                       lambda r: self.add_resource_providers())
+            service_dependencies.append('resource_providers')
+
+        def deployment_context(r):
+            service_principal = r['service_principal']
+            self.context['clientId'] = service_principal['appId']
+            self.context['tenantId'] = service_principal['tenant']
+            self.context['secret'] = service_principal['password']
+            self.update_deployment_context()
+
+        def service_start(r):
+            print('Waiting for service to start'
+                  f' {self.definitions.api_service_webapp}')
+            self.wait_for_service_to_start()
+
+        def keyvault_event_subscription(r):
+            desired, etag = self.keyvault_event_subscription_state()
+            if self.resource_state.unchanged('keyvault_event_subscription', desired, etag):
+                print('Key Vault event subscription is up to date')
+                return
+            # The orchestrator *must* be running for this to succeed.
+            print('Creating Key Vault event subscription')
+            self.create_keyvault_event_subscription()
+            desired, etag = self.keyvault_event_subscription_state()
+            self.resource_state.record('keyvault_event_subscription', desired, etag)
+
+        # the service principal secret is not saved in the state,
+        # so the context is updated on every run
+        graph.step('deployment_context',
+                   deployment_context,
+                   ['service_principal'] + service_dependencies,
+                   secret=True)
+        graph.step('service_start',
+                   service_start,
+                   ['deployment_context'])
+        graph.step('keyvault_event_subscription',
+                   keyvault_event_subscription,
+                   ['service_start'])
+        return graph
+
+    def deploy(self, sku, skip_sp_deployment, resume=False, max_workers=4, force=False):
+        '''
+            Deploys the service. Resources that do not depend on each other
+            are deployed concurrently.
+
+            Parameters:
+                sku: app service plan SKU
+                skip_sp_deployment: use the service principal from the
+                                    deployment context
+                resume: skip the steps that completed in the previous
+                        failed deployment with the same parameters
+                max_workers: maximum number of steps that run concurrently
+                force: deploy resources that did not change since the
+                       last deployment too
+        '''
+        if skip_sp_deployment and not (
+                self.context.get('clientId') and
+                self.context.get('tenantId') and
+                self.context.get('secret')):
+            raise Exception('Only can skip Service Principal'
+                            'deployment when redeploying existing'
+                            'service and passing secret'
+                            'as deployment parameter')
 
-        self.context['clientId'] = service_principal['appId']
-        self.context['tenantId'] = service_principal['tenant']
-        self.context['secret'] = service_principal['password']
+        self.test_az_version()
 
-        self.update_deployment_context()
-        print('Waiting for service to start'
-              f' {self.definitions.api_service_webapp}')
-        self.wait_for_service_to_start()
-        
-        # The orchestrator *must* be running for this to succeed.
-        print('Creating Key Vault event subscription')
-        self.create_keyvault_event_subscription()
+        # if opt-out-from-metrics is not present, then assume that user
+        # is opt-in and patch the defaults.json with that
+        print(f'Creating deployment with hash {self.site_hash}')
+        if force:
+            self.resource_state.reset()
+
+        graph = self.deployment_graph(sku, skip_sp_deployment, max_workers)
+        graph.run(resume)
+        graph.clear_state()
         print('Deployment Complete')
 
     def restart(self):
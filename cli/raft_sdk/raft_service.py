@@ -7,6 +7,7 @@ import os
 import sys
 import time
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 
 import tabulate
 from .raft_common import RaftApiException, RestApiClient, RaftDefinitions, RaftJsonDict
@@ -108,6 +109,158 @@ def print_status(status):
             print('======================')
 
 
+def status_by_agent(status):
+    '''
+        Indexes status object by agent name
+
+        Parameters:
+            status: status object returned by the service
+
+        Returns:
+            Dictionary of agent name to status entry
+    '''
+    return {s['agentName']: s for s in status}
+
+
+def status_diff(previous, status):
+    '''
+        Computes changes between two status snapshots of a job
+
+        Parameters:
+            previous: dictionary of agent name to status entry
+                      returned by status_by_agent, or None
+            status: status object returned by the service
+
+        Returns:
+            List of changes, one per new or changed agent. Every change
+            has jobId, agentName, tool, state and previousState (None if
+            the agent is new). Fields that did not change are omitted:
+                totalRequestCount: (previous count, count)
+                responseCodeCounts: dictionary of response code to
+                                    (previous count, count)
+                details: dictionary of new or changed details
+                utcEventTime, resultsUrl: new value
+    '''
+    if previous is None:
+        previous = {}
+
+    changes = []
+    for s in status:
+        p = previous.get(s['agentName'])
+        if p == s:
+            continue
+
+        change = {
+            'jobId': s['jobId'],
+            'agentName': s['agentName'],
+            'tool': s.get('tool'),
+            'state': s['state'],
+            'previousState': p['state'] if p else None
+        }
+
+        for k in ['utcEventTime', 'resultsUrl']:
+            if s.get(k) and (p is None or p.get(k) != s.get(k)):
+                change[k] = s[k]
+
+        metrics = s.get('metrics') or {}
+        previous_metrics = (p and p.get('metrics')) or {}
+        total_request_count = metrics.get('totalRequestCount') or 0
+        previous_total_request_count = previous_metrics.get('totalRequestCount') or 0
+        if total_request_count != previous_total_request_count:
+            change['totalRequestCount'] = (previous_total_request_count, total_request_count)
+
+        response_code_counts = metrics.get('responseCodeCounts') or {}
+        previous_response_code_counts = previous_metrics.get('responseCodeCounts') or {}
+        codes = {}
+        for code in response_code_counts:
+            count = response_code_counts[code]
+            previous_count = previous_response_code_counts.get(code, 0)
+            if count != previous_count:
+                codes[code] = (previous_count, count)
+        if codes:
+            change['responseCodeCounts'] = codes
+
+        details = s.get('details') or {}
+        previous_details = (p and p.get('details')) or {}
+        changed_details = {}
+        for k in details:
+            if previous_details.get(k) != details[k]:
+                changed_details[k] = details[k]
+        if changed_details:
+            change['details'] = changed_details
+
+        changes.append(change)
+    return changes
+
+
+def print_status_diff(changes):
+    '''
+        Prints changes computed by status_diff to standard output
+
+        Parameters:
+            changes: list of changes returned by status_diff
+    '''
+    def state(c):
+        if c['previousState'] and c['previousState'] != c['state']:
+            return f"{c['previousState']} -> {c['state']}"
+        else:
+            return c['state']
+
+    def print_details(c):
+        if c.get('details'):
+            print("Details:")
+            for k in c['details']:
+                print(f"{k} : {c['details'][k]}")
+
+    for c in changes:
+        if c['agentName'] == c['jobId']:
+            print(f"{c['jobId']} {state(c)}")
+            if c.get('utcEventTime'):
+                print(f'UtcEventTime: {c["utcEventTime"]}')
+            if c.get('resultsUrl'):
+                print(f'Results: {c["resultsUrl"]}')
+            print_details(c)
+
+    for c in changes:
+        if c['agentName'] != c['jobId']:
+            agent_status = (
+                f"Agent: {c['agentName']}"
+                f"    Tool: {c['tool']}"
+                f"    State: {state(c)}")
+
+            if c.get('totalRequestCount'):
+                previous_count, count = c['totalRequestCount']
+                print(f"{agent_status}"
+                        "     Total Request Count:"
+                        f" {count} (+{count - previous_count})")
+            else:
+                print(agent_status)
+
+            if c.get('responseCodeCounts'):
+                response_code_counts = []
+                for code, (previous_count, count) in c['responseCodeCounts'].items():
+                    response_code_counts.append([code, count, f'{count - previous_count:+}'])
+                table = tabulate.tabulate(
+                    response_code_counts,
+                    headers=['Response Code', 'Count', 'Change'])
+                print(table)
+                print()
+
+            print_details(c)
+            print('======================')
+
+
+def seconds_to_time_span(seconds):
+    '''
+        Converts number of seconds to a time span string
+        accepted by the service (d.hh:mm:ss)
+    '''
+    seconds = int(seconds)
+    days, seconds = divmod(seconds, 24 * 60 * 60)
+    hours, seconds = divmod(seconds, 60 * 60)
+    minutes, seconds = divmod(seconds, 60)
+    return f'{days}.{hours:02}:{minutes:02}:{seconds:02}'
+
 
 class RaftCLI():
     def __init__(self, context=None):
@@ -331,13 +484,133 @@ class RaftCLI():
                     return False, None
         return False, None
 
-    def poll(self, job_id, poll_interval=10, print_status=True):
+    def poll_many(self, job_ids, poll_interval=10, max_poll_interval=60, max_workers=8, on_change=None):
+        '''
+            Polls status of several jobs until all of them terminate.
+
+            The full status of every job is fetched once, concurrently.
+            After that every poll cycle makes a single request for the
+            job status entries updated since the previous cycle, so only
+            jobs that changed are re-evaluated. The poll interval doubles,
+            up to max_poll_interval, while none of the jobs change.
+
+            Parameters:
+                job_ids: list of job ids
+                poll_interval: initial poll interval in seconds
+                max_poll_interval: maximum poll interval in seconds
+                max_workers: maximum number of concurrent requests
+                             for the initial status fetch
+                on_change: called with job id and list of changes
+                           computed by status_diff every time job
+                           status changes
+
+            Yields:
+                (job_id, status, error) as soon as a job terminates.
+                error is a RaftJobError, or None if the job completed
+        '''
+        # job ID -> agent name -> latest status entry
+        statuses = {job_id: {} for job_id in job_ids}
+
+        def fetch(job_id):
+            try:
+                return job_id, self.job_status(job_id)
+            except RaftApiException as ex:
+                # job status is not set yet
+                if ex.status_code == 404:
+                    return job_id, []
+                raise
+
+        def merge(job_id, entries):
+            agents = statuses[job_id]
+            changes = status_diff(agents, entries)
+            agents.update(status_by_agent(entries))
+            if changes and on_change:
+                on_change(job_id, changes)
+            return len(changes) > 0
+
+        if len(job_ids) == 0:
+            return
+
+        with ThreadPoolExecutor(max_workers=min(max_workers, len(job_ids))) as pool:
+            for job_id, status in pool.map(fetch, job_ids):
+                merge(job_id, status)
+
+        pending = list(job_ids)
+        changed = set(job_ids)
+        interval = poll_interval
+        last_poll = time.time()
+        while True:
+            for job_id in [j for j in pending if j in changed]:
+                status = list(statuses[job_id].values())
+                completed, error = self.is_completed(status)
+                if completed:
+                    pending.remove(job_id)
+                    yield job_id, status, error
+
+            if len(pending) == 0:
+                return
+
+            time.sleep(interval)
+            poll_start = time.time()
+            # one minute margin for the time it takes to handle the request
+            time_span = seconds_to_time_span(poll_start - last_poll + 60)
+            try:
+                entries = self.list_jobs(time_span)
+            except RaftApiException as ex:
+                if ex.status_code != 404:
+                    raise
+                entries = []
+            last_poll = poll_start
+
+            updates = {}
+            for s in entries:
+                if s['jobId'] in statuses:
+                    updates.setdefault(s['jobId'], []).append(s)
+
+            changed = set()
+            for job_id in updates:
+                if merge(job_id, updates[job_id]):
+                    changed.add(job_id)
+
+            if len(changed) > 0:
+                interval = poll_interval
+            else:
+                interval = min(interval * 2, max_poll_interval)
+
+    def wait_all(self, job_ids, poll_interval=10, max_poll_interval=60, print_status=True):
+        '''
+            Waits until all jobs terminate.
+
+            Parameters:
+                job_ids: list of job ids
+                poll_interval: initial poll interval in seconds
+                max_poll_interval: maximum poll interval in seconds
+                print_status: print status of every job when it terminates
+
+            Returns:
+                Dictionary of job ID to RaftJobError,
+                or None if the job completed
+        '''
+        results = {}
+        for job_id, status, error in self.poll_many(job_ids, poll_interval, max_poll_interval):
+            results[job_id] = error
+            if print_status:
+                print(f'Job {job_id} terminated. {len(results)} out of {len(job_ids)} jobs done')
+                self.print_status(status)
+        return results
+
+    def poll(self, job_id, poll_interval=10, print_status=True, on_change=None):
         '''
             Polls and prints job status updates until job terminates.
+            Only agents that changed since the previous poll are printed.
 
             Parameters:
                 job_id: job id
                 poll_interval: poll interval in seconds
+                print_status: print status changes
+                on_change: called with job id and list of changes
+                           computed by status_diff every time job
+                           status changes
         '''
         og_status = None
         while True:
@@ -349,11 +622,14 @@ class RaftCLI():
                 i += 1
             try:
                 status = self.job_status(job_id)
-                if og_status != status:
-                    og_status = status
+                changes = status_diff(og_status, status)
+                if changes:
+                    og_status = status_by_agent(status)
                     if print_status:
                         print()
-                        self.print_status(status)
+                        print_status_diff(changes)
+                    if on_change:
+                        on_change(job_id, changes)
                 completed, error = self.is_completed(status)
                 if completed:
                     if error:
@@ -65,11 +65,14 @@ def run(cli, n_tasks, compile, test):
 
 if __name__ == "__main__":
     if '--local' in sys.argv:
-        #fails due to command being too long.
-        #Until this is addressed - do 20 tasks
         from raft_local import RaftLocalCLI
         cli = RaftLocalCLI(network='bridge')
-        n = 10
+        if cli.docker.name == 'engine':
+            n = 29
+        else:
+            #docker CLI fails due to command being too long.
+            #Until this is addressed - do 20 tasks
+            n = 10
     else:
         #actullay running 59 tasks
         #58 fuzzing tasks, and one "agent-utilities proxy" task